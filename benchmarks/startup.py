@@ -0,0 +1,99 @@
+"""
+Measure how long cwr takes to start up in each of its modes.
+
+Each mode is run several times, each time in a fresh interpreter against an
+empty results directory, and the best and median wall clock times are
+reported along with which of the slow to import dependencies were loaded.
+
+Usage: python benchmarks/startup.py [--repeat N] [MODE...]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import time
+
+
+HEAVY_MODULES = ['boto', 'bundletester', 'deployer', 'jinja2', 'jujuclient',
+                 'libcloud', 'requests']
+
+MODES = [
+    ('import', None),
+    ('help', ['--help']),
+    ('regenerate-index', ['--regenerate-index']),
+    ('rebuild-index', ['--rebuild-index']),
+    ('remove-test', ['--remove-test', 'missing-bundle']),
+    ('prune', ['--prune-older-than', '30', '--dry-run']),
+    ('compact', ['--compact-older-than', '30', '--dry-run']),
+]
+
+# Runs a mode in the child interpreter and reports the heavy modules it
+# loaded.
+CHILD = """
+import json, sys
+argv = json.loads(sys.argv[1])
+from cloudweatherreport import run
+if argv is not None:
+    sys.argv = ['cwr'] + argv
+    try:
+        run.entry_point()
+    except SystemExit:
+        pass
+heavy = sorted(set(m.split('.')[0] for m in sys.modules) & set({heavy!r}))
+sys.stderr.write('\\nHEAVY ' + json.dumps(heavy) + '\\n')
+""".format(heavy=HEAVY_MODULES)
+
+
+def run_mode(argv, results_dir):
+    if argv is not None:
+        argv = ['controller', 'test_plan.yaml', '--results-dir',
+                results_dir] + argv
+    with open(os.devnull, 'w') as devnull:
+        start = time()
+        process = subprocess.Popen(
+            [sys.executable, '-c', CHILD, json.dumps(argv)],
+            stdout=devnull, stderr=subprocess.PIPE)
+        _, err = process.communicate()
+        elapsed = time() - start
+    heavy = None
+    for line in err.splitlines():
+        if line.startswith('HEAVY '):
+            heavy = json.loads(line[len('HEAVY '):])
+    if heavy is None:
+        raise RuntimeError('Mode {} failed:\n{}'.format(argv, err))
+    return elapsed, heavy
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('modes', nargs='*', metavar='MODE',
+                        help='Modes to run: {} (default: all)'.format(
+                            ', '.join(name for name, _ in MODES)))
+    args = parser.parse_args(argv)
+    modes = [(name, mode_argv) for name, mode_argv in MODES
+             if not args.modes or name in args.modes]
+    print('{:<18} {:>8} {:>8}  {}'.format(
+        'mode', 'best', 'median', 'heavy imports'))
+    for name, mode_argv in modes:
+        times = []
+        for _ in range(args.repeat):
+            results_dir = mkdtemp(prefix='cwr-startup-')
+            try:
+                elapsed, heavy = run_mode(mode_argv, results_dir)
+            finally:
+                rmtree(results_dir)
+            times.append(elapsed)
+        times.sort()
+        print('{:<18} {:>7.3f}s {:>7.3f}s  {}'.format(
+            name, times[0], times[len(times) // 2],
+            ', '.join(heavy) or '-'))
+
+
+if __name__ == '__main__':
+    main()
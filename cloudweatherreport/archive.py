@@ -0,0 +1,178 @@
+"""
+Compaction of old reports into archives.
+
+Reports older than a cutoff are packed into one archive per bundle and
+month, archive/<bundle>/<YYYY-MM>.gz, so that the number of loose objects in
+the results store stays bounded.  An archive is a series of gzip members, one
+per report file, with a lookup file, archive/<bundle>/<YYYY-MM>.json, mapping
+each "<test_id>/<filename>" to the [offset, length] of its member.  Since a
+member can be decompressed on its own, the archive viewer only has to fetch
+a single report with a range request, and reports compacted later on are
+added by appending new members.
+"""
+from contextlib import closing
+from cStringIO import StringIO
+import gzip
+import json
+import logging
+import re
+import zlib
+
+from pkg_resources import resource_string
+
+from cloudweatherreport.utils import parallel_map
+
+
+VIEWER_FILES = {
+    'archive.html': 'static/archive.html',
+    'js/archive.js': 'static/js/archive.js',
+}
+
+
+def archive_filename(index_item):
+    """
+    Name of the archive a report index item is compacted into.
+    """
+    bundle_dir = index_item.filename_json.split('/')[0]
+    month = index_item.date.strftime('%Y-%m')
+    return 'archive/{}/{}.gz'.format(bundle_dir, month)
+
+
+def lookup_filename(archive):
+    """
+    Name of the lookup file for an archive.
+    """
+    return re.sub(r'\.gz$', '.json', archive)
+
+
+def compress(contents):
+    """
+    Compress contents as a single gzip member.
+    """
+    buf = StringIO()
+    with closing(gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)) as fp:
+        fp.write(contents)
+    return buf.getvalue()
+
+
+def read_lookup(datastore, archive):
+    filename = lookup_filename(archive)
+    if not datastore.exists(filename):
+        return {}
+    return json.loads(datastore.read(filename))
+
+
+def read_members(datastore, archive, names=None):
+    """
+    Read files from an archive.
+
+    Returns a dict of member names to their contents, for either every
+    member or only those in `names`.
+    """
+    lookup = read_lookup(datastore, archive)
+    data = datastore.read(archive, encoding=None)
+    members = {}
+    for name, (offset, length) in lookup.items():
+        if names is None or name in names:
+            members[name] = zlib.decompress(data[offset:offset + length],
+                                            16 + zlib.MAX_WBITS)
+    return members
+
+
+def read_report_json(datastore, index_item):
+    """
+    Read the JSON of an archived report.
+    """
+    name = '{}/report.json'.format(index_item.test_id)
+    members = read_members(datastore, index_item.archive, [name])
+    return members[name].decode('utf8')
+
+
+def append_members(datastore, archive, members):
+    """
+    Add files to an archive, creating it if necessary.
+
+    `members` is a list of (name, contents) tuples.  Members which are
+    already in the archive with the same contents are left unchanged.  A
+    member whose contents changed, such as a report which got a late result
+    after it was archived, is appended again and the lookup points to the
+    new copy.
+    """
+    lookup = read_lookup(datastore, archive)
+    buf = StringIO()
+    if lookup:
+        buf.write(datastore.read(archive, encoding=None))
+    for name, contents in members:
+        if name in lookup:
+            offset, length = lookup[name]
+            data = buf.getvalue()[offset:offset + length]
+            if zlib.decompress(data, 16 + zlib.MAX_WBITS) == contents:
+                continue
+        member = compress(contents)
+        lookup[name] = [buf.tell(), len(member)]
+        buf.write(member)
+    # Write the archive before its lookup, so that the lookup never refers
+    # to data which has not been written yet.
+    datastore.write(archive, buf.getvalue(), encoding=None)
+    datastore.write(lookup_filename(archive),
+                    json.dumps(lookup, sort_keys=True, indent=2))
+    return lookup
+
+
+def compact_reports(datastore, index_items, workers=16, dry_run=False):
+    """
+    Pack the files of reports into their archives.
+
+    Each index item which is archived is updated to point to its archive.
+    Returns a list of (filename, size) tuples of the loose files which were
+    archived, which can be deleted once the updated index is published.  On
+    a dry run, the files are listed but nothing is written.
+    """
+    groups = {}
+    for item in index_items:
+        groups.setdefault(archive_filename(item), []).append(item)
+    listings = {}
+    archived = []
+    for archive, items in sorted(groups.items()):
+        bundle_dir = archive.split('/')[1]
+        if bundle_dir not in listings:
+            listings[bundle_dir] = datastore.list_recursive(bundle_dir)
+        test_ids = set(item.test_id for item in items)
+        files = [(filename, size)
+                 for filename, size in listings[bundle_dir]
+                 if len(filename.split('/')) > 2 and
+                 filename.split('/')[1] in test_ids]
+        archived.extend(files)
+        logging.info('{} {} files, {} bytes, into {}'.format(
+            'Would archive' if dry_run else 'Archiving',
+            len(files), sum(size for _, size in files), archive))
+        if dry_run or not files:
+            continue
+
+        def read(filename):
+            return filename, datastore.read(filename, encoding=None)
+
+        contents = parallel_map(read, [f for f, _ in files], workers, 'files')
+        append_members(datastore, archive, [
+            (filename.split('/', 1)[1], data)
+            for filename, data in sorted(contents)])
+        found = set(filename.split('/')[1] for filename, _ in files)
+        for item in items:
+            if item.test_id in found:
+                item.archive = archive
+    return archived
+
+
+def write_viewer(datastore, force=False):
+    """
+    Publish the static archive viewer.
+
+    Like the dashboard, it only needs to be written once, so unless `force`
+    is set nothing is written if it has already been published.
+    """
+    if not force and datastore.exists('js/archive.js'):
+        return False
+    for filename, resource in sorted(VIEWER_FILES.items()):
+        datastore.write(filename,
+                        resource_string(__name__, resource).decode('utf8'))
+    return True
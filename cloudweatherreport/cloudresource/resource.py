@@ -2,9 +2,6 @@ import logging
 import os
 import yaml
 
-import cloudweatherreport.cloudresource.aws as aws
-import cloudweatherreport.cloudresource.gce as gce
-import cloudweatherreport.cloudresource.azure as azure
 from cloudweatherreport.utils import juju_cmd
 
 
@@ -55,7 +52,36 @@ def get_credentials(cloud, name=None):
     return credentials
 
 
+def get_resource_limits(cloud):
+    """Get the machine and CPU limits for a cloud.
+
+    These are the limits used by the resource checks: the
+    {CLOUD-NAME}_MACHINE_LIMIT and {CLOUD-NAME}_CPU_LIMIT environment
+    variables if they are set, otherwise the cloud's defaults.  A limit is
+    None if it is not known.
+    """
+    # The cloud modules are imported when needed since libcloud is slow to
+    # import.
+    from cloudweatherreport.cloudresource import aws, azure, gce
+    if 'aws' in cloud.lower():
+        limits = {'machines': aws.INSTANCE_LIMIT, 'cpus': None}
+    elif 'google' in cloud.lower():
+        limits = {'machines': gce.INSTANCE_LIMIT, 'cpus': gce.CPU_LIMIT}
+    elif 'azure' in cloud.lower():
+        limits = {'machines': azure.INSTANCE_LIMIT, 'cpus': azure.CORE_LIMIT}
+    else:
+        limits = {'machines': None, 'cpus': None}
+    for resource, name in (('machines', 'MACHINE'), ('cpus', 'CPU')):
+        try:
+            limits[resource] = int(
+                os.getenv('{}_{}_LIMIT'.format(cloud.upper(), name)))
+        except (TypeError, ValueError):
+            pass
+    return limits
+
+
 def _aws_client(creds, region, instance_limit, security_group_limit):
+    from cloudweatherreport.cloudresource import aws
     instance_limit = instance_limit or aws.INSTANCE_LIMIT
     security_group_limit = security_group_limit or aws.SECURITY_GROUP_LIMIT
     client = aws.AWS(
@@ -69,6 +95,7 @@ def _aws_client(creds, region, instance_limit, security_group_limit):
 
 def _gce_client(creds, region, instance_limit, security_group_limit,
                 cpu_limit):
+    from cloudweatherreport.cloudresource import gce
     instance_limit = instance_limit or gce.INSTANCE_LIMIT
     security_group_limit = security_group_limit or gce.SECURITY_GROUP_LIMIT
     cpu_limit = cpu_limit or gce.CPU_LIMIT
@@ -86,6 +113,7 @@ def _gce_client(creds, region, instance_limit, security_group_limit,
 
 def _azure_client(creds, region, instance_limit, security_group_limit,
                   cpu_limit, azure_tenant_id):
+    from cloudweatherreport.cloudresource import azure
     instance_limit = instance_limit or azure.INSTANCE_LIMIT
     security_group_limit = security_group_limit or azure.SECURITY_GROUP_LIMIT
     cpu_limit = cpu_limit or azure.CORE_LIMIT
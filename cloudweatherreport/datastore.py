@@ -1,18 +1,58 @@
+import codecs
 from contextlib import contextmanager
 from ConfigParser import ConfigParser
 import datetime
+import errno
 import logging
 import os
 from mimetypes import MimeTypes
+import re
+import threading
 from time import sleep, time
 from uuid import uuid4
 
-from boto.s3.connection import S3Connection
+from cloudweatherreport import metrics
+from cloudweatherreport.utils import parallel_map
 
 
 log = logging.getLogger(__name__)
 
 
+# Cache-Control headers applied to files written to S3, as a list of
+# (pattern, header value) pairs.  Patterns are matched against the file
+# name relative to the data store prefix and the first match wins; files
+# matching no pattern are written without a Cache-Control header.  S3 sets
+# an ETag on every object, so clients can revalidate cheaply once the
+# max-age expires.
+DEFAULT_CACHE_POLICIES = [
+    # Lock files are only meaningful to the writer holding them.
+    (r'^\.lock\.', 'no-store'),
+    # The reservation ledger is always read fresh by the runners.
+    (r'^reservations\.json$', 'no-store'),
+    # So is the result cache.
+    (r'^cache/', 'no-store'),
+    # Indexes change on every result, so keep them short-lived and make
+    # clients revalidate against the ETag.
+    (r'(^|/)(full_)?index(-\d+)?\.(html|json)$',
+     'public, max-age=60, must-revalidate'),
+    # Progress files, and the list of runs in progress, are rewritten as
+    # tests start and complete.
+    (r'^running\.json$', 'public, max-age=10, must-revalidate'),
+    (r'^[^/]+/[^/]+/progress-[^/]+\.json$',
+     'public, max-age=10, must-revalidate'),
+    # Archives are appended to, and their lookups rewritten, when late
+    # reports are compacted.
+    (r'^archive/', 'public, max-age=60, must-revalidate'),
+    # Report artifacts under <bundle>/<test_id>/ are rewritten as each
+    # controller of a multi-cloud run finishes, so they must not outlive
+    # the index which links to the newer result.
+    (r'^[^/]+/[^/]+/[^/]+$', 'public, max-age=60, must-revalidate'),
+    (r'^css/', 'public, max-age=3600'),
+    # Bundle SVGs are named by the hash of the bundle, so never change.
+    (r'^svg/', 'public, max-age=31536000, immutable'),
+]
+
+
 class TimeoutError(Exception):
     pass
 
@@ -23,7 +63,8 @@ class DataStore(object):
     """
 
     @classmethod
-    def get(cls, prefix, s3_bucket=None, s3_creds_file=None, public=True):
+    def get(cls, prefix, s3_bucket=None, s3_creds_file=None, public=True,
+            cache_policies=None):
         """
         Get a LocalDataStore or S3DataStore instance depending on whether
         S3 is provided.
@@ -32,7 +73,8 @@ class DataStore(object):
             return S3DataStore(prefix,
                                s3_bucket,
                                s3_creds_file,
-                               public)
+                               public,
+                               cache_policies=cache_policies)
         else:
             return LocalDataStore(prefix)
 
@@ -50,6 +92,16 @@ class DataStore(object):
         """
         raise NotImplementedError()
 
+    def list_recursive(self, path=None):
+        """
+        List all files under a path in the data store, including those in
+        sub-directories, sorted by name.
+
+        Returns a list of (filename, size) tuples, with file names relative
+        to the data store.
+        """
+        raise NotImplementedError()
+
     def exists(self, filename):
         """
         Test if a file exists in the data store.
@@ -74,6 +126,16 @@ class DataStore(object):
         """
         raise NotImplementedError()
 
+    def delete_many(self, filenames, workers=16):
+        """
+        Delete many files from the data store.
+
+        Files which do not exist are ignored.
+        """
+        for filename in filenames:
+            if self.exists(filename):
+                self.delete(filename)
+
     @contextmanager
     def lock(self, timeout=5*60, old_lock_age=60*60):
         """
@@ -97,6 +159,8 @@ class DataStore(object):
         # Optimistically create our unique lock file.  This relies on RAW
         # consistency to ensure it will be immediately visible to others,
         # and their lock files to us.
+        requested = time()
+        acquired = None
         lock_id = self.create_lock_id()
         lock_filename = '.lock.{}'.format(lock_id)
         self.write(lock_filename, '')
@@ -120,10 +184,14 @@ class DataStore(object):
                     wait_secs += 1
                 active_lock = self._active_lock_filename()
             log.debug('Datastore lock acquired {}'.format(lock_filename))
+            acquired = time()
+            metrics.observe('cwr_lock_wait_seconds', acquired - requested)
             yield lock_id
         finally:
             log.debug('Datastore lock released {}'.format(lock_filename))
             self.delete(lock_filename)
+            if acquired is not None:
+                metrics.observe('cwr_lock_hold_seconds', time() - acquired)
 
     def create_lock_id(self):
         """Create lock id.
@@ -162,6 +230,7 @@ class LocalDataStore(DataStore):
     Data store implementation using the local (posix) filesystem.
     """
 
+    @metrics.datastore_operation('list')
     def list(self, path=None):
         """
         List contents of a path in the data store, sorted by modification
@@ -175,30 +244,61 @@ class LocalDataStore(DataStore):
             return (os.stat(self._path(path, fn)).st_mtime, fn)
         return sorted(os.listdir(basepath), key=mtime)
 
+    @metrics.datastore_operation('list')
+    def list_recursive(self, path=None):
+        """
+        List all files under a path in the data store, including those in
+        sub-directories, sorted by name.
+
+        Returns a list of (filename, size) tuples, with file names relative
+        to the data store.
+        """
+        root = self._path()
+        files = []
+        for dirpath, _, filenames in os.walk(self._path(path)):
+            for filename in filenames:
+                filename = os.path.join(dirpath, filename)
+                files.append((os.path.relpath(filename, root),
+                              os.path.getsize(filename)))
+        return sorted(files)
+
+    @metrics.datastore_operation('exists')
     def exists(self, filename):
         """
         Test if a file exists in the data store.
         """
         return os.path.exists(self._path(filename))
 
+    @metrics.datastore_operation('read')
     def read(self, filename, encoding='utf8'):
         """
         Read a file from the data store.
+
+        If encoding is None, the raw bytes are returned.
         """
-        with open(self._path(filename)) as fp:
-            return fp.read().decode(encoding)
+        with open(self._path(filename), 'rb') as fp:
+            contents = fp.read()
+        return contents.decode(encoding) if encoding else contents
 
+    @metrics.datastore_operation('write')
     def write(self, filename, contents, encoding='utf8'):
         """
         Write a file to the data store.
+
+        If encoding is None, contents are written as raw bytes.
         """
         filename = self._path(filename)
         dirname = os.path.dirname(filename)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
-        with open(filename, 'w') as fp:
-            fp.write(contents.encode(encoding))
-
+        if encoding:
+            contents = contents.encode(encoding)
+        metrics.inc('cwr_datastore_written_bytes_total', len(contents),
+                    store=type(self).__name__)
+        with open(filename, 'wb') as fp:
+            fp.write(contents)
+
+    @metrics.datastore_operation('delete')
     def delete(self, filename):
         """
         Delete a file from the data store.
@@ -206,6 +306,34 @@ class LocalDataStore(DataStore):
         filename = self._path(filename)
         os.remove(filename)
 
+    @metrics.datastore_operation('delete')
+    def delete_many(self, filenames, workers=16):
+        """
+        Delete many files from the data store, in parallel.
+
+        Files which do not exist are ignored, and directories left empty
+        are removed.
+        """
+        root = self._path()
+
+        def unlink(filename):
+            filename = self._path(filename)
+            try:
+                os.remove(filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            return os.path.dirname(filename)
+
+        dirnames = set(parallel_map(unlink, filenames, workers, 'files'))
+        # deepest first, so that emptied parents are removed too
+        for dirname in sorted(dirnames, key=len, reverse=True):
+            while dirname.startswith(root + '/'):
+                if not os.path.isdir(dirname) or os.listdir(dirname):
+                    break
+                os.rmdir(dirname)
+                dirname = os.path.dirname(dirname)
+
     def age_in_seconds(self, filename):
         return time() - os.path.getmtime(self._path(filename))
 
@@ -216,7 +344,7 @@ class S3DataStore(DataStore):
     """
 
     def __init__(self, prefix, bucket_name, creds_file, public,
-                 debug_level=logging.INFO):
+                 debug_level=logging.INFO, cache_policies=None):
         super(S3DataStore, self).__init__(prefix)
         config = ConfigParser()
         with open(creds_file) as fp:
@@ -224,19 +352,26 @@ class S3DataStore(DataStore):
         self.access_key = config.get('default', 'access_key')
         self.secret_key = config.get('default', 'secret_key')
         self.bucket_name = bucket_name
-        self._bucket = None
+        # boto connections are not thread-safe, so each thread gets its own
+        self._local = threading.local()
         self.public = public
+        if cache_policies is None:
+            cache_policies = DEFAULT_CACHE_POLICIES
+        self.cache_policies = [(re.compile(pattern), cache_control)
+                               for pattern, cache_control in cache_policies]
         self.set_logging(debug_level)
 
     @property
     def bucket(self):
-        if self._bucket is None:
+        if getattr(self._local, 'bucket', None) is None:
+            # boto is slow to import, and only needed for S3.
+            from boto.s3.connection import S3Connection
             conn = S3Connection(self.access_key, self.secret_key)
             if conn.lookup(self.bucket_name):
-                self._bucket = conn.get_bucket(self.bucket_name)
+                self._local.bucket = conn.get_bucket(self.bucket_name)
             else:
-                self._bucket = conn.create_bucket(self.bucket_name)
-        return self._bucket
+                self._local.bucket = conn.create_bucket(self.bucket_name)
+        return self._local.bucket
 
     @staticmethod
     def set_logging(level):
@@ -244,6 +379,7 @@ class S3DataStore(DataStore):
         logger.propagate = False
         logger.setLevel(level)
 
+    @metrics.datastore_operation('list')
     def list(self, path=None):
         """
         List contents of a path in the data store, sorted by modification
@@ -258,6 +394,21 @@ class S3DataStore(DataStore):
         files = [k for k in paths if hasattr(k, 'last_modified')]
         return [key.name.split('/')[-1] for key in sorted(files, key=mtime)]
 
+    @metrics.datastore_operation('list')
+    def list_recursive(self, path=None):
+        """
+        List all files under a path in the data store, including those in
+        sub-directories, sorted by name.
+
+        Returns a list of (filename, size) tuples, with file names relative
+        to the data store.
+        """
+        root = self._path().rstrip('/') + '/'
+        basepath = self._path(path).rstrip('/') + '/'
+        return sorted((key.name[len(root):], key.size)
+                      for key in self.bucket.list(basepath))
+
+    @metrics.datastore_operation('exists')
     def exists(self, filename):
         """
         Test if a file exists in the data store.
@@ -265,28 +416,54 @@ class S3DataStore(DataStore):
         filename = self._path(filename)
         return self.bucket.get_key(filename) is not None
 
+    @metrics.datastore_operation('read')
     def read(self, filename, encoding='utf-8'):
         """
         Read a file from the data store.
+
+        If encoding is None, the raw bytes are returned.
         """
         key = self.bucket.get_key(self._path(filename))
         return key.get_contents_as_string(encoding=encoding)
 
+    def cache_control(self, filename):
+        """
+        Cache-Control header value for a file, or None if no policy applies.
+        """
+        for pattern, cache_control in self.cache_policies:
+            if pattern.search(filename):
+                return cache_control
+        return None
+
+    @metrics.datastore_operation('write')
     def write(self, filename, contents, encoding='utf8'):
         """
         Write a file to the data store.
+
+        If encoding is None, contents are written as raw bytes.
         """
         mime = MimeTypes()
         mime.add_type('text/x-yaml', '.yaml')
         content_type, _ = mime.guess_type(filename)
+        if encoding:
+            # The codec's canonical name, e.g., utf-8 for utf8.
+            content_type = '{}; charset={}'.format(
+                content_type or 'text/plain', codecs.lookup(encoding).name)
+            contents = contents.encode(encoding)
+        headers = {
+            'Content-Type': content_type or 'application/octet-stream',
+        }
+        cache_control = self.cache_control(filename)
+        if cache_control:
+            headers['Cache-Control'] = cache_control
+        metrics.inc('cwr_datastore_written_bytes_total', len(contents),
+                    store=type(self).__name__)
         key = self.bucket.new_key(self._path(filename))
-        key.set_contents_from_string(contents.encode(encoding), {
-            'Content-Type': content_type or 'text/plain',
-            'Content-Encoding': encoding,
-        })
+        key.set_contents_from_string(contents, headers)
         if self.public:
             key.set_canned_acl('public-read')
 
+    @metrics.datastore_operation('delete')
     def delete(self, filename):
         """
         Delete a file from the data store.
@@ -294,6 +471,27 @@ class S3DataStore(DataStore):
         if self.exists(filename):
             self.bucket.delete_key(self._path(filename))
 
+    @metrics.datastore_operation('delete')
+    def delete_many(self, filenames, workers=16):
+        """
+        Delete many files from the data store.
+
+        Uses S3 multi-object delete, with up to 1000 keys per request and
+        the requests made in parallel.  Files which do not exist are
+        ignored.
+        """
+        keys = [self._path(filename) for filename in filenames]
+        chunks = [keys[i:i + 1000] for i in range(0, len(keys), 1000)]
+
+        def delete_keys(chunk):
+            result = self.bucket.delete_keys(chunk, quiet=True)
+            for error in result.errors:
+                log.error('Unable to delete {}: {}'.format(
+                    error.key, error.message))
+            return len(chunk)
+
+        parallel_map(delete_keys, chunks, workers, 'delete requests')
+
     def age_in_seconds(self, filename):
         key = self.bucket.get_key(self._path(filename))
         # Date format return from boto: Tue, 28 Mar 2017 13:30:37 GMT
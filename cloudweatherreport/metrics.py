@@ -0,0 +1,218 @@
+"""
+Operational metrics, exported for the Prometheus textfile collector.
+
+Metrics are always counted in a per-process registry.  When --metrics-file
+is given, the job and publisher processes save their counts into a spool
+directory when they exit, and at the end of the invocation the main process
+merges them with its own and writes the file in the Prometheus text format,
+for node_exporter's textfile collector to pick up.  The file is replaced
+atomically, so the collector never sees a partial write.
+
+Durations are exported as summaries, as <name>_sum and <name>_count.
+"""
+from contextlib import contextmanager
+from functools import wraps
+import json
+import logging
+import os
+from shutil import rmtree
+import tempfile
+import threading
+from time import time
+
+
+HELP = {
+    'cwr_datastore_operations_seconds':
+        'Time spent in data store operations.',
+    'cwr_datastore_written_bytes_total': 'Bytes written to the data store.',
+    'cwr_lock_wait_seconds': 'Time spent waiting for the data store lock.',
+    'cwr_lock_hold_seconds': 'Time the data store lock was held.',
+    'cwr_runs_total': 'Test plan runs, by provider and outcome.',
+    'cwr_phase_seconds': 'Time spent in each phase of running and '
+                         'publishing.',
+    'cwr_action_polls_total': 'Requests made to poll Juju actions.',
+    'cwr_last_run_timestamp_seconds': 'When cwr last finished.',
+}
+
+
+class Registry(object):
+    """
+    Counters, keyed by metric name and labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.values = {}
+        self.types = {}
+
+    def inc(self, name, value=1, type_='counter', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+            self.types.setdefault(name, type_)
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.values[key] = value
+            self.types[name] = 'gauge'
+
+    def observe(self, name, seconds, **labels):
+        self.inc(name + '_sum', seconds, type_='summary', **labels)
+        self.inc(name + '_count', 1, type_='summary', **labels)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'types': dict(self.types),
+                'values': [[name, dict(labels), value]
+                           for (name, labels), value in self.values.items()],
+            }
+
+    def merge(self, data):
+        for name, labels, value in data['values']:
+            self.inc(name, value, type_=data['types'].get(name, 'counter'),
+                     **labels)
+
+    def as_text(self):
+        """
+        Format the metrics in the Prometheus text exposition format.
+        """
+        families = {}
+        for (name, labels), value in self.values.items():
+            family = name
+            if self.types.get(name) == 'summary':
+                family = name.rsplit('_', 1)[0]
+            families.setdefault(family, []).append((name, labels, value))
+        lines = []
+        for family in sorted(families):
+            if family in HELP:
+                lines.append('# HELP {} {}'.format(family, HELP[family]))
+            type_ = self.types.get(family) or self.types.get(
+                family + '_sum', 'counter')
+            lines.append('# TYPE {} {}'.format(family, type_))
+            for name, labels, value in sorted(families[family]):
+                label_text = ','.join(
+                    '{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                     .replace('"', '\\"'))
+                    for k, v in labels)
+                lines.append('{}{} {}'.format(
+                    name, '{' + label_text + '}' if labels else '',
+                    repr(float(value)) if isinstance(value, float)
+                    else value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+# Directory the metrics of child processes are saved into, if exporting.
+_spool_dir = None
+# Data store operations in progress in each thread.
+_operations = threading.local()
+
+
+def inc(name, value=1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    REGISTRY.observe(name, seconds, **labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time()
+    try:
+        yield
+    finally:
+        observe(name, time() - start, **labels)
+
+
+def datastore_operation(operation):
+    """
+    Decorator counting and timing a data store method.
+
+    Only the outermost operation is counted when one operation calls
+    another, e.g., when a delete checks that the file exists.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            depth = getattr(_operations, 'depth', 0)
+            if depth:
+                return func(self, *args, **kwargs)
+            _operations.depth = depth + 1
+            try:
+                with timer('cwr_datastore_operations_seconds',
+                           store=type(self).__name__, operation=operation):
+                    return func(self, *args, **kwargs)
+            finally:
+                _operations.depth = depth
+        return wrapper
+    return decorator
+
+
+def start_export():
+    """
+    Collect the metrics of child processes for export.
+    """
+    global _spool_dir
+    _spool_dir = tempfile.mkdtemp(prefix='cwr-metrics-')
+    return _spool_dir
+
+
+def stop_export():
+    """
+    Remove the metrics saved by child processes.
+    """
+    global _spool_dir
+    if _spool_dir is not None:
+        rmtree(_spool_dir, ignore_errors=True)
+        _spool_dir = None
+
+
+@contextmanager
+def child_process():
+    """
+    Count the metrics of a child process, which has forked a copy of its
+    parent's, separately and save them when it exits.
+    """
+    REGISTRY.clear()
+    try:
+        yield
+    finally:
+        save_child_metrics()
+
+
+def save_child_metrics():
+    if _spool_dir is None:
+        return
+    filename = os.path.join(_spool_dir, '{}.json'.format(os.getpid()))
+    try:
+        with open(filename + '.tmp', 'w') as fp:
+            json.dump(REGISTRY.as_dict(), fp)
+        os.rename(filename + '.tmp', filename)
+    except (IOError, OSError) as e:
+        logging.error('Unable to save metrics: {}'.format(e))
+
+
+def write_textfile(filename):
+    """
+    Write the metrics of this process and its children to a file.
+    """
+    registry = Registry()
+    registry.merge(REGISTRY.as_dict())
+    if _spool_dir is not None:
+        for part in sorted(os.listdir(_spool_dir)):
+            if not part.endswith('.json'):
+                continue
+            with open(os.path.join(_spool_dir, part)) as fp:
+                registry.merge(json.load(fp))
+    registry.set('cwr_last_run_timestamp_seconds', round(time(), 3))
+    tmp_filename = filename + '.{}.tmp'.format(os.getpid())
+    with open(tmp_filename, 'w') as fp:
+        fp.write(registry.as_text())
+    os.rename(tmp_filename, filename)
+    return registry
@@ -4,10 +4,8 @@ import json
 import yaml
 import logging
 from datetime import datetime
-from base64 import b64encode
 
 from pkg_resources import resource_filename
-import jinja2
 
 from cloudweatherreport import utils
 
@@ -29,6 +27,30 @@ TestOutcomes = namedtuple('TestOutcome', 'passed fail infra none')
 TEST_OUTCOMES = TestOutcomes(
     passed='PASS', fail='FAIL', infra='INFRA', none='NONE')
 
+# Benchmark param marking a benchmark which must not run at the same time as
+# any other benchmark.
+ISOLATED_PARAM = 'cwr-isolated'
+
+
+_template_env = None
+
+
+def get_template(name):
+    """
+    Load one of the report page templates.
+
+    jinja2 is only imported, and the templates compiled, when a page is
+    first rendered, so commands which don't render pages don't pay for it.
+    """
+    global _template_env
+    if _template_env is None:
+        import jinja2
+        templates = resource_filename(__name__, 'templates')
+        _template_env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(templates))
+        _template_env.filters['humanize_date'] = utils.humanize_date
+    return _template_env.get_template(name)
+
 
 # ******** Base types
 
@@ -279,6 +301,7 @@ class BenchmarkPlan(BaseModel):
         'unit': basestring,
         'action': basestring,
         'params': dict,
+        'isolated': bool,
     }
 
 
@@ -332,11 +355,18 @@ class TestPlan(BaseModel):
                 if isinstance(action_info, basestring):
                     action_info = {action_info: {}}
                 for action, params in action_info.items():
-                    plan.benchmarks.append(BenchmarkPlan(
+                    benchmark = BenchmarkPlan(
                         unit=unit,
                         action=action,
                         params=params,
-                    ))
+                    )
+                    if isinstance(params, dict) and \
+                            ISOLATED_PARAM in params:
+                        # Not an action param, so don't pass it on.
+                        benchmark.params = dict(params)
+                        benchmark.isolated = bool(
+                            benchmark.params.pop(ISOLATED_PARAM))
+                    plan.benchmarks.append(benchmark)
         return plan
 
     def report_filename(self, test_id):
@@ -475,11 +505,16 @@ class Benchmark(BaseModel):
             self.results.append(result)
             return result
 
-    def as_chart(self):
+    def as_chart(self, max_points=None):
         """
         Serialize this Benchmark to chart data as a Python dict.
 
         The result is used to render a graph using Chart.js.
+
+        If `max_points` is given, each provider's series is downsampled to
+        that many points using Largest-Triangle-Three-Buckets.  The points
+        kept for any provider are kept for all of them, and the chart is
+        flagged as `downsampled` if any points were left out.
         """
         data = {
             'title': self.name,
@@ -511,15 +546,25 @@ class Benchmark(BaseModel):
             data['datasets'].append(dataset)
         data['min'] = min
         data['max'] = max
+        if max_points and len(self.results) > max_points:
+            keep = set()
+            for dataset in data['datasets']:
+                keep.update(utils.lttb(dataset['data'], max_points))
+            keep = sorted(keep)
+            data['labels'] = [data['labels'][i] for i in keep]
+            for dataset in data['datasets']:
+                dataset['data'] = [dataset['data'][i] for i in keep]
+            if len(keep) < len(self.results):
+                data['downsampled'] = True
         return data
 
-    def as_chart_json(self):
+    def as_chart_json(self, max_points=None):
         """
         Serialize this Benchmark to chart data as a JSON string.
 
         The result is used to render a graph using Chart.js.
         """
-        return json.dumps(self.as_chart(),
+        return json.dumps(self.as_chart(max_points),
                           sort_keys=True,
                           encoding='utf8',
                           indent=2,
@@ -542,6 +587,9 @@ class SuiteResult(BaseModel):
         'test_outcome': basestring,
         'tests': list([TestResult]),
         'bundle_yaml': basestring,
+        'queue_wait': float,  # seconds spent waiting for cloud capacity
+        'cached_from': basestring,  # test_id of a cached result's run
+        'timings': dict,  # seconds spent in each phase of the run
     }
 
     @classmethod
@@ -609,12 +657,20 @@ class Report(BaseModel):
         'results': list([SuiteResult]),
         'bundle': BundleInfo,
         'benchmarks': list([Benchmark]),
+        'timings': dict,  # seconds spent publishing the latest result
     }
 
     @property
     def providers(self):
         return sorted([r.provider for r in self.results])
 
+    def total_timings(self):
+        """
+        Total seconds spent in the timed phases of each provider's run.
+        """
+        return {result.provider: round(sum(result.timings.values()), 1)
+                for result in self.results if result.timings}
+
     def provider_result(self, provider, create=False):
         """
         Find a SuiteResult for the named provider,
@@ -640,20 +696,33 @@ class Report(BaseModel):
             self.benchmarks.append(benchmark)
             return benchmark
 
-    def as_html(self, svg_data):
+    def as_html(self, svg_url=None, chart_points=None):
         """
         Serialize this report instance to an HTML page.
-        """
-        templates = resource_filename(__name__, 'templates')
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates))
-        env.filters['humanize_date'] = utils.humanize_date
-        env.filters['base64'] = b64encode
 
-        template = env.get_template('bundle.html')
-        html = template.render(report=self, svg_data=svg_data,
+        The bundle diagram is referenced from `svg_url`, relative to the
+        root of the data store, so that it is shared by every report of the
+        same bundle.  Benchmark charts are downsampled to `chart_points`
+        points per provider, with the full series available from
+        `benchmarks_json`.
+        """
+        template = get_template('bundle.html')
+        html = template.render(report=self, svg_url=svg_url,
+                               chart_points=chart_points,
                                base_url='../../')
         return html
 
+    def benchmarks_json(self):
+        """
+        Serialize the full resolution chart data of all benchmarks to JSON.
+        """
+        return json.dumps([benchmark.as_chart()
+                           for benchmark in self.benchmarks],
+                          sort_keys=True,
+                          encoding='utf8',
+                          indent=2,
+                          default=utils.serializer)
+
     def as_xml(self):
         """
         Serialize this report instance to an XML file.
@@ -686,11 +755,11 @@ class Report(BaseModel):
         pretty_xml_as_string = xmlparsed.toprettyxml()
         return pretty_xml_as_string
 
-    def _filename(self):
+    def _filename(self, name='report'):
         return '/'.join([
             re.sub(r'[^a-zA-Z0-9]', '_', self.bundle.name),
             self.test_id,
-            'report',
+            name,
         ])
 
     @property
@@ -705,6 +774,10 @@ class Report(BaseModel):
     def filename_xml(self):
         return self._filename() + '.xml'
 
+    @property
+    def filename_benchmarks_json(self):
+        return self._filename('benchmarks') + '.json'
+
     def upsert_result(self, result):
         """
         Add or replace a SuiteResult.
@@ -763,6 +836,9 @@ class ReportIndexItem(BaseModel):
         'results': dict,  # e.g., {'aws': 'PASS'}
         'url': basestring,
         'test_label': basestring,
+        'archive': basestring,  # set once compacted into an archive
+        'timings': dict,  # e.g., {'aws': 1234.5}, total seconds of the run
+        'publish_timings': dict,  # the report's timings, e.g., {'load': 0.5}
     }
 
     @classmethod
@@ -775,6 +851,8 @@ class ReportIndexItem(BaseModel):
                 result.provider: result.test_outcome
                 for result in report.results
             },
+            timings=report.total_timings(),
+            publish_timings=dict(report.timings or {}),
         )
 
     def __eq__(self, other):
@@ -789,9 +867,19 @@ class ReportIndexItem(BaseModel):
             result.provider: result.test_outcome
             for result in report.results
         })
+        self.timings = self.timings or {}
+        self.timings.update(report.total_timings())
+        self.publish_timings = dict(report.timings or {})
+        # the updated report has been written out again as loose files
+        self.archive = None
 
     @property
     def filename_html(self):
+        if self.archive:
+            # Archived reports are shown by the archive viewer, which finds
+            # the report in archive/<bundle>/<month>.gz
+            archive = re.sub(r'^archive/|\.gz$', '', self.archive)
+            return 'archive.html#{}/{}'.format(archive, self.test_id)
         return Report(
             test_id=self.test_id,
             bundle=BundleInfo(name=self.bundle_name),
@@ -815,6 +903,28 @@ class ReportIndex(BaseModel):
     summary_filename_html = 'index.html'
     summary_filename_json = 'index.json'
 
+    @classmethod
+    def from_reports(cls, reports):
+        """
+        Build an index from a list of reports, most recent first.
+
+        If more than one report has the same bundle name and test ID, only
+        the first one is indexed.
+        """
+        index = cls()
+        seen = set()
+        providers = set()
+        for report in sorted(reports, key=lambda r: r.date or datetime.min,
+                             reverse=True):
+            key = (report.bundle.name, report.test_id)
+            if key in seen:
+                continue
+            seen.add(key)
+            index.reports.append(ReportIndexItem.from_report(report))
+            providers.update(report.providers)
+        index.providers = sorted(providers)
+        return index
+
     def remove_by_bundle_name(self, name, dry_run=False):
         reports = [r for r in self.reports if r.bundle_name == name]
         if not dry_run:
@@ -822,6 +932,16 @@ class ReportIndex(BaseModel):
                 self.reports.remove(report)
         return reports
 
+    def remove_older_than(self, date, dry_run=False):
+        """
+        Remove the reports which were created before the given date.
+        """
+        reports = [r for r in self.reports if r.date and r.date < date]
+        if not dry_run:
+            for report in reports:
+                self.reports.remove(report)
+        return reports
+
     def upsert_report(self, report):
         """
         Add or update a single report.
@@ -854,43 +974,103 @@ class ReportIndex(BaseModel):
         """
         return set(report.bundle_name for report in self.reports)
 
-    def as_json(self, bundle_name=None, limit=None):
+    def bundle_reports(self, bundle_name):
         """
-        Serialize this index to JSON.
+        Return the reports for a given bundle, most recent first.
+        """
+        return [r for r in self.reports if r.bundle_name == bundle_name]
+
+    def bundle_page_count(self, bundle_name, page_size):
+        """
+        Return the number of full pages of older results for a bundle.
 
-        Optionally, only serialize reports for a given bundle.
+        Pages are numbered from the oldest result, starting at 1, so that
+        the contents of a page never change once it is full.  The most
+        recent results are listed on the bundle's main index instead.
         """
+        if not page_size:
+            return 0
+        return len(self.bundle_reports(bundle_name)) // page_size
+
+    def bundle_page(self, bundle_name, page, page_size):
+        """
+        Return the reports on a full page of older results for a bundle,
+        most recent first.
+        """
+        reports = self.bundle_reports(bundle_name)
+        end = len(reports) - (page - 1) * page_size
+        return reports[max(end - page_size, 0):end]
+
+    def bundle_report_page(self, report, page_size):
+        """
+        Return the number of the full page listing the given report, or
+        None if it is only listed on the bundle's main index.
+        """
+        reports = self.bundle_reports(report.bundle.name)
+        for i, index_item in enumerate(reports):
+            if index_item == report:
+                page = (len(reports) - 1 - i) // page_size + 1
+                if page <= self.bundle_page_count(report.bundle.name,
+                                                  page_size):
+                    return page
+        return None
+
+    def _bundle_selection(self, bundle_name, limit, page):
         reports = self.reports
+        pages = []
         if bundle_name:
-            reports = filter(lambda r: r.bundle_name == bundle_name, reports)
+            if page:
+                reports = self.bundle_page(bundle_name, page, limit)
+            else:
+                reports = self.bundle_reports(bundle_name)
+            pages = list(reversed(range(
+                1, self.bundle_page_count(bundle_name, limit) + 1)))
         if limit:
             reports = reports[:limit]
+        return reports, pages
+
+    def as_json(self, bundle_name=None, limit=None, page=None):
+        """
+        Serialize this index to JSON.
+
+        Optionally, only serialize reports for a given bundle, limited to
+        the `limit` most recent or to a full page of older results.  Pages
+        of a bundle index list the numbers of the older pages.
+        """
+        reports, pages = self._bundle_selection(bundle_name, limit, page)
         temp_index = ReportIndex(
             providers=self.providers,
             reports=reports,
         )
-        return super(ReportIndex, temp_index).as_json()
+        if not pages:
+            return super(ReportIndex, temp_index).as_json()
+        data = temp_index.as_dict()
+        data['pages'] = pages
+        return json.dumps(data,
+                          sort_keys=True,
+                          encoding='utf8',
+                          indent=2,
+                          default=utils.serializer)
 
-    def as_html(self, bundle_name=None, limit=None):
+    def as_html(self, bundle_name=None, limit=None, page=None):
         """
         Serialize this index to an HTML page.
 
-        Optionally, only serialize reports for a given bundle.
+        Optionally, only serialize reports for a given bundle, limited to
+        the `limit` most recent or to a full page of older results.
         """
-        templates = resource_filename(__name__, 'templates')
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates))
-        env.filters['humanize_date'] = utils.humanize_date
-        reports = self.reports
-        if bundle_name:
-            reports = filter(lambda r: r.bundle_name == bundle_name, reports)
-        if limit:
-            reports = reports[:limit]
+        reports, pages = self._bundle_selection(bundle_name, limit, page)
 
-        template = env.get_template('index.html')
+        template = get_template('index.html')
         html = template.render(
             bundle_name=bundle_name,
             reports=reports,
             providers=self.providers,
+            page=page,
+            pages=[(p, self.bundle_index_html(bundle_name, p))
+                   for p in pages],
+            latest_filename=(self.bundle_index_html(bundle_name)
+                             if bundle_name else None),
             base_url='../' if bundle_name else '',
         )
         return html
@@ -929,10 +1109,7 @@ class ReportIndex(BaseModel):
         Serialize this index to an HTML summary of all the bundles
         contained in the report.
         """
-        templates = resource_filename(__name__, 'templates')
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates))
-        env.filters['humanize_date'] = utils.humanize_date
-        template = env.get_template('bundles.html')
+        template = get_template('bundles.html')
 
         html = template.render(
             bundles=self._summary_data(),
@@ -940,13 +1117,14 @@ class ReportIndex(BaseModel):
         )
         return html
 
-    def _bundle_index_filename(self, bundle_name, ext):
+    def _bundle_index_filename(self, bundle_name, ext, page=None):
+        filename = 'index-%d.%s' % (page, ext) if page else 'index.%s' % ext
         return '/'.join([
             re.sub(r'[^a-zA-Z0-9]', '_', bundle_name),
-            'index.%s' % ext])
+            filename])
 
-    def bundle_index_html(self, bundle_name):
-        return self._bundle_index_filename(bundle_name, 'html')
+    def bundle_index_html(self, bundle_name, page=None):
+        return self._bundle_index_filename(bundle_name, 'html', page)
 
-    def bundle_index_json(self, bundle_name):
-        return self._bundle_index_filename(bundle_name, 'json')
+    def bundle_index_json(self, bundle_name, page=None):
+        return self._bundle_index_filename(bundle_name, 'json', page)
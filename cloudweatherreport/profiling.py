@@ -0,0 +1,196 @@
+"""
+Profiling of job and publisher processes.
+
+With --profile, each job and publisher process is profiled with
+cProfile and, at the same time, sampled every SAMPLE_INTERVAL seconds of CPU
+time.  Profiles are written into <results_dir>/profile/:
+
+  <name>-<pid>.pstats     cProfile statistics, for pstats or snakeviz
+  <name>-<pid>.collapsed  sampled stacks in the collapsed format read by
+                          flamegraph.pl and speedscope
+
+Only one profiler can be active in a thread, so a profiled block inside
+another one is covered by the outer profile.  Profiles of a process are
+accumulated and rewritten each time a profiled block exits.
+
+With --trace-malloc, the top allocations made while publishing results are
+appended to <results_dir>/profile/publish-<pid>.malloc.txt.  Where the
+tracemalloc module is missing, as on Python 2, the types whose number of
+live objects grew the most are listed instead.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import gc
+import logging
+import os
+import signal
+import threading
+
+from cloudweatherreport.utils import mkdir_p
+
+
+PROFILE_DIR = 'profile'
+# Seconds of CPU time between two stack samples.
+SAMPLE_INTERVAL = 0.005
+# Number of allocation sites listed by --trace-malloc.
+MALLOC_TOP = 25
+
+_profiles = {}
+_active = []
+
+
+def profile_filename(results_dir, name, extension):
+    return os.path.join(results_dir, PROFILE_DIR, '{}-{}.{}'.format(
+        name, os.getpid(), extension))
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{}:{}:{}'.format(os.path.basename(code.co_filename),
+                             code.co_name, code.co_firstlineno)
+
+
+class StackSampler(object):
+    """
+    Count the stacks of the main thread every `interval` seconds of CPU
+    time, using the SIGPROF timer.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+
+    @staticmethod
+    def available():
+        return (hasattr(signal, 'setitimer') and
+                isinstance(threading.current_thread(), threading._MainThread))
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        # Restart system calls interrupted by a sample instead of failing
+        # them with EINTR.
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in sorted(self.stacks.items()))
+
+
+@contextmanager
+def profiled(args, name):
+    """
+    Profile the block if --profile is set.
+    """
+    if not getattr(args, 'profile', False) or _active:
+        yield
+        return
+    key = (name, os.getpid())
+    if key not in _profiles:
+        sampler = StackSampler() if StackSampler.available() else None
+        _profiles[key] = (cProfile.Profile(), sampler)
+    profile, sampler = _profiles[key]
+    _active.append(name)
+    if sampler:
+        sampler.start()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        if sampler:
+            sampler.stop()
+        _active.pop()
+        write_profile(args.results_dir, name, profile, sampler)
+
+
+def write_profile(results_dir, name, profile, sampler=None):
+    try:
+        mkdir_p(os.path.join(results_dir, PROFILE_DIR))
+        filename = profile_filename(results_dir, name, 'pstats')
+        profile.dump_stats(filename)
+        if sampler:
+            with open(profile_filename(
+                    results_dir, name, 'collapsed'), 'w') as fp:
+                fp.write(sampler.collapsed())
+    except (IOError, OSError) as e:
+        logging.error('Unable to write the {} profile: {}'.format(name, e))
+        return None
+    logging.info('Wrote profile {}'.format(filename))
+    return filename
+
+
+def count_objects():
+    """
+    Count the live objects tracked by the garbage collector, by type.
+    """
+    gc.collect()
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def object_growth(before, after, top=MALLOC_TOP):
+    """
+    List the types whose number of objects grew the most.
+    """
+    growth = Counter(after)
+    growth.subtract(before)
+    return ['{}: {} (+{})'.format(name, after[name], count)
+            for name, count in growth.most_common(top) if count > 0]
+
+
+@contextmanager
+def traced_malloc(args, name, top=MALLOC_TOP):
+    """
+    Record the top allocations made in the block if --trace-malloc is set.
+    """
+    if not getattr(args, 'trace_malloc', False):
+        yield
+        return
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc is None:
+        before = count_objects()
+        try:
+            yield
+        finally:
+            write_malloc(args.results_dir, name,
+                         object_growth(before, count_objects(), top))
+        return
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    try:
+        yield
+    finally:
+        after = tracemalloc.take_snapshot()
+        if started:
+            tracemalloc.stop()
+        write_malloc(args.results_dir, name,
+                     after.compare_to(before, 'lineno')[:top])
+
+
+def write_malloc(results_dir, name, stats):
+    try:
+        mkdir_p(os.path.join(results_dir, PROFILE_DIR))
+        with open(profile_filename(results_dir, name, 'malloc.txt'),
+                  'a') as fp:
+            fp.write(''.join('{}\n'.format(stat) for stat in stats))
+            fp.write('\n')
+    except (IOError, OSError) as e:
+        logging.error('Unable to write the {} allocations: {}'.format(
+            name, e))
@@ -0,0 +1,213 @@
+"""
+Live progress of running tests.
+
+A report is only written once bundletester has finished, which for a big
+bundle can take hours.  To show what a run is doing before then, bundletester
+is given a streaming reporter which hands each test result to a Progress as
+soon as the test completes.  The Progress collects them into a partial suite
+result and publishes it, at most every PROGRESS_INTERVAL seconds, as a small
+JSON file next to the report, <bundle>/<test_id>/progress-<provider>.json.
+
+Progress files are written directly, without taking the data store lock or
+touching the index, since each one only has a single writer: the runner
+testing that provider.  Once the tests are done the progress is finalized
+with the outcome of the run.
+
+So that runs in progress can be found before they have a report, each one
+is also listed in running.json at the root of the data store from the time
+its tests start until they finish.  That list is shared by all runners, so
+it must only be read and written while holding the data store lock, which
+is only held for the small read-modify-write, without regenerating any
+index.  Entries of runners which died without removing them expire after a
+while.
+"""
+from datetime import datetime
+import json
+import logging
+import posixpath
+import re
+from time import time
+
+from cloudweatherreport import model
+
+
+REPORTER_NAME = 'cwr-progress'
+# Minimum number of seconds between two updates of a progress file.
+PROGRESS_INTERVAL = 30
+
+RUNNING = 'RUNNING'
+FINISHED = 'FINISHED'
+
+RUNNING_FILENAME = 'running.json'
+# Entries of running.json older than this are assumed to have been left
+# behind.
+RUNNING_TTL = 24 * 60 * 60
+
+
+def progress_filename(report_filename, provider):
+    """
+    Name of the progress file of a provider, next to its report.
+    """
+    provider = re.sub(r'[^A-Za-z0-9_.-]', '_', provider or 'unknown')
+    return posixpath.join(posixpath.dirname(report_filename),
+                          'progress-{}.json'.format(provider))
+
+
+def read_running(datastore, now=None):
+    """
+    Read the live entries of running.json, as a dict of progress file names
+    to runs.
+    """
+    if not datastore.exists(RUNNING_FILENAME):
+        return {}
+    try:
+        running = json.loads(datastore.read(RUNNING_FILENAME))
+    except ValueError:
+        logging.error('Ignoring invalid {}'.format(RUNNING_FILENAME))
+        return {}
+    now = time() if now is None else now
+    return {filename: run for filename, run in running.items()
+            if run.get('expires', 0) > now}
+
+
+def write_running(datastore, running):
+    datastore.write(RUNNING_FILENAME,
+                    json.dumps(running, sort_keys=True, indent=2))
+
+
+def register_reporter():
+    """
+    Make the streaming reporter available to bundletester.
+
+    The reporter is a bundletester JSON reporter which also passes each
+    result to the `on_test_result` callable of the bundletester options.
+    Before anything is deployed, it passes the status bundletester will
+    return, with the bundle YAML, to the `on_suite` callable, which can
+    raise to stop the run.
+    """
+    from bundletester import (
+        reporter,
+        tester,
+    )
+    if REPORTER_NAME in reporter.FACTORY:
+        return REPORTER_NAME
+
+    class StreamingReporter(reporter.JSONReporter):
+        def set_suite(self, suite):
+            super(StreamingReporter, self).set_suite(suite)
+            on_suite = getattr(self.options, 'on_suite', None)
+            if on_suite is not None:
+                on_suite(tester.get_return_data(None, suite))
+
+        def emit(self, msg):
+            super(StreamingReporter, self).emit(msg)
+            on_test_result = getattr(self.options, 'on_test_result', None)
+            if on_test_result is None:
+                return
+            try:
+                on_test_result(dict(msg))
+            except Exception:
+                # Progress is informational, never fail the tests for it.
+                logging.exception('Unable to record test progress')
+
+    reporter.FACTORY[REPORTER_NAME] = StreamingReporter
+    return REPORTER_NAME
+
+
+class Progress(object):
+    """
+    Partial result of a test run, published as the tests complete.
+    """
+
+    def __init__(self, datastore, filename, test_id, bundle, provider,
+                 interval=PROGRESS_INTERVAL):
+        self.datastore = datastore
+        self.filename = filename
+        self.test_id = test_id
+        self.bundle = bundle
+        self.provider = provider
+        self.interval = interval
+        self.messages = []
+        self.started = datetime.now()
+        self.published = None
+
+    def start(self):
+        self.publish(RUNNING)
+        self.update_running(True)
+
+    def add(self, message):
+        """
+        Record the bundletester message of a completed test.
+        """
+        self.messages.append(message)
+        if self.published is None or \
+                time() - self.published >= self.interval:
+            self.publish(RUNNING)
+
+    def finish(self, test_outcome=None):
+        """
+        Publish the final state of the run.
+        """
+        self.publish(FINISHED, test_outcome)
+        self.update_running(False)
+
+    def result(self):
+        """
+        The partial SuiteResult of the tests completed so far.
+        """
+        return model.SuiteResult.from_bundletester_output(
+            self.provider, json.dumps({'tests': self.messages}))
+
+    def as_dict(self, status, test_outcome=None):
+        result = self.result()
+        return {
+            'test_id': self.test_id,
+            'bundle': self.bundle,
+            'provider': self.provider,
+            'status': status,
+            'started': self.started.isoformat(),
+            'updated': datetime.now().isoformat(),
+            # Test outputs can be large and are left for the final report.
+            'tests': [{'name': test.name,
+                       'suite': test.suite,
+                       'result': test.result,
+                       'duration': test.duration}
+                      for test in result.tests],
+            'test_outcome': test_outcome or result.test_outcome,
+        }
+
+    def publish(self, status, test_outcome=None):
+        self.published = time()
+        try:
+            self.datastore.write(self.filename, json.dumps(
+                self.as_dict(status, test_outcome), sort_keys=True,
+                indent=2))
+        except Exception:
+            logging.exception('Unable to write {}'.format(self.filename))
+            return False
+        return True
+
+    def update_running(self, running, ttl=RUNNING_TTL):
+        """
+        Add this run to running.json, or remove it once finished.
+        """
+        try:
+            with self.datastore.lock():
+                now = time()
+                runs = read_running(self.datastore, now)
+                if running:
+                    runs[self.filename] = {
+                        'test_id': self.test_id,
+                        'bundle': self.bundle,
+                        'provider': self.provider,
+                        'progress': self.filename,
+                        'started': self.started.isoformat(),
+                        'expires': now + ttl,
+                    }
+                elif runs.pop(self.filename, None) is None:
+                    return True
+                write_running(self.datastore, runs)
+        except Exception:
+            logging.exception('Unable to update {}'.format(RUNNING_FILENAME))
+            return False
+        return True
@@ -0,0 +1,97 @@
+"""
+Ledger of cloud resources reserved by running test plans.
+
+The cloud resource check only sees the machines which already exist, so
+several runners checking the same cloud and region at once could all see
+the same free capacity and then run out of quota part way through their
+deployments.  To prevent that, a runner reserves the machines and CPUs of
+its plan's cloud_resource in a ledger, reservations.json in the results
+data store, before deploying, and releases them once the plan has finished.
+Reservations are counted by the resource check along with the machines
+already running.
+
+The ledger must only be read and written while holding the data store lock.
+Reservations of runners which died without releasing them expire after a
+while.
+"""
+import json
+import logging
+import os
+import socket
+from time import time
+
+
+LEDGER_FILENAME = 'reservations.json'
+# Reservations older than this are assumed to have been left behind.
+RESERVATION_TTL = 6 * 60 * 60
+
+
+def read_ledger(datastore, now=None):
+    """
+    Read the live reservations, as a dict of reservation ids to
+    reservations.
+    """
+    if not datastore.exists(LEDGER_FILENAME):
+        return {}
+    try:
+        ledger = json.loads(datastore.read(LEDGER_FILENAME))
+    except ValueError:
+        logging.error('Ignoring invalid reservation ledger')
+        return {}
+    now = time() if now is None else now
+    return {reservation_id: reservation
+            for reservation_id, reservation in ledger.items()
+            if reservation.get('expires', 0) > now}
+
+
+def write_ledger(datastore, ledger):
+    datastore.write(LEDGER_FILENAME,
+                    json.dumps(ledger, sort_keys=True, indent=2))
+
+
+def reserved(ledger, cloud, region):
+    """
+    Total machines and CPUs reserved in a cloud region.
+    """
+    totals = {'machines': 0, 'cpus': 0}
+    for reservation in ledger.values():
+        if (reservation['cloud'], reservation['region']) == (cloud, region):
+            for resource in totals:
+                totals[resource] += reservation.get(resource) or 0
+    return totals
+
+
+def reserve(datastore, reservation_id, cloud, region, machines, cpus,
+            ttl=RESERVATION_TTL):
+    """
+    Record a reservation in the ledger.
+    """
+    now = time()
+    ledger = read_ledger(datastore, now)
+    ledger[reservation_id] = {
+        'cloud': cloud,
+        'region': region,
+        'machines': machines,
+        'cpus': cpus,
+        'host': '{}:{}'.format(socket.gethostname(), os.getpid()),
+        'created': now,
+        'expires': now + ttl,
+    }
+    write_ledger(datastore, ledger)
+    logging.info('Reserved {} machines and {} cpus in {} {}'.format(
+        machines, cpus, cloud, region))
+
+
+def release(datastore, reservation_id):
+    """
+    Remove a reservation from the ledger.
+    """
+    ledger = read_ledger(datastore)
+    reservation = ledger.pop(reservation_id, None)
+    if reservation is None:
+        return False
+    write_ledger(datastore, ledger)
+    logging.info('Released {} machines and {} cpus in {} {}'.format(
+        reservation['machines'], reservation['cpus'], reservation['cloud'],
+        reservation['region']))
+    return True
@@ -0,0 +1,125 @@
+"""
+Cache of passing results, to skip retesting unchanged bundles.
+
+When a plan passes on a cloud, its result is stored in the results data store
+under cache/<key>.json, where the key is a hash of the bundle YAML which was
+deployed, as returned by get_bundle_yaml, the provider and the test plan.
+Charm revisions are part of the key through the bundle, so only bundles
+which pin the revision of every charm are cached: an unpinned charm may
+have been updated since the result was cached.  Before deploying, a runner
+with --result-cache looks up the key of the bundle it is about to test and,
+if a PASS was recorded within the TTL, carries that result forward instead
+of testing again.
+
+Each entry only has a single writer at a time and is simply overwritten by
+the latest pass, so the cache is used without the data store lock.
+"""
+import hashlib
+import json
+import logging
+import re
+from time import time
+
+import yaml
+
+from cloudweatherreport import model
+
+
+CACHE_DIR = 'cache'
+# A charm store URL ending with a revision, e.g., cs:~user/xenial/mysql-57.
+PINNED_CHARM_RE = re.compile(r'^cs:.*-\d+$')
+
+
+class CachedResult(Exception):
+    """
+    Raised to stop bundletester before deploying when a cached result is
+    found.
+    """
+
+    def __init__(self, result):
+        super(CachedResult, self).__init__(
+            'Cached result from {}'.format(result.cached_from))
+        self.result = result
+
+
+def is_pinned(bundle_yaml):
+    """
+    Check if a bundle pins the charm store revision of all of its charms.
+    """
+    try:
+        bundle = yaml.safe_load(bundle_yaml)
+    except yaml.YAMLError:
+        return False
+    if not isinstance(bundle, dict):
+        return False
+    if 'services' not in bundle and 'applications' not in bundle and \
+            len(bundle) == 1:
+        # The older format, with the bundle under its name.
+        bundle = list(bundle.values())[0]
+        if not isinstance(bundle, dict):
+            return False
+    services = bundle.get('services') or bundle.get('applications')
+    if not isinstance(services, dict) or not services:
+        return False
+    for service in services.values():
+        charm = service.get('charm') if isinstance(service, dict) else None
+        if not charm or not PINNED_CHARM_RE.match(str(charm)):
+            return False
+    return True
+
+
+def cache_key(bundle_yaml, provider, test_plan):
+    plan = test_plan.as_dict()
+    # The label only names the plan in the reports.
+    plan.pop('test_label', None)
+    digest = hashlib.sha256()
+    for part in (bundle_yaml, provider, json.dumps(plan, sort_keys=True)):
+        if isinstance(part, unicode):
+            part = part.encode('utf8')
+        digest.update(part or '')
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+def cache_filename(key):
+    return '{}/{}.json'.format(CACHE_DIR, key)
+
+
+def lookup(datastore, key, ttl, now=None):
+    """
+    Find a passing result cached within the last `ttl` seconds.
+
+    The result is returned with `cached_from` set to the test_id of the run
+    which produced it.
+    """
+    filename = cache_filename(key)
+    if not datastore.exists(filename):
+        return None
+    try:
+        entry = json.loads(datastore.read(filename))
+        result = model.SuiteResult.from_dict(entry['result'])
+    except (KeyError, TypeError, ValueError):
+        logging.error('Ignoring invalid cache entry {}'.format(filename))
+        return None
+    now = time() if now is None else now
+    if entry.get('created', 0) + ttl < now:
+        return None
+    if result.test_outcome != model.TEST_OUTCOMES.passed:
+        return None
+    result.cached_from = result.cached_from or entry.get('test_id')
+    return result
+
+
+def store(datastore, key, test_id, result):
+    """
+    Record a passing result.
+    """
+    if result.test_outcome != model.TEST_OUTCOMES.passed or \
+            result.cached_from:
+        return False
+    datastore.write(cache_filename(key), json.dumps({
+        'test_id': test_id,
+        'created': time(),
+        'result': result.as_dict(),
+    }, sort_keys=True, indent=2))
+    return True
@@ -3,52 +3,108 @@ from __future__ import print_function
 import multiprocessing as mp
 import argparse
 from cStringIO import StringIO
-from datetime import datetime
+from datetime import (
+    datetime,
+    timedelta,
+)
+import hashlib
 import logging
 import os
+from Queue import Empty
+import re
+import subprocess
 import sys
+from time import time
 import traceback
 from copy import copy
 from pkg_resources import resource_string
 
-from bundletester import tester
-
-from cloudweatherreport import model
+from cloudweatherreport import (
+    archive,
+    metrics,
+    model,
+    profiling,
+    progress,
+    reservation,
+    resultcache,
+)
 from cloudweatherreport.cloudresource.resource import (
+    get_resource_limits,
     is_resource_available,
     UnknownCloudName,
     UnknownCredentialName,
     CloudNotSupported,
 )
 from cloudweatherreport.datastore import DataStore
+from cloudweatherreport.scheduler import (
+    EXIT_REQUEUE,
+    Job,
+    Scheduler,
+)
 from cloudweatherreport.utils import (
     configure_logging,
     connect_juju_client,
+    enqueue_action,
     find_unit,
-    fetch_svg,
     get_provider_name,
     guess_provider_name,
-    run_action,
+    juju_cmd,
     get_bundle_yaml,
     get_juju_major_version,
     get_versioned_juju_api,
     generate_test_id,
+    parallel_map,
+    publish_svg,
+    read_file,
     temp_tmpdir,
+    timed,
+    wait_for_actions_complete,
+    write_bundle_index,
+    write_dashboard,
     write_to_datastore,
 )
 
 
+def cache_policies_file(filename):
+    """
+    Load a list of S3 Cache-Control policies from a YAML file.
+
+    The file should contain a list of mappings with `pattern` and
+    `cache-control` keys, in priority order.
+    """
+    return [(policy['pattern'], policy['cache-control'])
+            for policy in read_file(filename, 'yaml')]
+
+
 def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('controllers', nargs='+', help="Controller list.")
     parser.add_argument('test_plan', help="Test plan YAML file.")
     parser.add_argument('--regenerate-index', action="store_true")
+    parser.add_argument('--rebuild-index', action="store_true",
+                        help="Rebuild the index from the report files in the "
+                             "results store.  If this is set, the controllers "
+                             "and test_plan arguments will be ignored.")
     parser.add_argument('--remove-test',
                         help="Name of the test to be removed. If this is set, "
                              "the controllers and test_plan arguments will be "
                              "ignored.")
+    parser.add_argument('--prune-older-than', type=int, metavar='DAYS',
+                        help="Remove test results older than this many days "
+                             "and delete their files.  If this is set, the "
+                             "controllers and test_plan arguments will be "
+                             "ignored.")
+    parser.add_argument('--compact-older-than', type=int, metavar='DAYS',
+                        help="Pack test results older than this many days "
+                             "into per-bundle, per-month archives.  If this "
+                             "is set, the controllers and test_plan "
+                             "arguments will be ignored.")
     parser.add_argument('--results-dir', default='results',
                         help="Directory to store / find results.")
+    parser.add_argument('--workers', default=16, type=int,
+                        help="Number of parallel data store operations used "
+                             "by --rebuild-index, --remove-test, "
+                             "--prune-older-than and --compact-older-than.")
     parser.add_argument('--bucket',
                         help='Store / find results in this S3 bucket '
                              'instead of locally')
@@ -57,11 +113,63 @@ def parse_args(argv=None):
     parser.add_argument('--s3-private', dest='s3_public',
                         action='store_false', default=True,
                         help='Do not make the files written to S3 public-read')
+    parser.add_argument('--s3-cache-policies', type=cache_policies_file,
+                        help='YAML file of Cache-Control policies, keyed by '
+                             'file name pattern, applied to files written to '
+                             'S3.  Defaults to long-lived reports and '
+                             'short-lived indexes.')
     parser.add_argument('--results-per-bundle', default=40, type=int,
-                        help='Maximum number of results to list per bundle in '
-                             'the index.  Older results will not be listed, '
-                             'but the result reports themselves will be '
-                             'preserved.')
+                        help='Number of results to list per page of each '
+                             'bundle\'s history.  The most recent results are '
+                             'listed on the bundle index and older results on '
+                             'numbered pages which are only written once.')
+    parser.add_argument('--chart-points', default=500, type=int,
+                        help='Maximum number of points per cloud in '
+                             'benchmark charts.  Longer series are '
+                             'downsampled, with the full data written to '
+                             'benchmarks.json alongside the report.  Use 0 '
+                             'to disable downsampling.')
+    parser.add_argument('--plan-concurrency', default=1, type=int,
+                        help="Number of test plans to run at the same time "
+                             "on each controller, each in its own Juju "
+                             "model.")
+    parser.add_argument('--max-jobs', type=int,
+                        help="Maximum number of test plans to run at the "
+                             "same time across all controllers.")
+    parser.add_argument('--wait-for-capacity', type=int, metavar='SECONDS',
+                        help="When a cloud does not have the resources "
+                             "free for a test plan, requeue the plan and "
+                             "retry with backoff for up to this many "
+                             "seconds, instead of recording it as an "
+                             "infrastructure failure.")
+    parser.add_argument('--result-cache', type=int, metavar='HOURS',
+                        help="Carry forward the PASS result of the same "
+                             "bundle YAML, cloud and test plan from the "
+                             "last HOURS instead of deploying and testing "
+                             "again.")
+    parser.add_argument('--profile', action='store_true',
+                        help="Profile each runner, job and publisher process "
+                             "into RESULTS_DIR/profile/, as .pstats files "
+                             "and collapsed stacks for flame graphs.")
+    parser.add_argument('--trace-malloc', action='store_true',
+                        help="Record the top allocations made while "
+                             "publishing results into RESULTS_DIR/profile/, "
+                             "or the growth in objects by type without the "
+                             "tracemalloc module.")
+    parser.add_argument('--metrics-file',
+                        help="Write metrics of the run to this file, in the "
+                             "format of the Prometheus textfile collector.")
+    parser.add_argument('--svg-renderer', choices=['remote', 'local'],
+                        default='remote',
+                        help="Draw bundle diagrams with svg.juju.solutions "
+                             "(remote), falling back to the built-in "
+                             "renderer if it fails, or only with the "
+                             "built-in renderer (local).")
+    parser.add_argument('--client-side-index', action='store_true',
+                        help='Publish a static dashboard which renders the '
+                             'indexes in the browser from the JSON files, '
+                             'and only write JSON indexes when saving '
+                             'results.')
 
     # bundle tester args
     parser.add_argument('-t', '--testdir', default=os.getcwd())
@@ -91,6 +199,11 @@ def parse_args(argv=None):
     parser.add_argument('--test-pattern', dest="test_pattern")
     parser.add_argument('--test-id', dest="test_id", help="Test ID.",
                         default=generate_test_id())
+    parser.add_argument('--resume', action='store_true',
+                        help="Only run the plans which have no result for "
+                             "their cloud in the reports of --test-id yet, "
+                             "or whose result was an infrastructure "
+                             "failure.")
     parser.add_argument('--deploy-plan',
                         help='A plan to deploy charm under')
     parser.add_argument('--deploy-budget',
@@ -99,29 +212,99 @@ def parse_args(argv=None):
                         help="Skip matrix test run, even if juju-matrix is "
                         "in your path.")
     options = parser.parse_args(argv)
-    options.juju_major_version = get_juju_major_version()
+    # Probed by resolve_juju_major_version once it is needed, since the
+    # maintenance commands don't use juju at all.
+    options.juju_major_version = None
     configure_logging(getattr(logging, options.log_level))
     return options
 
 
-class Runner(mp.Process):
-    def __init__(self, controller, set_exit_code, cli_args, *args, **kwargs):
-        super(Runner, self).__init__(*args, **kwargs)
+def resolve_juju_major_version(args):
+    """
+    Major version of juju, probed the first time it is needed.
+    """
+    if args.juju_major_version is None:
+        args.juju_major_version = get_juju_major_version()
+    return args.juju_major_version
+
+
+# Returned by Runner.run_plan when the plan should be run again later.
+REQUEUE = 'requeue'
+# Results which arrive within this many seconds of each other are published
+# together.
+PUBLISH_DELAY = 5
+# Number of times the cloud is checked when other runners keep reserving
+# resources while it is checked.
+RESERVE_ATTEMPTS = 3
+# Time limit in seconds for each group of benchmarks run together.
+BENCHMARK_TIMEOUT = 3600
+
+
+class Runner(object):
+    def __init__(self, controller, cli_args):
         self.controller = controller
         self.args = copy(cli_args)
         self.test_id = self.args.test_id
-        self.set_exit_code = set_exit_code
-
-    def run(self):
-        test_plans = model.TestPlan.load_plans(self.args.test_plan)
-        any_fail = False
-        for test_plan in test_plans:
-            if not self.run_plan(test_plan):
-                any_fail = True
-        if self.set_exit_code:
-            sys.exit(any_fail)
-        else:
-            return any_fail
+        # set when run as a scheduled job
+        self.can_requeue = False
+        self.queue_wait = None
+        self.reservation_id = None
+        # seconds spent in each phase of the current plan
+        self.timings = {}
+        # set to publish results through a publisher process
+        self.results_queue = None
+
+    def run_plan_in_model(self, test_plan, number):
+        """
+        Run a plan in a new Juju model on this controller, which is
+        destroyed afterwards unless --no-destroy is set.
+        """
+        controller = self.controller
+        if self.args.resume:
+            # Don't create a model for a plan which is skipped.
+            env = connect_juju_client(
+                controller, logging=logging,
+                version=resolve_juju_major_version(self.args))
+            if env:
+                try:
+                    provider = env_provider_name(env.info())
+                finally:
+                    env.close()
+                resumed = self.resume_result(test_plan, provider)
+                if resumed is not None:
+                    return resumed
+        model_name = get_model_name(self.test_id, number)
+        self.controller = '{}:{}'.format(controller, model_name)
+        cmd = ['add-model', model_name, '-c', controller, '--no-switch']
+        if os.getenv('JUJU_CREDENTIAL_NAME'):
+            cmd.extend(['--credential', os.getenv('JUJU_CREDENTIAL_NAME')])
+        try:
+            juju_cmd(cmd)
+        except (OSError, subprocess.CalledProcessError) as e:
+            msg = 'Unable to create model {}: {}'.format(self.controller, e)
+            logging.error(msg)
+            test_result = self.generate_test_result(
+                provider=get_provider_name(guess_provider_name(controller)),
+                test_name='Juju model creation failed', output=msg)
+            self.save_result_in_datastore(test_result, [], test_plan)
+            return False
+        try:
+            return self.run_plan(test_plan)
+        finally:
+            if not self.args.no_destroy:
+                try:
+                    juju_cmd(['destroy-model', '-y', self.controller])
+                except (OSError, subprocess.CalledProcessError) as e:
+                    logging.error('Unable to destroy model {}: {}'.format(
+                        self.controller, e))
+
+    def get_datastore(self):
+        return DataStore.get(
+            self.args.results_dir,
+            self.args.bucket,
+            self.args.s3_creds,
+            self.args.s3_public,
+            self.args.s3_cache_policies)
 
     def load_index(self, datastore):
         index_filename = model.ReportIndex.full_index_filename_json
@@ -148,15 +331,60 @@ class Runner(mp.Process):
                     name=test_plan.bundle_name,
                     url=test_plan.url),
             )
+            archived = [item for item in index.reports
+                        if item == report and item.archive]
+            if archived:
+                return model.Report.from_json(
+                    self.read_report_json(datastore, archived[0]))
             prev_report = index.find_previous_report(report)
             if prev_report:
-                prev_file = prev_report.filename_json
-                prev_report_json = datastore.read(prev_file)
+                prev_report_json = self.read_report_json(datastore,
+                                                         prev_report)
                 prev_report = model.Report.from_json(prev_report_json)
                 report.upsert_benchmarks(prev_report.benchmarks)
         return report
 
-    def check_cloud_resource(self, test_plan, cloud_info):
+    def resume_result(self, test_plan, provider):
+        """
+        With --resume, return whether the earlier run of a plan on a provider
+        passed, or None if the plan should be run.
+        """
+        if not self.args.resume:
+            return None
+        completed = self.completed_result(test_plan, provider)
+        if not completed:
+            return None
+        logging.info('Skipping {} on {}, already {}.'.format(
+            test_plan.bundle_name, provider, completed.test_outcome))
+        return completed.test_outcome == 'PASS'
+
+    def completed_result(self, test_plan, provider):
+        """
+        Find the result of an earlier run of a plan on a provider with the
+        same test_id, unless it failed because of the infrastructure.
+        """
+        datastore = self.get_datastore()
+        for filename in (test_plan.report_filename(self.test_id),
+                         test_plan.old_report_filename(self.test_id)):
+            if datastore.exists(filename):
+                report = model.Report.from_json(datastore.read(filename))
+                break
+        else:
+            return None
+        result = report.provider_result(provider)
+        if result and result.test_outcome != model.TEST_OUTCOMES.infra:
+            return result
+        return None
+
+    def read_report_json(self, datastore, index_item):
+        """
+        Read the JSON of an indexed report, which may have been archived.
+        """
+        if index_item.archive:
+            return archive.read_report_json(datastore, index_item)
+        return datastore.read(index_item.filename_json)
+
+    def check_cloud_resource(self, test_plan, cloud_info, reserved=None):
         """Check if resources are available for a cloud.
 
         This check against the default resource limits. These limits can be
@@ -169,16 +397,17 @@ class Runner(mp.Process):
 
         :param test_plan: CWR test plan.
         :param cloud_info: Cloud info containing region and cloud name.
+        :param reserved: Machines and CPUs reserved by other runners, which
+          are needed on top of those already in use.
         """
         cloud = cloud_info['cloud-tag'].replace("cloud-", "")
         region = cloud_info['cloud-region']
-        if (test_plan.cloud_resource is None or
-                test_plan.cloud_resource.get('machines') is None or
-                test_plan.cloud_resource.get('cpus') is None):
+        if not self.has_cloud_resource(test_plan):
             logging.info(
                 'Skipping cloud resource check. Add "cloud_resource" field in '
                 'the test plan to check for resources before performing tests')
             return None
+        reserved = reserved or {}
         cloud_env = cloud.upper()
 
         try:
@@ -199,9 +428,11 @@ class Runner(mp.Process):
         try:
             return is_resource_available(
                 cloud=cloud, region=region,
-                num_of_instances=test_plan.cloud_resource['machines'],
+                num_of_instances=(test_plan.cloud_resource['machines'] +
+                                  reserved.get('machines', 0)),
                 num_of_security_groups=1,
-                num_of_cpus=test_plan.cloud_resource['cpus'],
+                num_of_cpus=(test_plan.cloud_resource['cpus'] +
+                             reserved.get('cpus', 0)),
                 instance_limit=machine_limit,
                 security_group_limit=sec_limit,
                 cpu_limit=cpu_limit,
@@ -214,8 +445,73 @@ class Runner(mp.Process):
             logging.info('Skipping cloud resource check: {}'.format(str(e)))
             return None
 
+    @staticmethod
+    def has_cloud_resource(test_plan):
+        return (test_plan.cloud_resource is not None and
+                test_plan.cloud_resource.get('machines') is not None and
+                test_plan.cloud_resource.get('cpus') is not None)
+
+    def reserve_cloud_resource(self, test_plan, cloud_info):
+        """Check for and reserve the resources of a test plan.
+
+        Resources reserved by other runners in the same cloud and region
+        are counted as in use.  If the resources are available, they are
+        reserved until release_cloud_resource is called once the plan is
+        deployed, so that other runners checking the cloud while this plan
+        is deploying don't count on them.
+
+        The cloud is checked without holding the data store lock, which
+        only guards the update of the ledger.  If more has been reserved by
+        the time the lock is held, the check is made again.
+
+        Returns the result of check_cloud_resource.
+        """
+        if not self.has_cloud_resource(test_plan):
+            return self.check_cloud_resource(test_plan, cloud_info)
+        cloud = cloud_info['cloud-tag'].replace("cloud-", "")
+        region = cloud_info['cloud-region']
+        datastore = self.get_datastore()
+        for attempt in range(RESERVE_ATTEMPTS):
+            reserved = reservation.reserved(
+                reservation.read_ledger(datastore), cloud, region)
+            available = self.check_cloud_resource(
+                test_plan, cloud_info, reserved)
+            if not available:
+                return available
+            with datastore.lock():
+                now_reserved = reservation.reserved(
+                    reservation.read_ledger(datastore), cloud, region)
+                if all(now_reserved[resource] <= reserved[resource]
+                       for resource in reserved):
+                    self.reservation_id = str(datastore.create_lock_id())
+                    reservation.reserve(
+                        datastore, self.reservation_id, cloud, region,
+                        test_plan.cloud_resource['machines'],
+                        test_plan.cloud_resource['cpus'])
+                    return available
+            logging.info('Resources were reserved by another runner during '
+                         'the check, checking again')
+        return False
+
+    def release_cloud_resource(self):
+        if self.reservation_id is None:
+            return
+        datastore = self.get_datastore()
+        try:
+            with datastore.lock():
+                reservation.release(datastore, self.reservation_id)
+        except Exception as e:
+            # The reservation will expire, so don't let it fail the plan.
+            logging.error('Unable to release reservation {}: {}'.format(
+                self.reservation_id, e))
+        self.reservation_id = None
+
     def run_plan(self, test_plan):
-        env = connect_juju_client(self.controller, logging=logging)
+        self.timings = {}
+        with timed(self.timings, 'connect'):
+            env = connect_juju_client(
+                self.controller, logging=logging,
+                version=resolve_juju_major_version(self.args))
         if not env:
             msg = "Jujuclient could not connect to {} ".format(self.controller)
             logging.error(msg)
@@ -227,12 +523,19 @@ class Runner(mp.Process):
             return False
 
         env.name = self.controller
-        env_info = env.info()
-        provider = (env_info.get("provider-type") or
-                    env_info.get("ProviderType"))
-        env.provider_name = get_provider_name(provider)
+        with timed(self.timings, 'env_info'):
+            env_info = env.info()
+        env.provider_name = env_provider_name(env_info)
+        resumed = self.resume_result(test_plan, env.provider_name)
+        if resumed is not None:
+            return resumed
         logging.info('Running test on {}.'.format(env.provider_name))
-        resource_available = self.check_cloud_resource(test_plan, env_info)
+        with timed(self.timings, 'resource_check'):
+            resource_available = self.reserve_cloud_resource(
+                test_plan, env_info)
+        if resource_available is False and self.can_requeue:
+            logging.info('Resource not available, waiting for capacity')
+            return REQUEUE
         if resource_available is False:
             msg = 'Resource not available'
             logging.error(msg)
@@ -244,7 +547,11 @@ class Runner(mp.Process):
         benchmark_result = []
         try:
             test_result = self.run_tests(test_plan, env)
-            benchmark_result = self.run_benchmarks(test_plan, env)
+            # Nothing was deployed for a cached result.
+            if not test_result.cached_from:
+                with timed(self.timings, 'benchmarks'):
+                    benchmark_result = self.run_benchmarks(test_plan, env)
+                self.cache_result(test_plan, test_result)
         except Exception:
             tb = traceback.format_exc()
             error = "Exception ({}):\n{}".format(env.name, tb)
@@ -253,47 +560,130 @@ class Runner(mp.Process):
             test_result = self.generate_test_result(
                 provider=env.provider_name, test_name='Exception',
                 output=error)
+        finally:
+            self.release_cloud_resource()
         self.save_result_in_datastore(test_result, benchmark_result, test_plan)
         return test_result.test_outcome == "PASS"
 
     def save_result_in_datastore(self, test_result, benchmark_results,
                                  test_plan):
-        datastore = DataStore.get(
-            self.args.results_dir,
-            self.args.bucket,
-            self.args.s3_creds,
-            self.args.s3_public)
-        svg_data = fetch_svg(test_result.bundle_yaml)
+        if self.queue_wait is not None:
+            test_result.queue_wait = self.queue_wait
+        if self.timings:
+            test_result.timings = dict(self.timings)
+        metrics.inc('cwr_runs_total', provider=test_result.provider,
+                    outcome=test_result.test_outcome)
+        if self.results_queue is not None:
+            # Published along with the results of other jobs by the
+            # publisher process.
+            self.results_queue.put(
+                encode_result(test_result, benchmark_results, test_plan))
+            return
+        self.publish_results([(test_result, benchmark_results, test_plan)])
+
+    def publish_results(self, results):
+        """
+        Publish a batch of results.
+
+        The index is loaded and written once for the whole batch, under a
+        single lock, and each updated report is written once, even if it
+        gets several results.
+
+        :param results: List of (SuiteResult, list of Benchmark, TestPlan)
+          tuples.
+        """
+        with profiling.profiled(self.args, 'publish'), \
+                profiling.traced_malloc(self.args, 'publish'):
+            self._publish_results(results)
+
+    def _publish_results(self, results):
+        datastore = self.get_datastore()
+        timings = {}
+        with timed(timings, 'svg'):
+            svg_urls = [publish_svg(datastore, test_result.bundle_yaml,
+                                    self.args.svg_renderer)
+                        for test_result, _, _ in results]
+        lock_requested = time()
         with datastore.lock():
-            index = self.load_index(datastore)
-            report = self.load_report(datastore, index, test_plan)
-            report.upsert_result(test_result)
-            report.upsert_benchmarks(benchmark_results)
-            index.upsert_report(report)
-            datastore.write(
-                'css/base.css',
-                resource_string(__name__,
-                                'static/css/base.css').decode('utf8'))
-            datastore.write(
-                'css/vanilla.min.css',
-                resource_string(__name__,
-                                'static/css/vanilla.min.css').decode('utf8'))
-            datastore.write(index.full_index_filename_json, index.as_json())
-            datastore.write(index.full_index_filename_html, index.as_html())
+            timings['lock_wait'] = round(time() - lock_requested, 3)
+            with timed(timings, 'load'):
+                index = self.load_index(datastore)
+                providers = list(index.providers)
+                reports = {}
+                report_svg_urls = {}
+                for (test_result, benchmark_results, test_plan), svg_url \
+                        in zip(results, svg_urls):
+                    filename = test_plan.report_filename(self.test_id)
+                    if filename not in reports:
+                        reports[filename] = self.load_report(
+                            datastore, index, test_plan)
+                    report = reports[filename]
+                    report.upsert_result(test_result)
+                    report.upsert_benchmarks(benchmark_results)
+                    index.upsert_report(report)
+                    report_svg_urls[filename] = svg_url
+            # A report can't include the time taken to write itself, so
+            # only the phases up to here are recorded in the reports and
+            # their index items.  The write time is in the phase metrics.
+            for report in reports.values():
+                report.timings = dict(timings)
+                index.upsert_report(report)
+            with timed(timings, 'write'):
+                self.write_published(datastore, index, providers, reports,
+                                     report_svg_urls)
+        logging.info('Published {} results to {} reports ({})'.format(
+            len(results), len(reports), ', '.join(
+                '{} {:.1f}s'.format(phase, seconds)
+                for phase, seconds in sorted(timings.items()))))
+
+    def write_published(self, datastore, index, providers, reports,
+                        report_svg_urls):
+        """
+        Render and write the index and reports updated by a publish.
+        """
+        client_side = self.args.client_side_index
+        if client_side:
+            write_dashboard(datastore)
+        datastore.write(
+            'css/base.css',
+            resource_string(__name__,
+                            'static/css/base.css').decode('utf8'))
+        datastore.write(
+            'css/vanilla.min.css',
+            resource_string(__name__,
+                            'static/css/vanilla.min.css').decode('utf8'))
+        datastore.write(index.full_index_filename_json, index.as_json())
+        if not client_side:
+            datastore.write(index.full_index_filename_html,
+                            index.as_html())
+        for filename, report in sorted(reports.items()):
             datastore.write(report.filename_json, report.as_json())
-            datastore.write(report.filename_html, report.as_html(svg_data))
+            datastore.write(report.filename_html, report.as_html(
+                report_svg_urls[filename],
+                chart_points=self.args.chart_points))
+            if report.benchmarks:
+                datastore.write(report.filename_benchmarks_json,
+                                report.benchmarks_json())
             datastore.write(report.filename_xml, report.as_xml())
-            datastore.write(index.summary_filename_html, index.summary_html())
-            datastore.write(index.summary_filename_json, index.summary_json())
-            for bundle_name in index.bundle_names():
-                datastore.write(
-                    index.bundle_index_html(bundle_name),
-                    index.as_html(bundle_name,
-                                  limit=self.args.results_per_bundle))
-                datastore.write(
-                    index.bundle_index_json(bundle_name),
-                    index.as_json(bundle_name,
-                                  limit=self.args.results_per_bundle))
+        if not client_side:
+            datastore.write(index.summary_filename_html,
+                            index.summary_html())
+        datastore.write(index.summary_filename_json, index.summary_json())
+        # Other bundles' indexes only change if a provider column was
+        # added.
+        updated = {}
+        for report in reports.values():
+            updated.setdefault(report.bundle.name, []).append(report)
+        if index.providers != providers:
+            bundle_names = sorted(index.bundle_names())
+        else:
+            bundle_names = sorted(updated)
+        for bundle_name in bundle_names:
+            write_bundle_index(
+                datastore, index, bundle_name,
+                self.args.results_per_bundle,
+                html=not client_side,
+                reports=updated.get(bundle_name))
 
     @staticmethod
     def generate_test_result(provider, test_name, output, suite='Error',
@@ -319,45 +709,103 @@ class Runner(mp.Process):
 
         :return: True if the test environment was provisioned and deployed
         """
+        # bundletester pulls in deployer, which is slow to import.
+        from bundletester import tester
+        resolve_juju_major_version(self.args)
         env_name = env.name
         bundletester_output = StringIO()
         self.args.output = bundletester_output
         self.args.tests = test_plan.tests if test_plan else None
         self.args.environment = env_name
-        self.args.reporter = 'json'
         self.args.testdir = test_plan.bundle
         if test_plan.bundle_file:
             self.args.bundle = test_plan.bundle_file
-        status = tester.main(self.args)
+        # Publish the results of the tests as they complete, rather than
+        # only once bundletester is done.
+        test_progress = progress.Progress(
+            self.get_datastore(),
+            progress.progress_filename(
+                test_plan.report_filename(self.test_id), env.provider_name),
+            self.test_id, test_plan.bundle_name, env.provider_name)
+        self.args.reporter = progress.register_reporter()
+
+        def on_test_result(message):
+            test_progress.add(message)
+            if message.get('test') == 'juju-deployer':
+                # The deployed machines are now counted by the cloud
+                # resource check, so the reservation is no longer needed.
+                self.release_cloud_resource()
+
+        self.args.on_test_result = on_test_result
+        if self.args.result_cache:
+            self.args.on_suite = lambda status: self.check_result_cache(
+                test_plan, env.provider_name, get_bundle_yaml(status))
+        test_progress.start()
+        try:
+            with timed(self.timings, 'tests'):
+                status = tester.main(self.args)
+        except resultcache.CachedResult as e:
+            test_progress.finish(e.result.test_outcome)
+            return e.result
+        except Exception:
+            test_progress.finish('INFRA')
+            raise
         result = model.SuiteResult.from_bundletester_output(
             env.provider_name,
             bundletester_output.getvalue())
         result.bundle_yaml = get_bundle_yaml(status)
+        test_progress.finish(result.test_outcome)
+        # bundletester reports the deployment as a test of its own.
+        deploy = sum(test.duration or 0 for test in result.tests
+                     if test.name == 'juju-deployer')
+        if deploy:
+            self.timings['deploy'] = round(deploy, 3)
+            self.timings['tests'] = round(
+                max(self.timings['tests'] - deploy, 0), 3)
         return result
 
+    def check_result_cache(self, test_plan, provider, bundle_yaml):
+        """
+        Stop the tests with a CachedResult if the bundle recently passed.
+        """
+        if not bundle_yaml or not resultcache.is_pinned(bundle_yaml):
+            return
+        key = resultcache.cache_key(bundle_yaml, provider, test_plan)
+        result = resultcache.lookup(self.get_datastore(), key,
+                                    self.args.result_cache * 60 * 60)
+        if result:
+            logging.info('Using the result of {} for {} on {}.'.format(
+                result.cached_from, test_plan.bundle_name, provider))
+            raise resultcache.CachedResult(result)
+
+    def cache_result(self, test_plan, test_result):
+        if not self.args.result_cache or not test_result.bundle_yaml or \
+                not resultcache.is_pinned(test_result.bundle_yaml):
+            return False
+        key = resultcache.cache_key(test_result.bundle_yaml,
+                                    test_result.provider, test_plan)
+        return resultcache.store(self.get_datastore(), key, self.test_id,
+                                 test_result)
+
     def run_benchmarks(self, test_plan, env):
-        actions_client = get_versioned_juju_api().facades.Actions(env)
+        actions_client = get_versioned_juju_api(
+            self.args.juju_major_version).facades.Actions(env)
         env_status = env.status()
-        benchmarks = []
+        planned = []
         for benchmark_plan in test_plan.benchmarks:
-            logging.info('Running benchmark {} on {} with params: {}'.format(
-                benchmark_plan.action,
-                benchmark_plan.unit,
-                benchmark_plan.params))
             real_unit = find_unit(benchmark_plan.unit, env_status)
             if not real_unit:
                 logging.error("unit not found: {}".format(benchmark_plan.unit))
                 continue
-            try:
-                result = run_action(
-                    actions_client,
-                    real_unit,
-                    benchmark_plan.action,
-                    action_param=benchmark_plan.params,
-                    timeout=3600)
-            except Exception as e:
-                logging.error('Action run failed: {}'.format(str(e)))
+            planned.append((benchmark_plan, real_unit))
+        outputs = {}
+        for group in group_benchmarks(planned):
+            outputs.update(self.run_benchmark_group(actions_client, group))
+        benchmarks = []
+        for benchmark_plan, _ in planned:
+            if id(benchmark_plan) not in outputs:
                 continue
+            result = outputs[id(benchmark_plan)] or {}
             composite = result.get('meta', {}).get('composite')
             if not composite:
                 logging.error('Skipping benchmark missing composite key: '
@@ -369,15 +817,51 @@ class Runner(mp.Process):
                 'provider': env.provider_name,
             })
             benchmarks.append(model.Benchmark.from_action(composite))
-            logging.info('Benchmark completed.')
         return benchmarks
 
+    def run_benchmark_group(self, actions_client, group):
+        """
+        Run a group of benchmarks at the same time.
+
+        All the benchmark actions are enqueued and then waited on together,
+        so the group takes as long as its slowest benchmark.  Returns
+        a dict of the ids of the benchmark plans which completed to their
+        action output.
+        """
+        pending = []
+        for benchmark_plan, unit in group:
+            logging.info('Running benchmark {} on {} with params: {}'.format(
+                benchmark_plan.action, unit, benchmark_plan.params))
+            try:
+                tag = enqueue_action(actions_client, unit,
+                                     benchmark_plan.action,
+                                     benchmark_plan.params)
+            except Exception as e:
+                logging.error('Action run failed: {}'.format(str(e)))
+                continue
+            pending.append((benchmark_plan, tag))
+        outputs = {}
+        if not pending:
+            return outputs
+        results = wait_for_actions_complete(
+            actions_client, [t for _, t in pending],
+            timeout=BENCHMARK_TIMEOUT)
+        for benchmark_plan, tag in pending:
+            result = results.get(tag)
+            if result is None:
+                logging.error('Action run failed: Timed out waiting for {} '
+                              'to complete.'.format(benchmark_plan.action))
+            elif result.get('error') or result.get('status') != 'completed':
+                logging.error('Action run failed: {}'.format(
+                    result.get('error') or result))
+            else:
+                outputs[id(benchmark_plan)] = result.get('output')
+                logging.info('Benchmark {} completed.'.format(
+                    benchmark_plan.action))
+        return outputs
+
     def remove_test_by_bundle_name(self):
-        datastore = DataStore.get(
-            self.args.results_dir,
-            self.args.bucket,
-            self.args.s3_creds,
-            self.args.s3_public)
+        datastore = self.get_datastore()
         with datastore.lock():
             index = self.load_index(datastore)
             reports = index.remove_by_bundle_name(
@@ -390,46 +874,457 @@ class Runner(mp.Process):
                 for report in reports:
                     logging.info("Removing {} id: {}".format(
                         report.bundle_name, report.test_id))
-            write_to_datastore(datastore, index)
+            self.delete_report_files(datastore, index, reports)
+            if not self.args.dryrun:
+                write_to_datastore(datastore, index,
+                                   html=not self.args.client_side_index)
+
+        return True
+
+    def prune_old_tests(self):
+        """
+        Remove the test results older than the --prune-older-than age.
 
+        The files of the removed reports are deleted, and the bundle indexes
+        of the affected bundles are rewritten, since removing old results
+        changes how the rest are split into pages.
+        """
+        datastore = self.get_datastore()
+        cutoff = datetime.now() - timedelta(days=self.args.prune_older_than)
+        with datastore.lock():
+            index = self.load_index(datastore)
+            reports = index.remove_older_than(cutoff, self.args.dryrun)
+            if not reports:
+                logging.info("No test results older than {}".format(
+                    cutoff.strftime('%Y-%m-%d')))
+                return False
+            logging.info("Removing {} test results older than {}".format(
+                len(reports), cutoff.strftime('%Y-%m-%d')))
+            self.delete_report_files(datastore, index, reports)
+            if self.args.dryrun:
+                return True
+            html = not self.args.client_side_index
+            write_to_datastore(datastore, index, html=html)
+            bundle_names = set(r.bundle_name for r in reports)
+            for bundle_name in sorted(bundle_names & index.bundle_names()):
+                write_bundle_index(datastore, index, bundle_name,
+                                   self.args.results_per_bundle,
+                                   html=html, all_pages=True)
         return True
 
+    def compact_old_tests(self):
+        """
+        Pack the test results older than the --compact-older-than age into
+        archives.
+
+        The compacted results stay in the index, linked to the archive
+        viewer instead of their report pages, and their loose files are
+        deleted once the updated index has been published.
+        """
+        datastore = self.get_datastore()
+        cutoff = datetime.now() - timedelta(days=self.args.compact_older_than)
+        with datastore.lock():
+            index = self.load_index(datastore)
+            reports = [r for r in index.reports
+                       if r.date and r.date < cutoff and not r.archive]
+            if not reports:
+                logging.info("No test results older than {}".format(
+                    cutoff.strftime('%Y-%m-%d')))
+                return False
+            logging.info("Compacting {} test results older than {}".format(
+                len(reports), cutoff.strftime('%Y-%m-%d')))
+            files = archive.compact_reports(datastore, reports,
+                                            self.args.workers,
+                                            self.args.dryrun)
+            total = sum(size for _, size in files)
+            if self.args.dryrun:
+                logging.info("Would archive {} files, {} bytes in total"
+                             .format(len(files), total))
+                return True
+            archive.write_viewer(datastore)
+            html = not self.args.client_side_index
+            write_to_datastore(datastore, index, html=html)
+            for bundle_name in sorted(set(r.bundle_name for r in reports)):
+                write_bundle_index(datastore, index, bundle_name,
+                                   self.args.results_per_bundle,
+                                   html=html, all_pages=True)
+            logging.info("Deleting {} archived files, {} bytes in total"
+                         .format(len(files), total))
+            datastore.delete_many([f for f, _ in files], self.args.workers)
+        return True
+
+    def delete_report_files(self, datastore, index, reports):
+        """
+        Delete the files of reports which have been removed from the index.
+
+        Bundle index pages which are no longer used, and all of the bundle
+        index files of bundles with no remaining results, are deleted too.
+        On a dry run, the files are only listed.
+        """
+        removed = {}
+        for report in reports:
+            bundle_dir, test_id = report.filename_json.split('/')[:2]
+            removed.setdefault(bundle_dir, set()).add(test_id)
+        # a dry run leaves the reports in the index
+        removed_ids = set(id(report) for report in reports)
+        remaining = model.ReportIndex(
+            providers=index.providers,
+            reports=[r for r in index.reports if id(r) not in removed_ids])
+        page_counts = {}
+        for bundle_name in remaining.bundle_names():
+            bundle_dir = index.bundle_index_json(bundle_name).split('/')[0]
+            page_counts[bundle_dir] = remaining.bundle_page_count(
+                bundle_name, self.args.results_per_bundle)
+        page_re = re.compile(r'^index-(\d+)\.(html|json)$')
+        files = []
+        for bundle_dir, test_ids in sorted(removed.items()):
+            for filename, size in datastore.list_recursive(bundle_dir):
+                parts = filename.split('/')
+                if len(parts) > 2:
+                    if parts[1] in test_ids:
+                        files.append((filename, size))
+                elif bundle_dir not in page_counts:
+                    files.append((filename, size))
+                else:
+                    match = page_re.match(parts[1])
+                    if match and int(match.group(1)) > page_counts[bundle_dir]:
+                        files.append((filename, size))
+        # Archives are only deleted once none of their reports are left.
+        archives = (set(r.archive for r in reports if r.archive) -
+                    set(r.archive for r in remaining.reports if r.archive))
+        for archive_dir in sorted(set(os.path.dirname(a) for a in archives)):
+            for filename, size in datastore.list_recursive(archive_dir):
+                if (filename in archives or
+                        filename in map(archive.lookup_filename, archives)):
+                    files.append((filename, size))
+        total = sum(size for _, size in files)
+        if self.args.dryrun:
+            for filename, size in files:
+                logging.info("Would delete {} ({} bytes)".format(
+                    filename, size))
+            logging.info("Would delete {} files, {} bytes in total".format(
+                len(files), total))
+        else:
+            logging.info("Deleting {} files, {} bytes in total".format(
+                len(files), total))
+            datastore.delete_many([f for f, _ in files], self.args.workers)
+        return files
+
+    def write_index(self, datastore, index):
+        """
+        Write the full index, summary and every page of each bundle index.
+        """
+        html = not self.args.client_side_index
+        if not html:
+            write_dashboard(datastore, force=True)
+        write_to_datastore(datastore, index, html=html)
+        for bundle_name in sorted(index.bundle_names()):
+            write_bundle_index(datastore, index, bundle_name,
+                               self.args.results_per_bundle,
+                               html=html, all_pages=True)
+
     def regenerate_index(self):
         logging.info('Regenerating index...')
-        datastore = DataStore.get(
-            self.args.results_dir,
-            self.args.bucket,
-            self.args.s3_creds,
-            self.args.s3_public)
+        datastore = self.get_datastore()
         with datastore.lock():
             index = self.load_index(datastore)
-            write_to_datastore(datastore, index)
+            self.write_index(datastore, index)
         return True
 
+    def rebuild_index(self):
+        """
+        Rebuild the index from all of the report files in the data store,
+        including those packed into archives.
+
+        Reports are downloaded and parsed in parallel, and the rebuilt index
+        is published under a single lock.
+        """
+        logging.info('Rebuilding index from reports...')
+        datastore = self.get_datastore()
+        report_re = re.compile(r'^[^/]+/[^/]+/report\.json$')
+        lookup_re = re.compile(r'^archive/[^/]+/\d{4}-\d{2}\.json$')
+        filenames = []
+        archives = []
+        for filename, _ in datastore.list_recursive():
+            if lookup_re.match(filename):
+                archives.append(re.sub(r'\.json$', '.gz', filename))
+            elif report_re.match(filename):
+                filenames.append(filename)
+        logging.info('Found {} reports and {} archives'.format(
+            len(filenames), len(archives)))
+
+        def load(filename):
+            try:
+                return model.Report.from_json(datastore.read(filename))
+            except Exception as e:
+                logging.warn('Skipping unreadable report {}: {}'.format(
+                    filename, e))
+
+        def load_archive(archive_name):
+            try:
+                members = archive.read_members(datastore, archive_name)
+                return [(model.Report.from_json(contents.decode('utf8')),
+                         archive_name)
+                        for name, contents in sorted(members.items())
+                        if name.endswith('/report.json')]
+            except Exception as e:
+                logging.warn('Skipping unreadable archive {}: {}'.format(
+                    archive_name, e))
+                return []
+
+        start = time()
+        reports = parallel_map(load, filenames, self.args.workers, 'reports')
+        reports = [r for r in reports
+                   if r and r.bundle and r.bundle.name and r.test_id]
+        # Loose report files take precedence over archived copies.
+        loose = set((r.bundle.name, r.test_id) for r in reports)
+        archived = {}
+        for members in parallel_map(load_archive, archives,
+                                    self.args.workers, 'archives'):
+            for report, archive_name in members:
+                key = (report.bundle.name, report.test_id)
+                if report.bundle.name and key not in loose:
+                    archived[key] = archive_name
+                    reports.append(report)
+        index = model.ReportIndex.from_reports(reports)
+        for item in index.reports:
+            item.archive = archived.get((item.bundle_name, item.test_id))
+        logging.info('Indexed {} reports in {:.1f}s'.format(
+            len(index.reports), time() - start))
+        with datastore.lock():
+            self.write_index(datastore, index)
+        logging.info('Published index in {:.1f}s'.format(time() - start))
+        return True
+
+
+def group_benchmarks(planned):
+    """
+    Group benchmarks which can run at the same time.
+
+    `planned` is a list of (BenchmarkPlan, unit) tuples, in the order they
+    are listed in the test plan.  Returns a list of groups, to be run one
+    after another, in which no two benchmarks target the same unit.
+    Benchmarks of a unit run in their listed order, and an isolated
+    benchmark gets a group of its own, after every benchmark listed before
+    it and before every benchmark listed after it.
+    """
+    groups = []
+    # the first group a benchmark may join, after any isolated benchmark
+    first = 0
+    last_group = {}
+    for benchmark_plan, unit in planned:
+        if benchmark_plan.isolated:
+            groups.append([(benchmark_plan, unit)])
+            first = len(groups)
+            continue
+        i = max(first, last_group.get(unit, -1) + 1)
+        if i == len(groups):
+            groups.append([])
+        groups[i].append((benchmark_plan, unit))
+        last_group[unit] = i
+    return groups
+
+
+def get_model_name(test_id, number):
+    """
+    Name of the Juju model a plan of a test run is run in.
+
+    Juju model names may only have lowercase letters, digits and hyphens,
+    so the start of the test_id is slugified, and a hash of the whole
+    test_id keeps the names of different runs apart.
+    """
+    slug = re.sub(r'[^a-z0-9]+', '-', test_id.lower()).strip('-')
+    digest = hashlib.sha1(test_id.encode('utf8')).hexdigest()[:6]
+    return '-'.join(part for part in (
+        'cwr', slug[:8].strip('-'), digest, str(number)) if part)
+
+
+def env_provider_name(env_info):
+    return get_provider_name(env_info.get("provider-type") or
+                             env_info.get("ProviderType"))
+
+
+def get_controller_cloud(controller, juju_major_version=None):
+    """
+    Name of the cloud of a controller, or None if it cannot be found.
+    """
+    try:
+        env = connect_juju_client(controller, logging=logging,
+                                  version=juju_major_version)
+    except Exception as e:
+        logging.warn('Unable to connect to {}: {}'.format(controller, e))
+        return None
+    if not env:
+        return None
+    # The connection is not inherited by the job processes.
+    try:
+        info = env.info()
+    finally:
+        env.close()
+    cloud = info.get('cloud-tag', '').replace('cloud-', '')
+    return cloud or info.get('ProviderType')
+
+
+def encode_result(test_result, benchmark_results, test_plan):
+    """
+    Encode a result to be sent to the publisher process.
+    """
+    return (test_result.as_json(),
+            [benchmark.as_json() for benchmark in benchmark_results],
+            test_plan.as_json())
+
+
+def decode_result(message):
+    result_json, benchmarks_json, plan_json = message
+    return (model.SuiteResult.from_json(result_json),
+            [model.Benchmark.from_json(b) for b in benchmarks_json],
+            model.TestPlan.from_json(plan_json))
+
+
+def run_publisher(args, results_queue, delay=PUBLISH_DELAY):
+    """
+    Publish the results sent by the job processes until sent None.
+
+    Results which arrive within `delay` seconds of each other are published
+    as one batch, so that the index is only loaded and written once for
+    them.  A batch which fails to publish is retried with the next one.
+    Exits with an error if some results could not be published.
+    """
+    with metrics.child_process():
+        runner = Runner(None, args)
+        pending = []
+        done = False
+        while not done:
+            message = results_queue.get()
+            if message is None:
+                done = True
+            else:
+                pending.append(decode_result(message))
+                deadline = time() + delay
+                while True:
+                    try:
+                        message = results_queue.get(
+                            timeout=max(0, deadline - time()))
+                    except Empty:
+                        break
+                    if message is None:
+                        done = True
+                        break
+                    pending.append(decode_result(message))
+            if not pending:
+                continue
+            try:
+                runner.publish_results(pending)
+                pending = []
+            except Exception:
+                logging.error('Unable to publish {} results:\n{}'.format(
+                    len(pending), traceback.format_exc()))
+    if pending:
+        sys.exit(1)
+
+
+def run_job(args, job, in_model, results_queue=None):
+    runner = Runner(job.controller, args)
+    runner.results_queue = results_queue
+    runner.can_requeue = job.can_wait
+    if job.deadline is not None:
+        runner.queue_wait = round(job.queue_wait, 1)
+    with metrics.child_process(), profiling.profiled(args, 'job'):
+        if in_model:
+            passed = runner.run_plan_in_model(job.test_plan, job.number)
+        else:
+            passed = runner.run_plan(job.test_plan)
+    if passed is REQUEUE:
+        sys.exit(EXIT_REQUEUE)
+    sys.exit(not passed)
+
+
+def run_jobs(args, controllers, test_plans):
+    """
+    Run every test plan on every controller.
+
+    The plans are scheduled across the whole matrix, each in its own
+    process, limited by --plan-concurrency per controller, --max-jobs in
+    total, and the machine and CPU limits of each cloud.  If more than one
+    plan can run on a controller at once, each runs in its own Juju model.
+    With --wait-for-capacity, plans which find too few free resources are
+    requeued rather than failed.
+
+    :return: True if any plan failed.
+    """
+    concurrency = args.plan_concurrency
+    # Resolved once here so that the job processes don't each probe it.
+    resolve_juju_major_version(args)
+    if concurrency > 1 and args.juju_major_version == 1:
+        logging.warn('Juju 1 has no models, so plans are run one at a '
+                     'time on each controller.')
+        concurrency = 1
+    scheduler = Scheduler(concurrency, args.max_jobs)
+    for controller in controllers:
+        cloud = get_controller_cloud(controller, args.juju_major_version)
+        if cloud:
+            scheduler.limits[cloud] = get_resource_limits(cloud)
+        for number, test_plan in enumerate(test_plans, 1):
+            scheduler.add(Job(controller, test_plan, number, cloud,
+                              args.wait_for_capacity))
+
+    results_queue = mp.Queue()
+    publisher = mp.Process(target=run_publisher, args=(args, results_queue))
+    publisher.start()
+
+    def start(job):
+        logging.info('Starting {}'.format(job))
+        process = mp.Process(target=run_job,
+                             args=(args, job, concurrency > 1, results_queue))
+        process.start()
+        return process
+
+    try:
+        any_fail = scheduler.run(start)
+    finally:
+        results_queue.put(None)
+        publisher.join()
+    if publisher.exitcode:
+        logging.error('Some results could not be published.')
+        any_fail = True
+    return any_fail
+
 
 def entry_point():
     args = parse_args()
-    processes = []
     with temp_tmpdir():
-        if args.remove_test:
-            return Runner(None, False, args).remove_test_by_bundle_name()
-        if args.regenerate_index:
-            return Runner(None, False, args).regenerate_index()
-
-        if len(args.controllers) > 1:
-            for controller in args.controllers:
-                processes.append(Runner(controller, True, args))
-                processes[-1].start()
-            overall_fail = False
-            for p in processes:
-                p.join()
-                if p.exitcode:
-                    overall_fail = True
-            return overall_fail
+        if args.metrics_file:
+            metrics.start_export()
+        try:
+            return run_command(args)
+        finally:
+            if args.metrics_file:
+                write_metrics(args.metrics_file)
+                metrics.stop_export()
 
-        else:
-            exitcode = Runner(args.controllers[0], False, args).run()
-            return exitcode
+
+def run_command(args):
+    if args.remove_test:
+        return Runner(None, args).remove_test_by_bundle_name()
+    if args.prune_older_than is not None:
+        return Runner(None, args).prune_old_tests()
+    if args.compact_older_than is not None:
+        return Runner(None, args).compact_old_tests()
+    if args.regenerate_index:
+        return Runner(None, args).regenerate_index()
+    if args.rebuild_index:
+        return Runner(None, args).rebuild_index()
+
+    test_plans = model.TestPlan.load_plans(args.test_plan)
+    return run_jobs(args, args.controllers, test_plans)
+
+
+def write_metrics(filename):
+    try:
+        metrics.write_textfile(filename)
+    except (IOError, OSError) as e:
+        logging.error('Unable to write metrics to {}: {}'.format(
+            filename, e))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+"""
+Scheduling of test plan runs across controllers.
+
+The controllers x test plans matrix is expanded into jobs, which are run in
+separate processes up to a per-controller and a global limit.  Jobs are also
+held back while starting them would commit more machines or CPUs of a cloud,
+as given by the cloud_resource of each test plan, than the cloud's limits.
+Jobs which find too few free resources when they start can be requeued, to
+be retried with backoff until a deadline, while other jobs go ahead.
+"""
+import logging
+from time import (
+    sleep,
+    time,
+)
+
+
+# Exit code of a job process which found too few free cloud resources and
+# should be run again later.
+EXIT_REQUEUE = 75
+
+
+class Job(object):
+    """
+    A test plan to be run on a controller.
+
+    :param wait_for_capacity: Seconds, from when the job is first queued,
+      for which it may be requeued to wait for free cloud resources.
+    """
+    def __init__(self, controller, test_plan, number, cloud=None,
+                 wait_for_capacity=None):
+        self.controller = controller
+        self.test_plan = test_plan
+        self.number = number
+        self.cloud = cloud
+        self.queued_at = time()
+        self.deadline = None
+        if wait_for_capacity:
+            self.deadline = self.queued_at + wait_for_capacity
+        self.not_before = 0
+        self.attempts = 0
+        # Seconds spent waiting to be run again after being requeued.
+        self.queue_wait = 0.0
+        self.requeued_at = None
+
+    @property
+    def can_wait(self):
+        """
+        Whether the job may still be requeued to wait for capacity.
+        """
+        return self.deadline is not None and time() < self.deadline
+
+    def dequeue(self):
+        """
+        Add the time waited since the job was requeued to its queue_wait.
+        """
+        if self.requeued_at is not None:
+            self.queue_wait += time() - self.requeued_at
+            self.requeued_at = None
+
+    def __repr__(self):
+        return '<Job {} #{} on {}>'.format(
+            self.test_plan.bundle, self.number, self.controller)
+
+    @property
+    def needs(self):
+        """
+        Resources needed by the job, from its test plan's cloud_resource.
+        """
+        resource = self.test_plan.cloud_resource or {}
+        return {
+            'machines': int(resource.get('machines') or 0),
+            'cpus': int(resource.get('cpus') or 0),
+        }
+
+
+class Scheduler(object):
+    """
+    Runs jobs concurrently, within the concurrency and resource limits.
+
+    :param per_controller: Maximum number of jobs running on a controller.
+    :param max_jobs: Maximum number of jobs running in total, or None for
+      no limit.
+    :param limits: Resource limits by cloud name, e.g.,
+      {'aws': {'machines': 20, 'cpus': None}}.  None means no limit.
+    """
+    def __init__(self, per_controller=1, max_jobs=None, limits=None,
+                 poll_interval=1, retry_delay=60, max_retry_delay=900):
+        self.per_controller = per_controller
+        self.max_jobs = max_jobs
+        self.limits = limits or {}
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.pending = []
+        self.running = {}
+
+    def add(self, job):
+        self.pending.append(job)
+
+    def requeue(self, job):
+        """
+        Queue a job to be run again, after an exponential backoff which is
+        cut short by the job's deadline.
+        """
+        delay = min(self.retry_delay * 2 ** job.attempts,
+                    self.max_retry_delay)
+        job.not_before = min(time() + delay, job.deadline or 0)
+        job.attempts += 1
+        job.requeued_at = time()
+        logging.info('Requeued {} to retry in {:.0f}s'.format(
+            job, max(job.not_before - time(), 0)))
+        self.pending.append(job)
+
+    def used(self, cloud, resource):
+        """
+        Amount of a resource committed to running jobs on a cloud.
+        """
+        return sum(job.needs[resource] for job in self.running
+                   if job.cloud == cloud)
+
+    def fits(self, job):
+        """
+        Check if a job can be started now.
+        """
+        if time() < job.not_before:
+            return False
+        if self.max_jobs and len(self.running) >= self.max_jobs:
+            return False
+        on_controller = [j for j in self.running
+                         if j.controller == job.controller]
+        if len(on_controller) >= self.per_controller:
+            return False
+        if job.cloud is None or not any(j.cloud == job.cloud
+                                        for j in self.running):
+            # A job needing more than the limits is still run once the
+            # cloud is idle, so that its resource check reports it.
+            return True
+        for resource, limit in self.limits.get(job.cloud, {}).items():
+            if limit is None:
+                continue
+            if self.used(job.cloud, resource) + job.needs[resource] > limit:
+                return False
+        return True
+
+    def run(self, start):
+        """
+        Run all of the jobs.
+
+        Jobs are started, in the order they were added but skipping those
+        which do not fit yet, by calling `start(job)`, which should return
+        a started multiprocessing.Process.  A job whose process exits with
+        EXIT_REQUEUE is requeued.
+
+        :return: True if any job failed.
+        """
+        any_fail = False
+        while self.pending or self.running:
+            for job in list(self.pending):
+                if self.fits(job):
+                    self.pending.remove(job)
+                    job.dequeue()
+                    self.running[job] = start(job)
+            sleep(self.poll_interval)
+            for job, process in list(self.running.items()):
+                if not process.is_alive():
+                    process.join()
+                    del self.running[job]
+                    if process.exitcode == EXIT_REQUEUE:
+                        self.requeue(job)
+                    elif process.exitcode:
+                        any_fail = True
+        return any_fail
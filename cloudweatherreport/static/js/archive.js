@@ -0,0 +1,121 @@
+/*
+ * Viewer for reports which cwr has compacted into archives.
+ *
+ * The report is selected with the URL fragment, as in
+ *   archive.html#BUNDLE/YYYY-MM/TEST_ID
+ * Its offset and length are found in archive/BUNDLE/YYYY-MM.json, then just
+ * that gzip member of archive/BUNDLE/YYYY-MM.gz is fetched with a range
+ * request, decompressed, and shown in place of this page.  Other files of
+ * the report, such as its benchmarks.json, are selected by adding their
+ * name, as in archive.html#BUNDLE/YYYY-MM/TEST_ID/benchmarks.json, and
+ * links to them from the report are rewritten to do so.
+ */
+(function () {
+    'use strict';
+
+    function show_error(message) {
+        document.getElementById('archive-message').textContent = message;
+    }
+
+    function fetch_ok(url, options) {
+        return fetch(url, options).then(function (response) {
+            if (!response.ok) {
+                throw new Error('Unable to load ' + url);
+            }
+            return response;
+        });
+    }
+
+    function read_member(response, entry) {
+        if (response.status === 206) {
+            return response.blob();
+        }
+        // The server ignored the range, so take the member from the
+        // whole archive.
+        return response.blob().then(function (blob) {
+            return blob.slice(entry[0], entry[0] + entry[1]);
+        });
+    }
+
+    function gunzip(blob) {
+        var stream = blob.stream().pipeThrough(new DecompressionStream('gzip'));
+        return new Response(stream).text();
+    }
+
+    function escape_regexp(text) {
+        return text.replace(/[.*+?^${}()|[\]\\]/g, '\\$&');
+    }
+
+    function show_report(html, bundle, month, test_id) {
+        // Report pages use a <base> tag to link relative to the site root,
+        // which is the directory of this page.
+        var root = window.location.href.replace(/[#?].*$/, '')
+            .replace(/[^\/]*$/, '');
+        html = html.replace(/<base href="[^"]*">/,
+                            '<base href="' + root + '">');
+        // The report's own files were archived along with it.
+        html = html.replace(
+            new RegExp('href="' + escape_regexp(bundle + '/' + test_id + '/'),
+                       'g'),
+            'href="archive.html#' + bundle + '/' + month + '/' + test_id +
+                '/');
+        document.open();
+        document.write(html);
+        document.close();
+    }
+
+    function show_file(text, filename) {
+        var type = /\.json$/.test(filename) ? 'application/json' :
+            'text/plain';
+        window.location.replace(
+            URL.createObjectURL(new Blob([text], {type: type})));
+    }
+
+    function load() {
+        var match = /^#([^\/]+)\/([^\/]+)\/([^\/]+)(?:\/(.+))?$/.exec(
+            decodeURIComponent(window.location.hash));
+        if (!match) {
+            show_error('No archived report selected.');
+            return;
+        }
+        var bundle = match[1], month = match[2], test_id = match[3];
+        var filename = match[4] || 'report.html';
+        var archive = 'archive/' + bundle + '/' + month;
+        var member = test_id + '/' + filename;
+        var entry;
+        fetch_ok(archive + '.json', {cache: 'no-cache'})
+            .then(function (response) {
+                return response.json();
+            })
+            .then(function (lookup) {
+                entry = lookup[member];
+                if (!entry) {
+                    throw new Error(member + ' is not in ' + archive +
+                                    '.gz');
+                }
+                return fetch_ok(archive + '.gz', {headers: {
+                    Range: 'bytes=' + entry[0] + '-' +
+                        (entry[0] + entry[1] - 1)
+                }});
+            })
+            .then(function (response) {
+                return read_member(response, entry);
+            })
+            .then(gunzip)
+            .then(function (text) {
+                if (/\.html$/.test(filename)) {
+                    show_report(text, bundle, month, test_id);
+                } else {
+                    show_file(text, filename);
+                }
+            })
+            .catch(function (error) {
+                show_error(error.message);
+            });
+    }
+
+    window.addEventListener('hashchange', function () {
+        window.location.reload();
+    });
+    document.addEventListener('DOMContentLoaded', load);
+})();
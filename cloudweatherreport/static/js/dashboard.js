@@ -0,0 +1,272 @@
+/*
+ * Client-side rendered Cloud Weather Report dashboard.
+ *
+ * Renders the bundle summary, per-bundle result lists and the full list of
+ * recent results from the JSON indexes written by cwr, so that publishing a
+ * result only needs to update the JSON files.
+ *
+ * Runs still in progress, listed in running.json, are shown above the
+ * results with links to their progress files.
+ *
+ * Views are selected with the URL fragment:
+ *   index.html                      Latest result of every bundle
+ *   index.html#bundle=NAME&page=N   Results for a single bundle, where
+ *                                   N selects a page of older results
+ *   index.html#recent&page=N        All recent results
+ */
+(function () {
+    'use strict';
+
+    var PAGE_SIZE = 20;
+    var MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                  'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'];
+    var OUTCOMES = {
+        'PASS': ['pass', '✔'],
+        'FAIL': ['fail', '✘'],
+        'INFRA': ['cloud-fail', '▲']
+    };
+
+    function escape_html(value) {
+        return String(value === undefined || value === null ? '' : value)
+            .replace(/&/g, '&amp;')
+            .replace(/</g, '&lt;')
+            .replace(/>/g, '&gt;')
+            .replace(/"/g, '&quot;');
+    }
+
+    // Must match the file naming in cloudweatherreport.model.
+    function bundle_dir(bundle_name) {
+        return bundle_name.replace(/[^a-zA-Z0-9]/g, '_');
+    }
+
+    function report_filename(report) {
+        if (report.archive) {
+            // Must match ReportIndexItem.filename_html
+            return 'archive.html#' +
+                report.archive.replace(/^archive\/|\.gz$/g, '') + '/' +
+                report.test_id;
+        }
+        return [bundle_dir(report.bundle_name), report.test_id,
+                'report.html'].join('/');
+    }
+
+    function humanize_date(value) {
+        // Dates are serialized as %Y-%m-%dT%H:%M:%S
+        var m = /^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2})/.exec(value || '');
+        if (!m) {
+            return escape_html(value);
+        }
+        return MONTHS[parseInt(m[2], 10) - 1] + ' ' + m[3] + ', ' + m[1] +
+            ' at ' + m[4] + ':' + m[5];
+    }
+
+    function status_img(value) {
+        var outcome = OUTCOMES[value] || ['no-result', '◯'];
+        return '<span class="test-result ' + outcome[0] + '">' +
+            outcome[1] + '</span>';
+    }
+
+    function parse_hash() {
+        var params = {};
+        var parts = window.location.hash.replace(/^#/, '').split('&');
+        for (var i = 0; i < parts.length; i++) {
+            if (!parts[i]) {
+                continue;
+            }
+            var kv = parts[i].split('=');
+            params[decodeURIComponent(kv[0])] =
+                kv.length > 1 ? decodeURIComponent(kv[1]) : true;
+        }
+        return params;
+    }
+
+    function fetch_json(url, callback, errback) {
+        var request = new XMLHttpRequest();
+        errback = errback || function () {
+            show_error('Unable to load ' + url);
+        };
+        request.open('GET', url);
+        request.onload = function () {
+            if (request.status >= 200 && request.status < 300) {
+                callback(JSON.parse(request.responseText));
+            } else {
+                errback();
+            }
+        };
+        request.onerror = errback;
+        request.send();
+    }
+
+    function show_error(message) {
+        document.getElementById('dashboard-reports').innerHTML =
+            '<tr><td colspan="3">' + escape_html(message) + '</td></tr>';
+        document.getElementById('dashboard-pagination').innerHTML = '';
+    }
+
+    function results_cell(report, providers, href) {
+        var html = '<a href="' + href + '">';
+        for (var i = 0; i < providers.length; i++) {
+            html += '<table class="outcome">' +
+                '<tr><td>' + escape_html(providers[i]) + '</td></tr>' +
+                '<tr><td>' + status_img((report.results || {})[providers[i]]) +
+                '</td></tr></table>';
+        }
+        return html + '</a>';
+    }
+
+    function render_rows(rows, providers) {
+        var html = '';
+        for (var i = 0; i < rows.length; i++) {
+            var report = rows[i].report;
+            var report_href = escape_html(report_filename(report));
+            var name_href = escape_html(rows[i].href || report_filename(report));
+            html += '<tr class="result">' +
+                '<td class="bundle-name"><a href="' + name_href + '">' +
+                escape_html(report.bundle_name) + '</a></td>' +
+                '<td class="bundle-date"><a href="' + report_href + '">' +
+                humanize_date(report.date) + '</a></td>' +
+                '<td class="bundle-status">' +
+                results_cell(report, providers, report_href) + '</td>' +
+                '</tr>';
+        }
+        document.getElementById('dashboard-reports').innerHTML = html;
+    }
+
+    function render_pagination(view, page, page_count) {
+        var html = '';
+        if (page_count > 1) {
+            for (var p = 1; p <= page_count; p++) {
+                if (p === page) {
+                    html += '<strong>' + p + '</strong> ';
+                } else {
+                    html += '<a href="#' + view + '&page=' + p + '">' + p +
+                        '</a> ';
+                }
+            }
+        }
+        document.getElementById('dashboard-pagination').innerHTML = html;
+    }
+
+    function render_paged(view, reports, providers, page) {
+        var page_count = Math.max(1, Math.ceil(reports.length / PAGE_SIZE));
+        page = Math.min(Math.max(parseInt(page, 10) || 1, 1), page_count);
+        var rows = [];
+        var start = (page - 1) * PAGE_SIZE;
+        var page_reports = reports.slice(start, start + PAGE_SIZE);
+        for (var i = 0; i < page_reports.length; i++) {
+            rows.push({report: page_reports[i]});
+        }
+        render_rows(rows, providers);
+        render_pagination(view, page, page_count);
+    }
+
+    function set_title(title, results_title) {
+        document.getElementById('dashboard-title').textContent = title;
+        document.getElementById('dashboard-results-title').textContent =
+            results_title;
+    }
+
+    function show_summary() {
+        set_title('', 'Latest Test Results');
+        fetch_json('index.json', function (summary) {
+            var providers = {};
+            var rows = [];
+            for (var i = 0; i < summary.length; i++) {
+                var report = summary[i].latest_result;
+                for (var provider in report.results || {}) {
+                    providers[provider] = true;
+                }
+                rows.push({
+                    report: report,
+                    href: '#bundle=' + encodeURIComponent(summary[i].bundle_name)
+                });
+            }
+            render_rows(rows, Object.keys(providers).sort());
+            render_pagination('', 1, 1);
+        });
+    }
+
+    function show_bundle(bundle_name, page) {
+        // Older results are split into numbered pages, oldest first,
+        // alongside the bundle's main index of the most recent results.
+        page = parseInt(page, 10) || null;
+        var view = 'bundle=' + encodeURIComponent(bundle_name);
+        var filename = page ? 'index-' + page + '.json' : 'index.json';
+        set_title('Recent Results for ' + bundle_name +
+                  (page ? ' (page ' + page + ')' : ''), 'Test Results');
+        fetch_json(bundle_dir(bundle_name) + '/' + filename, function (index) {
+            var rows = [];
+            for (var i = 0; i < index.reports.length; i++) {
+                rows.push({report: index.reports[i]});
+            }
+            render_rows(rows, index.providers);
+            var pages = index.pages || [];
+            var html = '';
+            if (pages.length) {
+                html = 'Older results: ' + (page ?
+                    '<a href="#' + view + '">Latest</a> ' :
+                    '<strong>Latest</strong> ');
+                for (var p = 0; p < pages.length; p++) {
+                    if (pages[p] === page) {
+                        html += '<strong>' + pages[p] + '</strong> ';
+                    } else {
+                        html += '<a href="#' + view + '&page=' + pages[p] +
+                            '">' + pages[p] + '</a> ';
+                    }
+                }
+            }
+            document.getElementById('dashboard-pagination').innerHTML = html;
+        });
+    }
+
+    function show_recent(page) {
+        set_title('Recent Results', 'Test Results');
+        fetch_json('full_index.json', function (index) {
+            render_paged('recent', index.reports, index.providers, page);
+        });
+    }
+
+    function show_running(bundle_name) {
+        // running.json only exists once a run has started, and is
+        // informational, so failing to load it is not an error.
+        var element = document.getElementById('dashboard-running');
+        element.innerHTML = '';
+        fetch_json('running.json', function (running) {
+            var runs = [];
+            for (var filename in running) {
+                if (!bundle_name || running[filename].bundle === bundle_name) {
+                    runs.push(running[filename]);
+                }
+            }
+            if (!runs.length) {
+                return;
+            }
+            runs.sort(function (a, b) {
+                return a.started < b.started ? 1 : -1;
+            });
+            var html = '<h3>Running</h3><ul>';
+            for (var i = 0; i < runs.length; i++) {
+                html += '<li><a href="' + escape_html(runs[i].progress) +
+                    '">' + escape_html(runs[i].bundle) + ' on ' +
+                    escape_html(runs[i].provider) + '</a>, started ' +
+                    humanize_date(runs[i].started) + '</li>';
+            }
+            element.innerHTML = html + '</ul>';
+        }, function () {});
+    }
+
+    function route() {
+        var params = parse_hash();
+        show_running(params.bundle);
+        if (params.bundle) {
+            show_bundle(params.bundle, params.page);
+        } else if (params.recent) {
+            show_recent(params.page);
+        } else {
+            show_summary();
+        }
+    }
+
+    window.addEventListener('hashchange', route);
+    document.addEventListener('DOMContentLoaded', route);
+})();
@@ -0,0 +1,151 @@
+"""
+Local rendering of bundle diagrams.
+
+Draws the services of a bundle, placed by their gui-x / gui-y annotations,
+and the relations between them as an SVG, without needing the
+svg.juju.solutions service.
+"""
+from __future__ import unicode_literals
+
+import math
+from xml.sax.saxutils import (
+    escape,
+    quoteattr,
+)
+
+import yaml
+
+
+RADIUS = 60
+PADDING = 40
+SPACING = 300
+
+
+def _services(bundle):
+    if not isinstance(bundle, dict):
+        return {}, []
+    if 'services' not in bundle and 'applications' not in bundle and \
+            len(bundle) == 1:
+        # Old style bundle files wrap the bundle in a named deployment.
+        bundle = list(bundle.values())[0] or {}
+    services = bundle.get('services') or bundle.get('applications') or {}
+    return services, bundle.get('relations') or []
+
+
+def _relations(relations):
+    """
+    Yield pairs of related service names.
+    """
+    for relation in relations:
+        if not isinstance(relation, (list, tuple)) or len(relation) < 2:
+            continue
+        source = relation[0]
+        # Old style relations may list several targets for one source.
+        targets = relation[1]
+        if not isinstance(targets, (list, tuple)):
+            targets = relation[1:]
+        for target in targets:
+            yield source.split(':')[0], target.split(':')[0]
+
+
+def _position(service):
+    annotations = (service or {}).get('annotations') or {}
+    try:
+        return (float(annotations['gui-x']), float(annotations['gui-y']))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def layout(services):
+    """
+    Return the position of each service.
+
+    Services without gui-x / gui-y annotations are placed in a grid below
+    those which have them.
+    """
+    positions = {}
+    unplaced = []
+    for name in sorted(services):
+        position = _position(services[name])
+        if position is None:
+            unplaced.append(name)
+        else:
+            positions[name] = position
+    columns = int(math.ceil(math.sqrt(len(unplaced)))) or 1
+    top = max([y for _, y in positions.values()] or [-SPACING]) + SPACING
+    left = min([x for x, _ in positions.values()] or [0])
+    for i, name in enumerate(unplaced):
+        positions[name] = (left + (i % columns) * SPACING,
+                           top + (i // columns) * SPACING)
+    return positions
+
+
+def _charm_name(service):
+    charm = (service or {}).get('charm') or ''
+    name = charm.split('/')[-1].split(':')[-1]
+    # strip the revision from charm URLs, e.g. cs:trusty/mysql-42
+    parts = name.rsplit('-', 1)
+    if len(parts) == 2 and parts[1].isdigit():
+        name = parts[0]
+    return name
+
+
+def render(bundle_yaml):
+    """
+    Render a bundle YAML as an SVG diagram.
+
+    Returns None if the bundle has no services.
+    """
+    try:
+        bundle = yaml.safe_load(bundle_yaml)
+    except yaml.YAMLError:
+        return None
+    services, relations = _services(bundle)
+    if not services:
+        return None
+    positions = layout(services)
+    xs = [x for x, _ in positions.values()]
+    ys = [y for _, y in positions.values()]
+    margin = RADIUS + PADDING
+    min_x, min_y = min(xs) - margin, min(ys) - margin
+    width = max(xs) - min(xs) + 2 * margin
+    height = max(ys) - min(ys) + 2 * margin
+
+    lines = [
+        '<svg xmlns="http://www.w3.org/2000/svg" '
+        'viewBox="{:g} {:g} {:g} {:g}" width="{:g}" height="{:g}">'.format(
+            min_x, min_y, width, height, width, height),
+        '<g class="relations" stroke="#888888" stroke-width="3">',
+    ]
+    drawn = set()
+    for source, target in _relations(relations):
+        key = tuple(sorted([source, target]))
+        if source not in positions or target not in positions or \
+                key in drawn:
+            continue
+        drawn.add(key)
+        (x1, y1), (x2, y2) = positions[source], positions[target]
+        lines.append(
+            '<line x1="{:g}" y1="{:g}" x2="{:g}" y2="{:g}"/>'.format(
+                x1, y1, x2, y2))
+    lines.append('</g>')
+    lines.append('<g class="services" font-family="Ubuntu, sans-serif" '
+                 'text-anchor="middle">')
+    for name in sorted(positions):
+        x, y = positions[name]
+        charm = _charm_name(services[name])
+        lines.append('<g class="service" id={}>'.format(quoteattr(name)))
+        lines.append(
+            '<circle cx="{:g}" cy="{:g}" r="{}" fill="#ffffff" '
+            'stroke="#dd4814" stroke-width="4"/>'.format(x, y, RADIUS))
+        lines.append(
+            '<text x="{:g}" y="{:g}" font-size="18">{}</text>'.format(
+                x, y + 6, escape(charm or name)))
+        lines.append(
+            '<text x="{:g}" y="{:g}" font-size="16" fill="#333333">'
+            '{}</text>'.format(x, y + RADIUS + 24, escape(name)))
+        lines.append('</g>')
+    lines.append('</g>')
+    lines.append('</svg>')
+    svg = '\n'.join(lines) + '\n'
+    return svg.encode('utf8') if isinstance(svg, unicode) else svg
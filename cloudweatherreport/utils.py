@@ -1,35 +1,55 @@
 
 from contextlib import contextmanager
-from datetime import (
-    datetime,
-    timedelta,
-)
+from datetime import datetime
 import errno
-import jujuclient.juju1
-import jujuclient.juju2
+import hashlib
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+from pkg_resources import resource_string
 from shutil import rmtree
 import socket
 import subprocess
 import tempfile
 from tempfile import mkdtemp
-from time import sleep
+from time import (
+    sleep,
+    time,
+)
 import traceback
 import uuid
 import yaml
-import requests
 
-import jujuclient.juju1.environment
-import jujuclient.juju2.environment
-import jujuclient.juju1.facades
-import jujuclient.juju2.facades
+from cloudweatherreport import (
+    metrics,
+    svg,
+)
 
 
 PROVISIONING_ERROR_CODE = 240
 
 ISO_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
+DASHBOARD_FILES = {
+    'index.html': 'static/dashboard.html',
+    'js/dashboard.js': 'static/js/dashboard.js',
+}
+
+# Longest pause between polls of running actions, in seconds.
+ACTION_MAX_PAUSE_TIME = 10
+ACTION_FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+# Seconds to wait for svg.juju.solutions before using the local renderer.
+SVG_TIMEOUT = 30
+# Seconds for which svg.juju.solutions is not tried again after it failed to
+# answer.
+SVG_RETRY_AFTER = 10 * 60
+
+# Data store filenames of the SVGs known to be published.
+_svg_cache = set()
+# Time until which svg.juju.solutions is considered down.
+_svg_down_until = 0
+
 
 def get_bundle_yaml(status):
     if not status:
@@ -53,15 +73,68 @@ def serializer(obj):
         raise TypeError('%s is not serializable' % obj)
 
 
+def lttb(values, threshold):
+    """
+    Downsample a series using the Largest-Triangle-Three-Buckets algorithm.
+
+    `values` is a list of y values using the list index as the x value.
+    None values are gaps and are never selected.
+
+    Returns the sorted indices of at most `threshold` values which best
+    preserve the visual shape of the series.  The first and last values
+    are always kept.
+    """
+    points = [(i, v) for i, v in enumerate(values) if v is not None]
+    if len(points) <= threshold:
+        return [i for i, _ in points]
+    if threshold < 3:
+        return [i for i, _ in (points[:1] + points[-1:])[:threshold]]
+    selected = [points[0][0]]
+    bucket_size = float(len(points) - 2) / (threshold - 2)
+    prev = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        next_bucket = points[end:int((bucket + 2) * bucket_size) + 1]
+        next_bucket = next_bucket or points[-1:]
+        avg_x = sum(x for x, _ in next_bucket) / float(len(next_bucket))
+        avg_y = sum(y for _, y in next_bucket) / float(len(next_bucket))
+        prev_x, prev_y = points[prev]
+        max_area = -1
+        for i in range(start, end):
+            x, y = points[i]
+            area = abs((prev_x - avg_x) * (y - prev_y) -
+                       (prev_x - x) * (avg_y - prev_y))
+            if area > max_area:
+                max_area = area
+                prev = i
+        selected.append(points[prev][0])
+    selected.append(points[-1][0])
+    return selected
+
+
 def fetch_svg(bundle_yaml):
-    if not bundle_yaml:
+    """
+    Render a bundle with svg.juju.solutions.
+
+    If the service times out or fails, it is not tried again for
+    SVG_RETRY_AFTER seconds, so that saving a batch of results doesn't wait
+    for it once per result.
+    """
+    global _svg_down_until
+    if not bundle_yaml or time() < _svg_down_until:
         return None
+    import requests
     try:
-        r = requests.post('http://svg.juju.solutions', bundle_yaml)
+        r = requests.post('http://svg.juju.solutions', bundle_yaml,
+                          timeout=SVG_TIMEOUT)
     except Exception as e:
         logging.warn("Exception from svg.juju.solution for bundle.yaml:\n"
                      "{}\n{}".format(bundle_yaml, e))
+        _svg_down_until = time() + SVG_RETRY_AFTER
         return None
+    if r.status_code >= 500:
+        _svg_down_until = time() + SVG_RETRY_AFTER
     if r.status_code != requests.codes.ok:
         logging.warn("Could not generate svg. Response from "
                      "svg.juju.solutions: \n"
@@ -72,6 +145,50 @@ def fetch_svg(bundle_yaml):
     return r.content
 
 
+def svg_filename(bundle_yaml, renderer='remote'):
+    """
+    Data store filename of the cached SVG for a bundle.
+
+    SVGs drawn by the local renderer are cached separately, so that they
+    are replaced by the service's rendering once it is available.
+    """
+    if isinstance(bundle_yaml, unicode):
+        bundle_yaml = bundle_yaml.encode('utf8')
+    suffix = '' if renderer == 'remote' else '-' + renderer
+    return 'svg/{}{}.svg'.format(hashlib.sha256(bundle_yaml).hexdigest(),
+                                 suffix)
+
+
+def publish_svg(datastore, bundle_yaml, renderer='remote'):
+    """
+    Make sure the SVG for a bundle is in the data store, and return its
+    filename, or None if it could not be rendered.
+
+    SVGs are written once per distinct bundle, named by the hash of the
+    bundle YAML, and referenced by each report so that browsers can cache
+    them.  An in-process cache in front avoids checking the data store on
+    every save.  The `remote` renderer uses svg.juju.solutions, and falls
+    back to the `local` renderer if the service fails.
+    """
+    if not bundle_yaml:
+        return None
+    renderers = ['local'] if renderer == 'local' else ['remote', 'local']
+    for renderer in renderers:
+        filename = svg_filename(bundle_yaml, renderer)
+        if filename in _svg_cache or datastore.exists(filename):
+            _svg_cache.add(filename)
+            return filename
+        if renderer == 'local':
+            svg_data = svg.render(bundle_yaml)
+        else:
+            svg_data = fetch_svg(bundle_yaml)
+        if svg_data:
+            datastore.write(filename, svg_data, encoding=None)
+            _svg_cache.add(filename)
+            return filename
+    return None
+
+
 def read_file(file_path, file_type=None):
     deserializer = {'yaml': yaml.safe_load}
     with open(file_path) as stream:
@@ -81,39 +198,110 @@ def read_file(file_path, file_type=None):
     return content
 
 
-def run_action(client, unit, action, action_param=None, timeout=-1):
-    logging.debug(
-        'Action run - unit: {} action:{} param:{} timeout: {}'.format(
-            unit, action, action_param, timeout))
+def enqueue_action(client, unit, action, action_param=None):
+    """Enqueue an action on a unit and return the action's tag."""
     action_param = action_param or {}
     pending_action = client.enqueue_units(unit, action, action_param)
     if pending_action['results'][0].get('error'):
         raise Exception('Action failed {}'.format(
             pending_action['results'][0].get('error')))
-    result = wait_for_action_complete(
-        client, pending_action['results'][0]['action']['tag'], timeout=timeout)
+    return pending_action['results'][0]['action']['tag']
+
+
+def run_action(client, unit, action, action_param=None, timeout=-1):
+    logging.debug(
+        'Action run - unit: {} action:{} param:{} timeout: {}'.format(
+            unit, action, action_param, timeout))
+    tag = enqueue_action(client, unit, action, action_param)
+    result = wait_for_action_complete(client, tag, timeout=timeout)
     logging.debug('Action run completed. Result:\n{} '.format(result))
     return result['results'][0].get('output')
 
 
 def wait_for_action_complete(action, tag, timeout=-1, pause_time=.1):
     """Wait for action to complete. Use -1 to wait indefinitely."""
-    time_limit = datetime.now() + timedelta(seconds=timeout)
-    not_expired = True if timeout == -1 else datetime.now() < time_limit
-    result = None
-    while not_expired:
-        result = action.info([{'Tag': tag}])
-        if result['results'][0].get('error'):
-            raise ValueError(result['results'][0].get('error'))
-        if result['results'][0].get('status') == 'completed':
-            return result
-        if result['results'][0].get('status') == 'failed':
-            raise Exception('Action failed. Result: {}'.format(result))
-        sleep(pause_time)
-        not_expired = True if timeout == -1 else datetime.now() < time_limit
-    logging.debug('Action timeout:\nAction: {} \nTag: {} \nResult: {}'.format(
-        action, tag, result))
-    raise Exception('Timed out waiting for action to complete.')
+    results = wait_for_actions_complete(
+        action, [tag], timeout=timeout, pause_time=pause_time)
+    if tag not in results:
+        logging.debug('Action timeout:\nAction: {} \nTag: {}'.format(
+            action, tag))
+        raise Exception('Timed out waiting for action to complete.')
+    result = {'results': [results[tag]]}
+    if results[tag].get('error'):
+        raise ValueError(results[tag].get('error'))
+    if results[tag].get('status') != 'completed':
+        raise Exception('Action failed. Result: {}'.format(result))
+    return result
+
+
+def wait_for_actions_complete(action, tags, timeout=-1, pause_time=.1,
+                              max_pause_time=ACTION_MAX_PAUSE_TIME):
+    """Wait for a set of actions to finish. Use -1 to wait indefinitely.
+
+    All the unfinished actions are polled with a single info call.  The
+    pause between polls starts at pause_time and doubles while no action
+    finishes, up to max_pause_time, so that long running actions don't
+    hammer the controller.  The Juju API has no watcher for actions, so
+    they have to be polled.
+
+    Returns a dict of the tags of the actions which finished, successfully
+    or not, to their results.  Actions still running when the timeout
+    expires are left out.
+    """
+    time_limit = None if timeout == -1 else time() + timeout
+    pending = list(tags)
+    results = {}
+    pause = pause_time
+    polls = 0
+    while pending and (time_limit is None or time() < time_limit):
+        metrics.inc('cwr_action_polls_total')
+        info = action.info([{'Tag': tag} for tag in pending])
+        polls += 1
+        finished = False
+        for tag, result in zip(list(pending), info['results']):
+            if result.get('error') or \
+                    result.get('status') in ACTION_FINAL_STATUSES:
+                results[tag] = result
+                pending.remove(tag)
+                finished = True
+        if not pending:
+            break
+        pause = pause_time if finished else min(pause * 2, max_pause_time)
+        if time_limit is not None:
+            pause = max(0, min(pause, time_limit - time()))
+        sleep(pause)
+    logging.debug('Polled {} actions {} times, {} still pending'.format(
+        len(tags), polls, len(pending)))
+    return results
+
+
+def parallel_map(func, items, workers=16, description='items',
+                 progress_every=500):
+    """
+    Apply func to each item using a pool of threads.
+
+    Progress and throughput are logged every `progress_every` items.
+    Returns the results in completion order.
+    """
+    items = list(items)
+    if not items:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(items))))
+    results = []
+    start = time()
+    try:
+        for count, result in enumerate(pool.imap_unordered(func, items), 1):
+            results.append(result)
+            if count % progress_every == 0 or count == len(items):
+                elapsed = time() - start
+                logging.info('Processed {} of {} {} in {:.1f}s '
+                             '({:.1f}/s)'.format(
+                                 count, len(items), description, elapsed,
+                                 count / max(elapsed, 0.001)))
+    finally:
+        pool.close()
+        pool.join()
+    return results
 
 
 def mkdir_p(path):
@@ -220,6 +408,20 @@ def temp_tmpdir():
             tempfile.tempdir = tempdir
 
 
+@contextmanager
+def timed(timings, phase):
+    """
+    Add the time spent in the block, in seconds, to `timings[phase]`.
+    """
+    start = time()
+    try:
+        yield
+    finally:
+        elapsed = time() - start
+        timings[phase] = round(timings.get(phase, 0) + elapsed, 3)
+        metrics.observe('cwr_phase_seconds', elapsed, phase=phase)
+
+
 @contextmanager
 def chdir(path):
     orig = os.getcwd()
@@ -230,20 +432,37 @@ def chdir(path):
         os.chdir(orig)
 
 
+_juju_major_version = None
+
+
 def get_juju_major_version():
-    return int(subprocess.check_output(["juju", "version"]).split(b'.')[0])
+    """
+    Major version of the juju CLI, which is only probed once per process.
+    """
+    global _juju_major_version
+    if _juju_major_version is None:
+        _juju_major_version = int(
+            subprocess.check_output(["juju", "version"]).split(b'.')[0])
+    return _juju_major_version
 
 
 def get_versioned_juju_api(version=None):
     if version is None:
         version = get_juju_major_version()
-    return jujuclient.juju1 if version == 1 else jujuclient.juju2
+    # jujuclient is slow to import, and not needed by every command.
+    if version == 1:
+        import jujuclient.juju1.environment
+        import jujuclient.juju1.facades
+        return jujuclient.juju1
+    import jujuclient.juju2.environment
+    import jujuclient.juju2.facades
+    return jujuclient.juju2
 
 
-def connect_juju_client(env_name, retries=3, logging=None):
+def connect_juju_client(env_name, retries=3, logging=None, version=None):
     """Connect to jujuclient."""
     env = None
-    juju_client = get_versioned_juju_api().environment.Environment
+    juju_client = get_versioned_juju_api(version).environment.Environment
     for _ in xrange(retries):
         try:
             env = juju_client.connect(env_name=env_name)
@@ -282,11 +501,62 @@ def humanize_date(value, input_format=ISO_TIME_FORMAT):
     return value.strftime("%b %d, %Y at %H:%M")
 
 
-def write_to_datastore(datastore, index, update_summary=False):
+def write_to_datastore(datastore, index, update_summary=False, html=True):
     datastore.write(index.full_index_filename_json, index.as_json())
-    datastore.write(index.full_index_filename_html, index.as_html())
+    if html:
+        datastore.write(index.full_index_filename_html, index.as_html())
     datastore.write(index.summary_filename_json, index.summary_json())
-    datastore.write(index.summary_filename_html, index.summary_html())
+    if html:
+        datastore.write(index.summary_filename_html, index.summary_html())
+
+
+def write_bundle_index(datastore, index, bundle_name, page_size, html=True,
+                       reports=None, all_pages=False):
+    """
+    Write the index pages for a single bundle.
+
+    The `page_size` most recent results are written to the bundle's main
+    index, and the older history to numbered pages which no longer change
+    once they are full.  Unless `all_pages` is set, only the newest full
+    page (if it hasn't been written yet) and the pages listing the updated
+    `reports` are written along with the main index.
+    """
+    pages = set()
+    page_count = index.bundle_page_count(bundle_name, page_size)
+    if all_pages:
+        pages.update(range(1, page_count + 1))
+    elif page_count:
+        if not datastore.exists(
+                index.bundle_index_json(bundle_name, page_count)):
+            pages.add(page_count)
+        for report in reports or []:
+            pages.add(index.bundle_report_page(report, page_size))
+    pages.discard(None)
+    for page in [None] + sorted(pages):
+        if html:
+            datastore.write(
+                index.bundle_index_html(bundle_name, page),
+                index.as_html(bundle_name, limit=page_size, page=page))
+        datastore.write(
+            index.bundle_index_json(bundle_name, page),
+            index.as_json(bundle_name, limit=page_size, page=page))
+
+
+def write_dashboard(datastore, force=False):
+    """
+    Publish the static, client-side rendered dashboard.
+
+    The dashboard replaces the generated summary, full index and bundle
+    index pages by rendering the matching JSON files in the browser.  It
+    only needs to be written once, so unless `force` is set nothing is
+    written if it has already been published.
+    """
+    if not force and datastore.exists('js/dashboard.js'):
+        return False
+    for filename, resource in sorted(DASHBOARD_FILES.items()):
+        datastore.write(filename,
+                        resource_string(__name__, resource).decode('utf8'))
+    return True
 
 
 def juju_cmd(cmd):
@@ -0,0 +1,111 @@
+from datetime import datetime
+import json
+from unittest import TestCase
+
+from cloudweatherreport import (
+    archive,
+    model,
+)
+from cloudweatherreport.datastore import LocalDataStore
+from cloudweatherreport.utils import temp_dir
+
+
+class TestArchive(TestCase):
+
+    def make_item(self, bundle_name, test_id, date):
+        return model.ReportIndexItem(bundle_name=bundle_name, test_id=test_id,
+                                     date=date)
+
+    def test_archive_filename(self):
+        item = self.make_item('cs:foo', '1', datetime(2017, 3, 4))
+        self.assertEqual(archive.archive_filename(item),
+                         'archive/cs_foo/2017-03.gz')
+        self.assertEqual(archive.lookup_filename('archive/cs_foo/2017-03.gz'),
+                         'archive/cs_foo/2017-03.json')
+
+    def test_append_members(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            archive.append_members(ds, 'archive/foo/2017-01.gz', [
+                ('1/report.html', '<html>1</html>'),
+                ('1/report.json', '{}'),
+            ])
+            first = archive.read_lookup(ds, 'archive/foo/2017-01.gz')
+            lookup = archive.append_members(ds, 'archive/foo/2017-01.gz', [
+                ('1/report.html', '<html>1</html>'),
+                ('2/report.html', '<html>2</html>'),
+            ])
+            # unchanged members are not added again
+            self.assertEqual(lookup['1/report.html'], first['1/report.html'])
+            self.assertEqual(sorted(lookup),
+                             ['1/report.html', '1/report.json',
+                              '2/report.html'])
+            self.assertEqual(
+                json.loads(ds.read('archive/foo/2017-01.json')), lookup)
+            self.assertEqual(
+                archive.read_members(ds, 'archive/foo/2017-01.gz'), {
+                    '1/report.html': '<html>1</html>',
+                    '1/report.json': '{}',
+                    '2/report.html': '<html>2</html>',
+                })
+            # each member can be decompressed on its own
+            data = ds.read('archive/foo/2017-01.gz', encoding=None)
+            offset, length = lookup['2/report.html']
+            self.assertEqual(
+                archive.read_members(ds, 'archive/foo/2017-01.gz',
+                                     ['2/report.html']),
+                {'2/report.html': '<html>2</html>'})
+            self.assertEqual(len(data), offset + length)
+
+    def test_compact_reports(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            items = [self.make_item('foo', '1', datetime(2017, 1, 1)),
+                     self.make_item('foo', '2', datetime(2017, 2, 1)),
+                     self.make_item('foo', '3', datetime(2017, 2, 2))]
+            ds.write('foo/1/report.json', '{"test_id": "1"}')
+            ds.write('foo/1/report.html', 'html')
+            ds.write('foo/2/report.json', '{"test_id": "2"}')
+            ds.write('foo/index.json', '{}')
+
+            files = archive.compact_reports(ds, items, dry_run=True)
+            self.assertEqual(files, [('foo/1/report.html', 4),
+                                     ('foo/1/report.json', 16),
+                                     ('foo/2/report.json', 16)])
+            self.assertFalse(ds.exists('archive'))
+            self.assertEqual([item.archive for item in items],
+                             [None, None, None])
+
+            self.assertEqual(archive.compact_reports(ds, items), files)
+            self.assertEqual([item.archive for item in items],
+                             ['archive/foo/2017-01.gz',
+                              'archive/foo/2017-02.gz', None])
+            self.assertEqual(archive.read_report_json(ds, items[1]),
+                             '{"test_id": "2"}')
+            self.assertEqual(
+                sorted(archive.read_members(ds, 'archive/foo/2017-01.gz')),
+                ['1/report.html', '1/report.json'])
+
+    def test_compact_updated_report(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            item = self.make_item('foo', '1', datetime(2017, 1, 1))
+            ds.write('foo/1/report.json', '{"results": ["AWS"]}')
+            files = archive.compact_reports(ds, [item])
+            ds.delete_many([f for f, _ in files])
+            # a late result is written out as loose files again
+            item.archive = None
+            ds.write('foo/1/report.json', '{"results": ["AWS", "GCE"]}')
+            files = archive.compact_reports(ds, [item])
+            self.assertEqual(files, [('foo/1/report.json', 27)])
+            ds.delete_many([f for f, _ in files])
+            self.assertEqual(item.archive, 'archive/foo/2017-01.gz')
+            self.assertEqual(archive.read_report_json(ds, item),
+                             '{"results": ["AWS", "GCE"]}')
+
+    def test_write_viewer(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            self.assertIs(archive.write_viewer(ds), True)
+            self.assertIn('js/archive.js', ds.read('archive.html'))
+            self.assertIs(archive.write_viewer(ds), False)
@@ -169,6 +169,19 @@ class TestLocalDataStore(TestCase):
                 'path',
             ])
 
+    def test_list_recursive(self):
+        self.assertEqual(self.ds.list_recursive(), [
+            ('file1', 5),
+            ('file2', 5),
+            ('path/file3', 10),
+            ('path/file4', 10),
+        ])
+        self.assertEqual(self.ds.list_recursive('path'), [
+            ('path/file3', 10),
+            ('path/file4', 10),
+        ])
+        self.assertEqual(self.ds.list_recursive('other'), [])
+
     def test_exists(self):
         self.assertTrue(self.ds.exists('file1'))
         self.assertTrue(self.ds.exists('path/file3'))
@@ -193,6 +206,23 @@ class TestLocalDataStore(TestCase):
         self.ds.delete('test_del')
         assert not self.ds.exists('test_del')
 
+    def test_write_binary(self):
+        self.ds.write('binary', '\x1f\x8b\xff', encoding=None)
+        self.assertEqual(self.ds.read('binary', encoding=None),
+                         '\x1f\x8b\xff')
+        self.ds.delete('binary')
+
+    def test_delete_many(self):
+        self.ds.write('del/a/1', '')
+        self.ds.write('del/a/2', '')
+        self.ds.write('del/b', '')
+        self.ds.delete_many(['del/a/1', 'del/a/2', 'del/missing'])
+        self.assertFalse(os.path.exists(self.ds._path('del/a')))
+        self.assertTrue(self.ds.exists('del/b'))
+        self.ds.delete_many(['del/b'])
+        self.assertFalse(os.path.exists(self.ds._path('del')))
+        self.assertTrue(os.path.isdir(self.prefix))
+
     def test_lock(self):
         # test lock
         with self.ds.lock(timeout=1) as lock_id:
@@ -254,7 +284,7 @@ class TestS3DataStore(TestCase):
     def setUp(self):
         self.ds = datastore.S3DataStore('prefix', 'bucket', self.credsfile,
                                         True)
-        self.s3conn_p = mock.patch.object(datastore, 'S3Connection')
+        self.s3conn_p = mock.patch('boto.s3.connection.S3Connection')
         self.S3Connection = self.s3conn_p.start()
         self.addCleanup(self.s3conn_p.stop)
 
@@ -276,7 +306,7 @@ class TestS3DataStore(TestCase):
         assert not self.S3Connection.called
 
         self.S3Connection.return_value.lookup.return_value = None
-        self.ds._bucket = None
+        self.ds._local.bucket = None
         self.assertEqual(self.ds.bucket, 'new')
 
     def test_list(self):
@@ -303,6 +333,22 @@ class TestS3DataStore(TestCase):
             mock.call('prefix/path/', '/'),
         ])
 
+    def test_list_recursive(self):
+        def key(name, size):
+            key = mock.Mock(size=size)
+            key.name = name
+            return key
+
+        self.ds.bucket.list.return_value = [
+            key('prefix/path/file2', 2),
+            key('prefix/path/sub/file1', 1),
+        ]
+        self.assertEqual(self.ds.list_recursive('path'), [
+            ('path/file2', 2),
+            ('path/sub/file1', 1),
+        ])
+        self.ds.bucket.list.assert_called_once_with('prefix/path/')
+
     def test_exists(self):
         self.ds.bucket.get_key.side_effect = [None, mock.Mock()]
         self.assertFalse(self.ds.exists('file1'))
@@ -325,14 +371,61 @@ class TestS3DataStore(TestCase):
         key = self.ds.bucket.new_key.return_value
         key.set_contents_from_string.assert_called_once_with(
             'contents', {
-                'Content-Type': 'text/x-yaml',
-                'Content-Encoding': 'ascii',
+                'Content-Type': 'text/x-yaml; charset=ascii',
             })
 
+    def test_write_cache_control(self):
+        self.ds.write('bundle/test_id/report.json', 'contents')
+        key = self.ds.bucket.new_key.return_value
+        key.set_contents_from_string.assert_called_once_with(
+            'contents', {
+                'Content-Type': 'application/json; charset=utf-8',
+                'Cache-Control': 'public, max-age=60, must-revalidate',
+            })
+
+    def test_cache_control(self):
+        self.assertEqual(self.ds.cache_control('.lock.1234'), 'no-store')
+        self.assertEqual(self.ds.cache_control('index.json'),
+                         'public, max-age=60, must-revalidate')
+        self.assertEqual(self.ds.cache_control('full_index.html'),
+                         'public, max-age=60, must-revalidate')
+        self.assertEqual(self.ds.cache_control('bundle/index.html'),
+                         'public, max-age=60, must-revalidate')
+        self.assertEqual(self.ds.cache_control('bundle/test_id/report.html'),
+                         'public, max-age=60, must-revalidate')
+        self.assertEqual(
+            self.ds.cache_control('archive/bundle/2017-03.gz'),
+            'public, max-age=60, must-revalidate')
+        self.assertEqual(self.ds.cache_control('svg/1234.svg'),
+                         'public, max-age=31536000, immutable')
+        self.assertEqual(
+            self.ds.cache_control('bundle/test_id/progress-AWS.json'),
+            'public, max-age=10, must-revalidate')
+        self.assertEqual(self.ds.cache_control('running.json'),
+                         'public, max-age=10, must-revalidate')
+        self.assertEqual(self.ds.cache_control('css/base.css'),
+                         'public, max-age=3600')
+        self.assertIsNone(self.ds.cache_control('other.yaml'))
+
+    def test_cache_control_custom_policies(self):
+        ds = datastore.S3DataStore('prefix', 'bucket', self.credsfile, True,
+                                   cache_policies=[(r'\.json$', 'no-cache')])
+        self.assertEqual(ds.cache_control('bundle/index.json'), 'no-cache')
+        self.assertIsNone(ds.cache_control('bundle/index.html'))
+
     def test_delete(self):
         self.ds.delete('test_del')
         self.ds.bucket.delete_key.assert_called_once_with('prefix/test_del')
 
+    def test_delete_many(self):
+        self.ds.bucket.delete_keys.return_value.errors = []
+        self.ds.delete_many(['file%d' % i for i in range(1500)], workers=1)
+        self.assertEqual(self.ds.bucket.delete_keys.call_args_list, [
+            mock.call(['prefix/file%d' % i for i in range(1000)], quiet=True),
+            mock.call(['prefix/file%d' % i for i in range(1000, 1500)],
+                      quiet=True),
+        ])
+
     def test_age_in_seconds(self):
         self.ds.bucket.get_key.return_value = self.make_key()
         # 30 min diff from last_modified date
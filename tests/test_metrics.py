@@ -0,0 +1,129 @@
+import json
+import os
+from unittest import TestCase
+
+import mock
+
+from cloudweatherreport import metrics
+from cloudweatherreport.datastore import LocalDataStore
+from cloudweatherreport.utils import temp_dir
+
+
+class CheckedDataStore(LocalDataStore):
+
+    @metrics.datastore_operation('delete')
+    def delete(self, filename):
+        if self.exists(filename):
+            super(CheckedDataStore, self).delete(filename)
+
+
+class TestRegistry(TestCase):
+
+    def test_as_text(self):
+        registry = metrics.Registry()
+        registry.inc('cwr_runs_total', provider='AWS', outcome='PASS')
+        registry.inc('cwr_runs_total', provider='AWS', outcome='PASS')
+        registry.inc('cwr_runs_total', provider='GCE', outcome='FAIL')
+        registry.observe('cwr_phase_seconds', 1.5, phase='deploy')
+        registry.observe('cwr_phase_seconds', 2.0, phase='deploy')
+        registry.set('cwr_last_run_timestamp_seconds', 1000.5)
+        self.assertEqual(registry.as_text(), '\n'.join([
+            '# HELP cwr_last_run_timestamp_seconds When cwr last finished.',
+            '# TYPE cwr_last_run_timestamp_seconds gauge',
+            'cwr_last_run_timestamp_seconds 1000.5',
+            '# HELP cwr_phase_seconds Time spent in each phase of running '
+            'and publishing.',
+            '# TYPE cwr_phase_seconds summary',
+            'cwr_phase_seconds_count{phase="deploy"} 2',
+            'cwr_phase_seconds_sum{phase="deploy"} 3.5',
+            '# HELP cwr_runs_total Test plan runs, by provider and outcome.',
+            '# TYPE cwr_runs_total counter',
+            'cwr_runs_total{outcome="FAIL",provider="GCE"} 1',
+            'cwr_runs_total{outcome="PASS",provider="AWS"} 2',
+        ]) + '\n')
+
+    def test_label_escaping(self):
+        registry = metrics.Registry()
+        registry.inc('cwr_runs_total', provider='a"b\\c')
+        self.assertIn('cwr_runs_total{provider="a\\"b\\\\c"} 1',
+                      registry.as_text())
+
+    def test_merge(self):
+        registry = metrics.Registry()
+        registry.inc('cwr_action_polls_total', 2)
+        other = metrics.Registry()
+        other.inc('cwr_action_polls_total', 3)
+        other.observe('cwr_lock_wait_seconds', 1.0)
+        registry.merge(json.loads(json.dumps(other.as_dict())))
+        self.assertEqual(registry.values, {
+            ('cwr_action_polls_total', ()): 5,
+            ('cwr_lock_wait_seconds_sum', ()): 1.0,
+            ('cwr_lock_wait_seconds_count', ()): 1,
+        })
+        self.assertEqual(registry.types['cwr_lock_wait_seconds_sum'],
+                         'summary')
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        metrics.REGISTRY.clear()
+        self.addCleanup(metrics.REGISTRY.clear)
+
+    def test_datastore_operations(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            ds.write('a.json', u'\xe9')
+            ds.read('a.json')
+            ds.exists('a.json')
+            with ds.lock():
+                pass
+        values = metrics.REGISTRY.values
+        store = (('operation', 'write'), ('store', 'LocalDataStore'))
+        # the lock file is written too
+        self.assertEqual(
+            values[('cwr_datastore_operations_seconds_count', store)], 2)
+        self.assertEqual(
+            values[('cwr_datastore_written_bytes_total',
+                    (('store', 'LocalDataStore'),))], 2)
+        self.assertEqual(values[('cwr_lock_wait_seconds_count', ())], 1)
+        self.assertEqual(values[('cwr_lock_hold_seconds_count', ())], 1)
+
+    def test_nested_datastore_operations(self):
+        with temp_dir() as tmp:
+            ds = CheckedDataStore(tmp)
+            ds.write('a.json', '')
+            metrics.REGISTRY.clear()
+            ds.delete('a.json')
+        self.assertEqual(
+            [key for key in metrics.REGISTRY.values
+             if key[0] == 'cwr_datastore_operations_seconds_count'],
+            [('cwr_datastore_operations_seconds_count',
+              (('operation', 'delete'), ('store', 'CheckedDataStore')))])
+
+    def test_write_textfile(self):
+        with temp_dir() as tmp:
+            with mock.patch('tempfile.tempdir', tmp), \
+                    mock.patch.object(metrics, '_spool_dir', None):
+                metrics.start_export()
+                with metrics.child_process():
+                    metrics.inc('cwr_action_polls_total', 3)
+                # the parent's own metrics
+                metrics.REGISTRY.clear()
+                metrics.inc('cwr_action_polls_total')
+                filename = os.path.join(tmp, 'cwr.prom')
+                registry = metrics.write_textfile(filename)
+                metrics.stop_export()
+                self.assertIsNone(metrics._spool_dir)
+            with open(filename) as fp:
+                text = fp.read()
+            self.assertEqual(os.listdir(tmp), ['cwr.prom'])
+        self.assertEqual(registry.values[('cwr_action_polls_total', ())], 4)
+        self.assertIn('cwr_action_polls_total 4\n', text)
+        self.assertIn('cwr_last_run_timestamp_seconds ', text)
+
+    def test_child_process_without_export(self):
+        metrics.inc('cwr_action_polls_total')
+        with mock.patch.object(metrics, '_spool_dir', None):
+            with metrics.child_process():
+                self.assertEqual(metrics.REGISTRY.values, {})
@@ -1,4 +1,4 @@
-import os
+import json
 import re
 from unittest import TestCase
 from datetime import datetime
@@ -299,6 +299,23 @@ class TestTestPlan(TestCase):
             ),
         ])
 
+    def test_from_dict_isolated_benchmark(self):
+        plan = model.TestPlan.from_dict({
+            'bundle': 'bundle_name',
+            'benchmark': {
+                'unit/0': {
+                    'name1': {'param': 'value1', 'cwr-isolated': True},
+                    'name2': None,
+                },
+            },
+        })
+        benchmarks = sorted(plan.benchmarks, key=lambda b: b.action)
+        self.assertEqual(benchmarks, [
+            model.BenchmarkPlan(unit='unit/0', action='name1',
+                                params={'param': 'value1'}, isolated=True),
+            model.BenchmarkPlan(unit='unit/0', action='name2'),
+        ])
+
     @mock.patch.object(model, 'Report')
     def test_report_filename(self, mReport):
         mReport.return_value.filename_json = 'report.json'
@@ -467,6 +484,44 @@ class TestBenchmark(TestCase):
                 },
             ]})
 
+    def test_as_chart_downsampled(self):
+        bm = model.Benchmark(name='terasort')
+        for i in range(100):
+            provider_results = [
+                model.BenchmarkProviderResult(provider='aws', value=float(i))]
+            if i % 2:
+                provider_results.append(
+                    model.BenchmarkProviderResult(provider='gce',
+                                                  value=float(i % 7)))
+            bm.results.append(model.BenchmarkResult(
+                test_id='test_{}'.format(i),
+                provider_results=provider_results))
+        chart = bm.as_chart(max_points=10)
+        self.assertIs(chart['downsampled'], True)
+        self.assertLessEqual(len(chart['labels']), 20)
+        self.assertEqual(chart['labels'][0], 'test_0')
+        self.assertEqual(chart['labels'][-1], 'test_99')
+        self.assertEqual(chart['min'], 0.0)
+        self.assertEqual(chart['max'], 99.0)
+        for dataset in chart['datasets']:
+            self.assertEqual(len(dataset['data']), len(chart['labels']))
+        self.assertNotIn('downsampled', bm.as_chart(max_points=100))
+
+    def test_as_chart_downsampled_all_points(self):
+        # the points kept for each provider cover all of the results
+        bm = model.Benchmark(name='terasort', results=[
+            model.BenchmarkResult(test_id='test_0', provider_results=[
+                model.BenchmarkProviderResult(provider='aws', value=0.0)]),
+            model.BenchmarkResult(test_id='test_1', provider_results=[
+                model.BenchmarkProviderResult(provider='aws', value=1.0),
+                model.BenchmarkProviderResult(provider='gce', value=1.0)]),
+            model.BenchmarkResult(test_id='test_2', provider_results=[
+                model.BenchmarkProviderResult(provider='gce', value=2.0)]),
+        ])
+        chart = bm.as_chart(max_points=2)
+        self.assertEqual(chart['labels'], ['test_0', 'test_1', 'test_2'])
+        self.assertNotIn('downsampled', chart)
+
     @mock.patch.object(model.Benchmark, 'as_chart')
     def test_as_char_json(self, as_chart):
         as_chart.return_value = {
@@ -674,9 +729,6 @@ class TestReport(TestCase):
         self.assertEqual(report.benchmarks, [bm, bm2])
 
     def test_as_html_xml(self):
-        test_dir = os.path.dirname(__file__)
-        with open(os.path.join(test_dir, 'data/hadoop-processing.svg')) as fp:
-            svg_data = fp.read()
         report = model.Report(
             test_id='test2',
             bundle=model.BundleInfo(name='cs:my-bundle'),
@@ -809,9 +861,15 @@ class TestReport(TestCase):
         self.assertEqual(soup.title.text, 'cs:my-bundle')
         self.assertIn("display_chart(1, {", html)
         self.assertIn("display_chart(2, {", html)
-        html = report.as_html(svg_data)
+        self.assertNotIn('Full data', html)
+        html = report.as_html('svg/1234.svg', chart_points=3)
+        self.assertIn('Showing 3 of 4 results', html)
+        self.assertIn('cs_my_bundle/test2/benchmarks.json', html)
+        self.assertEqual(
+            [chart['title'] for chart in json.loads(report.benchmarks_json())],
+            ['bench1', 'bench2'])
         self.assertNotIn('Image not available', html)
-        self.assertIn('src="data:image/svg+xml;base64,', html)
+        self.assertIn('<img src="svg/1234.svg"', html)
         xml = report.as_xml()
         self.assertIn('Some other output', xml)
         self.assertIn('testsuite', xml)
@@ -1047,6 +1105,27 @@ class TestReportIndexItem(TestCase):
         self.assertEqual(rii.bundle_name, 'bundle')
         self.assertEqual(rii.date, report.date)
         self.assertEqual(rii.results, {'aws': 'PASS', 'gce': 'FAIL'})
+        self.assertEqual(rii.timings, {})
+
+    def test_from_report_timings(self):
+        report = model.Report(
+            test_id='test_id',
+            bundle=model.BundleInfo(name='bundle'),
+            date=datetime.now(),
+            results=[
+                model.SuiteResult(provider='aws', test_outcome='PASS',
+                                  timings={'deploy': 600.5, 'tests': 60}),
+                model.SuiteResult(provider='gce', test_outcome='FAIL'),
+            ])
+        report.timings = {'load': 1.5}
+        rii = model.ReportIndexItem.from_report(report)
+        self.assertEqual(rii.timings, {'aws': 660.5})
+        self.assertEqual(rii.publish_timings, {'load': 1.5})
+        report.results[1].timings = {'connect': 2}
+        report.timings = {'load': 0.5, 'svg': 3}
+        rii.update_from_report(report)
+        self.assertEqual(rii.timings, {'aws': 660.5, 'gce': 2})
+        self.assertEqual(rii.publish_timings, {'load': 0.5, 'svg': 3})
 
     def test_update_from_report(self):
         report = model.Report(
@@ -1301,3 +1380,81 @@ class TestReportIndex(TestCase):
                 re.sub('\n+', ' ', tds[2].text.strip()),
                 tds[0].find('a')['href'],
             ))
+
+    def test_from_reports(self):
+        reports = [
+            model.Report(test_id='test1',
+                         bundle=model.BundleInfo(name='foo'),
+                         date=datetime(2000, 1, 1),
+                         results=[model.SuiteResult(provider='gce',
+                                                    test_outcome='PASS')]),
+            model.Report(test_id='test2',
+                         bundle=model.BundleInfo(name='foo'),
+                         date=datetime(2000, 1, 2),
+                         results=[model.SuiteResult(provider='aws',
+                                                    test_outcome='FAIL')]),
+            model.Report(test_id='test1',
+                         bundle=model.BundleInfo(name='foo'),
+                         date=datetime(2000, 1, 1)),
+        ]
+        index = model.ReportIndex.from_reports(reports)
+        self.assertEqual([r.test_id for r in index.reports],
+                         ['test2', 'test1'])
+        self.assertEqual(index.reports[1].results, {'gce': 'PASS'})
+        self.assertEqual(index.providers, ['aws', 'gce'])
+
+    def _paged_index(self):
+        ri = model.ReportIndex(providers=['aws'])
+        for i in range(1, 8):
+            ri.upsert_report(model.Report(
+                test_id='test{}'.format(i),
+                bundle=model.BundleInfo(name='cs:bundle1'),
+                date=datetime(2000, 1, i),
+                results=[model.SuiteResult(provider='aws',
+                                           test_outcome='PASS')]))
+        ri.upsert_report(model.Report(
+            test_id='other',
+            bundle=model.BundleInfo(name='cs:bundle2'),
+            date=datetime(2000, 1, 1)))
+        return ri
+
+    def test_bundle_pages(self):
+        ri = self._paged_index()
+        self.assertEqual(ri.bundle_page_count('cs:bundle1', 3), 2)
+        self.assertEqual(ri.bundle_page_count('cs:bundle1', None), 0)
+        self.assertEqual(
+            [r.test_id for r in ri.bundle_page('cs:bundle1', 1, 3)],
+            ['test3', 'test2', 'test1'])
+        self.assertEqual(
+            [r.test_id for r in ri.bundle_page('cs:bundle1', 2, 3)],
+            ['test6', 'test5', 'test4'])
+        report = model.Report(test_id='test2',
+                              bundle=model.BundleInfo(name='cs:bundle1'))
+        self.assertEqual(ri.bundle_report_page(report, 3), 1)
+        report.test_id = 'test7'
+        self.assertIsNone(ri.bundle_report_page(report, 3))
+        self.assertEqual(ri.bundle_index_json('cs:bundle1', 2),
+                         'cs_bundle1/index-2.json')
+        self.assertEqual(ri.bundle_index_html('cs:bundle1'),
+                         'cs_bundle1/index.html')
+
+    def test_as_json_pages(self):
+        ri = self._paged_index()
+        data = json.loads(ri.as_json('cs:bundle1', limit=3))
+        self.assertEqual([r['test_id'] for r in data['reports']],
+                         ['test7', 'test6', 'test5'])
+        self.assertEqual(data['pages'], [2, 1])
+        data = json.loads(ri.as_json('cs:bundle1', limit=3, page=1))
+        self.assertEqual([r['test_id'] for r in data['reports']],
+                         ['test3', 'test2', 'test1'])
+        self.assertNotIn('pages', json.loads(ri.as_json()))
+
+    def test_as_html_pages(self):
+        ri = self._paged_index()
+        soup = BeautifulSoup(ri.as_html('cs:bundle1', limit=3, page=2),
+                             'html.parser')
+        self.assertEqual(len(soup.find_all('tr', class_='result')), 3)
+        links = [a['href'] for a in soup.find('div', class_='pagination')
+                 .find_all('a')]
+        self.assertEqual(links, ['cs_bundle1/index.html',
+                                 'cs_bundle1/index-1.html'])
@@ -0,0 +1,77 @@
+import argparse
+import os
+import pstats
+import sys
+from unittest import TestCase
+
+import mock
+
+from cloudweatherreport import profiling
+from cloudweatherreport.utils import temp_dir
+
+
+def busy():
+    return sum(i * i for i in range(200000))
+
+
+class Leak(object):
+    pass
+
+
+class TestProfiling(TestCase):
+
+    def test_profiled_disabled(self):
+        with temp_dir() as tmp:
+            args = argparse.Namespace(profile=False, results_dir=tmp)
+            with profiling.profiled(args, 'job'):
+                busy()
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'profile')))
+
+    def test_profiled(self):
+        with temp_dir() as tmp:
+            args = argparse.Namespace(profile=True, results_dir=tmp)
+            with profiling.profiled(args, 'job'):
+                # nested blocks are covered by the outer profile
+                with profiling.profiled(args, 'publish'):
+                    busy()
+            files = sorted(os.listdir(os.path.join(tmp, 'profile')))
+            pid = os.getpid()
+            expected = ['job-{}.pstats'.format(pid)]
+            if profiling.StackSampler.available():
+                expected.insert(0, 'job-{}.collapsed'.format(pid))
+            self.assertEqual(files, expected)
+            stats = pstats.Stats(profiling.profile_filename(
+                tmp, 'job', 'pstats'))
+            self.assertTrue(any(func[2] == 'busy' for func in stats.stats))
+        self.assertEqual(profiling._active, [])
+
+    def test_stack_sampler(self):
+        sampler = profiling.StackSampler()
+        sampler.sample(None, sys._getframe())
+        sampler.sample(None, sys._getframe())
+        lines = sampler.collapsed().splitlines()
+        self.assertEqual(len(lines), 1)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertEqual(count, '2')
+        self.assertTrue(stack.endswith(
+            'test_profiling.py:test_stack_sampler:{}'.format(
+                self.test_stack_sampler.__func__.__code__.co_firstlineno)))
+
+    def test_traced_malloc_without_tracemalloc(self):
+        with temp_dir() as tmp:
+            args = argparse.Namespace(trace_malloc=True, results_dir=tmp)
+            with mock.patch.dict(sys.modules, {'tracemalloc': None}):
+                with profiling.traced_malloc(args, 'publish'):
+                    kept = [Leak() for _ in range(1000)]
+            with open(profiling.profile_filename(
+                    tmp, 'publish', 'malloc.txt')) as fp:
+                lines = fp.read().splitlines()
+        self.assertEqual(len(kept), 1000)
+        self.assertIn('Leak: 1000 (+1000)', lines)
+        self.assertEqual(lines[-1], '')
+
+    def test_object_growth(self):
+        self.assertEqual(
+            profiling.object_growth({'dict': 10, 'list': 5},
+                                    {'dict': 12, 'list': 5, 'Report': 3}),
+            ['Report: 3 (+3)', 'dict: 12 (+2)'])
@@ -0,0 +1,142 @@
+import json
+from unittest import TestCase
+
+import mock
+
+from cloudweatherreport import progress
+
+with mock.patch('deployer.utils.get_juju_major_version', return_value=1):
+    # deployer (from bundletester) tries to call out to Juju CLI on import
+    from bundletester import reporter
+from cloudweatherreport.datastore import LocalDataStore
+from cloudweatherreport.utils import temp_dir
+
+
+def make_progress(datastore, interval=progress.PROGRESS_INTERVAL):
+    return progress.Progress(
+        datastore, 'git/1234/progress-AWS.json', '1234', 'git', 'AWS',
+        interval=interval)
+
+
+class TestProgress(TestCase):
+
+    def test_progress_filename(self):
+        self.assertEqual(
+            progress.progress_filename('git/1234/report.json', 'AWS'),
+            'git/1234/progress-AWS.json')
+        self.assertEqual(
+            progress.progress_filename('git/1234/report.json', 'Joyent/X'),
+            'git/1234/progress-Joyent_X.json')
+
+    def test_start(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            make_progress(ds).start()
+            data = json.loads(ds.read('git/1234/progress-AWS.json'))
+        self.assertEqual(data['status'], progress.RUNNING)
+        self.assertEqual(data['tests'], [])
+        self.assertEqual(data['test_outcome'], 'NONE')
+        self.assertEqual(data['provider'], 'AWS')
+
+    def test_start_lists_running(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            make_progress(ds).start()
+            running = json.loads(ds.read(progress.RUNNING_FILENAME))
+        self.assertEqual(running.keys(), ['git/1234/progress-AWS.json'])
+        run = running['git/1234/progress-AWS.json']
+        self.assertEqual(run['progress'], 'git/1234/progress-AWS.json')
+        self.assertEqual(run['bundle'], 'git')
+        self.assertEqual(run['test_id'], '1234')
+        self.assertEqual(run['provider'], 'AWS')
+
+    def test_add(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            prog = make_progress(ds)
+            prog.start()
+            with mock.patch('cloudweatherreport.progress.time',
+                            return_value=prog.published + 1):
+                prog.add({'test': 'charm-proof', 'returncode': 0,
+                          'output': 'ok', 'duration': 1.5,
+                          'suite': 'git'})
+            # Throttled, the progress file is not updated yet.
+            data = json.loads(ds.read('git/1234/progress-AWS.json'))
+            self.assertEqual(data['tests'], [])
+            with mock.patch('cloudweatherreport.progress.time',
+                            return_value=prog.published + 31):
+                prog.add({'test': 'test_01', 'returncode': 1,
+                          'output': 'failed', 'duration': 2.0,
+                          'suite': 'git'})
+            data = json.loads(ds.read('git/1234/progress-AWS.json'))
+        self.assertEqual(data['status'], progress.RUNNING)
+        self.assertEqual(data['test_outcome'], 'FAIL')
+        self.assertEqual(data['tests'], [
+            {'name': 'charm-proof', 'suite': 'git', 'result': 'PASS',
+             'duration': 1.5},
+            {'name': 'test_01', 'suite': 'git', 'result': 'FAIL',
+             'duration': 2.0},
+        ])
+
+    def test_finish(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            prog = make_progress(ds)
+            prog.add({'test': 'test_01', 'returncode': 0, 'output': 'ok',
+                      'duration': 2.0, 'suite': 'git'})
+            prog.finish('PASS')
+            data = json.loads(ds.read('git/1234/progress-AWS.json'))
+        self.assertEqual(data['status'], progress.FINISHED)
+        self.assertEqual(data['test_outcome'], 'PASS')
+        self.assertEqual(len(data['tests']), 1)
+
+    def test_finish_removes_running(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            other = progress.Progress(
+                ds, 'git/1234/progress-GCE.json', '1234', 'git', 'GCE')
+            other.start()
+            prog = make_progress(ds)
+            prog.start()
+            prog.finish('PASS')
+            running = json.loads(ds.read(progress.RUNNING_FILENAME))
+        self.assertEqual(running.keys(), ['git/1234/progress-GCE.json'])
+
+    def test_read_running_drops_expired(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            progress.write_running(ds, {
+                'old': {'expires': 100},
+                'new': {'expires': 300},
+            })
+            self.assertEqual(progress.read_running(ds, now=200),
+                             {'new': {'expires': 300}})
+            ds.write(progress.RUNNING_FILENAME, 'not json')
+            self.assertEqual(progress.read_running(ds), {})
+
+    def test_update_running_error(self):
+        ds = mock.MagicMock()
+        ds.exists.side_effect = IOError('denied')
+        with mock.patch('logging.exception') as log:
+            self.assertFalse(make_progress(ds).update_running(True))
+        self.assertTrue(log.called)
+
+    def test_publish_error(self):
+        ds = mock.Mock()
+        ds.write.side_effect = IOError('denied')
+        with mock.patch('logging.exception') as log:
+            self.assertFalse(make_progress(ds).publish(progress.RUNNING))
+        self.assertTrue(log.called)
+
+    def test_streaming_reporter(self):
+        name = progress.register_reporter()
+        self.assertEqual(progress.register_reporter(), name)
+        options = mock.Mock(on_test_result=mock.Mock(), on_suite=mock.Mock())
+        rep = reporter.get_reporter(name, mock.Mock(), options)
+        suite = mock.Mock(model={'bundle': None, 'metadata': None})
+        rep.set_suite(suite)
+        self.assertEqual(options.on_suite.call_count, 1)
+        rep.emit({'test': 'test_01', 'returncode': 0})
+        options.on_test_result.assert_called_once_with(
+            {'test': 'test_01', 'returncode': 0})
+        self.assertEqual(len(rep.messages), 1)
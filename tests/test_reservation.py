@@ -0,0 +1,65 @@
+import json
+from unittest import TestCase
+
+import mock
+
+from cloudweatherreport import reservation
+from cloudweatherreport.datastore import LocalDataStore
+from cloudweatherreport.utils import temp_dir
+
+
+class TestReservation(TestCase):
+
+    def test_read_ledger_missing(self):
+        with temp_dir() as tmp:
+            self.assertEqual(reservation.read_ledger(LocalDataStore(tmp)), {})
+
+    def test_read_ledger_drops_expired(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            ds.write(reservation.LEDGER_FILENAME, json.dumps({
+                'old': {'cloud': 'aws', 'region': 'us-east-1',
+                        'machines': 1, 'cpus': 1, 'expires': 100},
+                'live': {'cloud': 'aws', 'region': 'us-east-1',
+                         'machines': 2, 'cpus': 4, 'expires': 300},
+            }))
+            ledger = reservation.read_ledger(ds, now=200)
+        self.assertEqual(list(ledger), ['live'])
+
+    def test_read_ledger_invalid(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            ds.write(reservation.LEDGER_FILENAME, 'not json')
+            self.assertEqual(reservation.read_ledger(ds), {})
+
+    def test_reserved(self):
+        ledger = {
+            '1': {'cloud': 'aws', 'region': 'us-east-1', 'machines': 2,
+                  'cpus': 4},
+            '2': {'cloud': 'aws', 'region': 'us-east-1', 'machines': 3,
+                  'cpus': None},
+            '3': {'cloud': 'aws', 'region': 'us-west-2', 'machines': 5,
+                  'cpus': 5},
+        }
+        self.assertEqual(reservation.reserved(ledger, 'aws', 'us-east-1'),
+                         {'machines': 5, 'cpus': 4})
+        self.assertEqual(reservation.reserved(ledger, 'google', 'us-east1'),
+                         {'machines': 0, 'cpus': 0})
+
+    @mock.patch('cloudweatherreport.reservation.time', return_value=1000)
+    def test_reserve_and_release(self, mtime):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            reservation.reserve(ds, '1', 'aws', 'us-east-1', 2, 4, ttl=60)
+            reservation.reserve(ds, '2', 'aws', 'us-east-1', 1, 1, ttl=60)
+            ledger = reservation.read_ledger(ds)
+            self.assertEqual(sorted(ledger), ['1', '2'])
+            self.assertEqual(ledger['1']['expires'], 1060)
+            self.assertEqual(
+                reservation.reserved(ledger, 'aws', 'us-east-1'),
+                {'machines': 3, 'cpus': 5})
+            self.assertTrue(reservation.release(ds, '1'))
+            self.assertFalse(reservation.release(ds, '1'))
+            self.assertEqual(list(reservation.read_ledger(ds)), ['2'])
+            mtime.return_value = 1061
+            self.assertEqual(reservation.read_ledger(ds), {})
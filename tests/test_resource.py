@@ -7,6 +7,7 @@ from yaml import safe_load
 
 from cloudweatherreport.cloudresource.resource import (
     get_credentials,
+    get_resource_limits,
     is_resource_available,
     CloudNotSupported,
     UnknownCloudName,
@@ -190,3 +191,15 @@ class TestIsResourceAvailable(TestCase):
         with self.assertRaisesRegexp(
                 CloudNotSupported, 'Tenant ID is required'):
             is_resource_available('azure', 'westus', 1, 1, 1)
+
+    def test_get_resource_limits(self):
+        with patch.dict(os.environ, {'GOOGLE_CPU_LIMIT': '8',
+                                     'AWS_MACHINE_LIMIT': 'bad'}):
+            self.assertEqual(get_resource_limits('aws'),
+                             {'machines': 20, 'cpus': None})
+            self.assertEqual(get_resource_limits('google'),
+                             {'machines': 200, 'cpus': 8})
+            self.assertEqual(get_resource_limits('azure'),
+                             {'machines': 60, 'cpus': 20})
+            self.assertEqual(get_resource_limits('lxd'),
+                             {'machines': None, 'cpus': None})
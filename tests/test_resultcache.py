@@ -0,0 +1,84 @@
+import json
+from unittest import TestCase
+
+from cloudweatherreport import (
+    model,
+    resultcache,
+)
+from cloudweatherreport.datastore import LocalDataStore
+from cloudweatherreport.utils import temp_dir
+
+
+class TestResultCache(TestCase):
+
+    def setUp(self):
+        self.plan = model.TestPlan(bundle='git', bundle_name='git',
+                                   tests=['test_01'])
+        self.result = model.SuiteResult(provider='AWS', test_outcome='PASS',
+                                        bundle_yaml='services: {}')
+
+    def test_cache_key(self):
+        key = resultcache.cache_key('services: {}', 'AWS', self.plan)
+        self.assertEqual(len(key), 64)
+        self.assertEqual(
+            key, resultcache.cache_key(u'services: {}', 'AWS', self.plan))
+        self.assertNotEqual(
+            key, resultcache.cache_key('services: {a: {}}', 'AWS',
+                                       self.plan))
+        self.assertNotEqual(
+            key, resultcache.cache_key('services: {}', 'GCE', self.plan))
+        other_plan = model.TestPlan(bundle='git', bundle_name='git',
+                                    tests=['test_02'])
+        self.assertNotEqual(
+            key, resultcache.cache_key('services: {}', 'AWS', other_plan))
+        labelled = model.TestPlan(bundle='git', bundle_name='git',
+                                  tests=['test_01'], test_label='nightly')
+        self.assertEqual(
+            key, resultcache.cache_key('services: {}', 'AWS', labelled))
+
+    def test_is_pinned(self):
+        self.assertTrue(resultcache.is_pinned(
+            'services: {a: {charm: "cs:xenial/mysql-57"},'
+            ' b: {charm: "cs:~user/wordpress-3"}}'))
+        self.assertTrue(resultcache.is_pinned(
+            'applications: {a: {charm: "cs:xenial/mysql-57"}}'))
+        self.assertTrue(resultcache.is_pinned(
+            'wiki: {services: {a: {charm: "cs:xenial/mysql-57"}}}'))
+        self.assertFalse(resultcache.is_pinned(
+            'services: {a: {charm: "cs:xenial/mysql-57"},'
+            ' b: {charm: "cs:~user/wordpress"}}'))
+        self.assertFalse(resultcache.is_pinned(
+            'services: {a: {charm: "local:xenial/mysql-1"}}'))
+        self.assertFalse(resultcache.is_pinned('services: {}'))
+        self.assertFalse(resultcache.is_pinned('services: ['))
+
+    def test_store_and_lookup(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            self.assertIsNone(resultcache.lookup(ds, 'key', 60))
+            self.assertTrue(resultcache.store(ds, 'key', '1234',
+                                              self.result))
+            entry = json.loads(ds.read('cache/key.json'))
+            result = resultcache.lookup(ds, 'key', 60)
+            self.assertEqual(result.cached_from, '1234')
+            self.assertEqual(result.bundle_yaml, 'services: {}')
+            self.assertIsNone(resultcache.lookup(
+                ds, 'key', 60, now=entry['created'] + 61))
+
+    def test_store_only_passes(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            self.result.test_outcome = 'FAIL'
+            self.assertFalse(resultcache.store(ds, 'key', '1234',
+                                               self.result))
+            self.result.test_outcome = 'PASS'
+            self.result.cached_from = '0123'
+            self.assertFalse(resultcache.store(ds, 'key', '1234',
+                                               self.result))
+            self.assertFalse(ds.exists('cache/key.json'))
+
+    def test_lookup_invalid(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            ds.write('cache/key.json', 'not json')
+            self.assertIsNone(resultcache.lookup(ds, 'key', 60))
@@ -1,21 +1,36 @@
 import argparse
 from cStringIO import StringIO
+from datetime import (
+    datetime,
+    timedelta,
+)
 import json
 import os
 from shutil import rmtree
+import subprocess
+import sys
 from tempfile import mkdtemp
 import unittest
 
 import mock
 
-from cloudweatherreport.datastore import DataStore
+from cloudweatherreport.datastore import (
+    DataStore,
+    LocalDataStore,
+)
 from cloudweatherreport.utils import temp_dir
 
 with mock.patch('deployer.utils.get_juju_major_version', return_value=1):
     # deployer (from bundletester) tries to call out to Juju CLI
-    # on import to determine which major version of Juju it's using
+    # on import to determine which major version of Juju it's using, and
+    # run only imports bundletester once it runs the tests.
+    import bundletester.tester  # noqa
     from cloudweatherreport import run
-    from cloudweatherreport import model
+    from cloudweatherreport import (
+        archive,
+        model,
+        reservation,
+    )
 
 
 class TestRunner(unittest.TestCase):
@@ -29,17 +44,212 @@ class TestRunner(unittest.TestCase):
         self.mgjmv = self._pgjmv.start()
         self.addCleanup(self._pgjmv.stop)
 
-    @mock.patch.object(model.TestPlan, 'load_plans')
-    def test_run(self, mload_plans):
-        mload_plans.return_value = [mock.Mock(), mock.Mock()]
-        runner = run.Runner('aws', False, mock.Mock())
+    @mock.patch.object(run, 'get_controller_cloud',
+                       side_effect=lambda c, v: 'aws' if c == 'aws' else None)
+    @mock.patch.object(run, 'Scheduler')
+    def test_run_jobs(self, mscheduler, mcloud):
+        scheduler = mscheduler.return_value
+        scheduler.limits = {}
+        scheduler.run.return_value = True
+        args = mock.Mock(plan_concurrency=3, max_jobs=4, juju_major_version=1,
+                         wait_for_capacity=600)
+        with mock.patch.dict(os.environ, {'AWS_MACHINE_LIMIT': '7'}):
+            self.assertTrue(run.run_jobs(args, ['aws', 'gce'], ['p1', 'p2']))
+        # Juju 1 has no models to run plans concurrently in
+        mscheduler.assert_called_once_with(1, 4)
+        self.assertEqual(scheduler.limits,
+                         {'aws': {'machines': 7, 'cpus': None}})
+        jobs = [c[0][0] for c in scheduler.add.call_args_list]
+        self.assertTrue(all(j.can_wait for j in jobs))
+        self.assertEqual([(j.controller, j.test_plan, j.number, j.cloud)
+                          for j in jobs],
+                         [('aws', 'p1', 1, 'aws'), ('aws', 'p2', 2, 'aws'),
+                          ('gce', 'p1', 1, None), ('gce', 'p2', 2, None)])
+
+    @mock.patch.object(run, 'get_controller_cloud', return_value='aws')
+    @mock.patch('cloudweatherreport.run.mp.Process')
+    def test_run_jobs_schedule(self, mprocess, mcloud):
+        mprocess.return_value.is_alive.return_value = False
+        mprocess.return_value.exitcode = 0
+        args = mock.Mock(plan_concurrency=2, max_jobs=None,
+                         juju_major_version=2, wait_for_capacity=None)
+        plan = mock.Mock(bundle='cs:bundle', cloud_resource=None)
+        with mock.patch('cloudweatherreport.scheduler.sleep'):
+            self.assertFalse(run.run_jobs(args, ['aws', 'gce'], [plan]))
+        publisher, calls = (mprocess.call_args_list[0],
+                            mprocess.call_args_list[1:])
+        self.assertEqual(publisher[1]['target'], run.run_publisher)
+        jobs = [c[1]['args'][1] for c in calls]
+        self.assertEqual([(j.controller, j.test_plan, j.number, j.cloud)
+                          for j in jobs],
+                         [('aws', plan, 1, 'aws'), ('gce', plan, 1, 'aws')])
+        self.assertEqual([c[1]['args'][2] for c in calls], [True, True])
+        # the jobs send their results to the publisher
+        results_queue = publisher[1]['args'][1]
+        self.assertEqual([c[1]['args'][3] for c in calls],
+                         [results_queue, results_queue])
+        # a publisher failure fails the run
+        with mock.patch('cloudweatherreport.scheduler.sleep'):
+            with mock.patch.object(run, 'Scheduler') as mscheduler:
+                mscheduler.return_value.run.return_value = False
+                publisher_process = mock.Mock(exitcode=1)
+                mprocess.side_effect = [publisher_process]
+                self.assertTrue(run.run_jobs(args, ['aws'], [plan]))
+        publisher_process.join.assert_called_once_with()
+
+    def test_save_result_in_queue(self):
+        runner = run.Runner('aws', mock.Mock())
+        runner.results_queue = mock.Mock()
+        runner.queue_wait = 12.5
+        test_result = model.SuiteResult(provider='AWS', test_outcome='PASS')
+        benchmark = model.Benchmark(name='perf')
+        test_plan = model.TestPlan(bundle='cs:bundle', bundle_name='bundle')
+        with mock.patch.object(run.Runner, 'publish_results') as mpublish:
+            runner.save_result_in_datastore(test_result, [benchmark],
+                                            test_plan)
+        self.assertFalse(mpublish.called)
+        message = runner.results_queue.put.call_args[0][0]
+        self.assertEqual(run.decode_result(message),
+                         (test_result, [benchmark], test_plan))
+        self.assertEqual(test_result.queue_wait, 12.5)
+
+    @mock.patch('cloudweatherreport.run.publish_svg',
+                return_value='svg/1234.svg')
+    def test_publish_results(self, mpublish_svg):
+        plan1 = model.TestPlan(bundle='cs:bundle1', bundle_name='bundle1')
+        plan2 = model.TestPlan(bundle='cs:bundle2', bundle_name='bundle2')
+        results = [
+            (model.SuiteResult(provider='AWS', test_outcome='PASS'), [],
+             plan1),
+            (model.SuiteResult(provider='GCE', test_outcome='FAIL'), [],
+             plan1),
+            (model.SuiteResult(provider='AWS', test_outcome='PASS'), [],
+             plan2),
+        ]
+        with temp_dir() as results_dir:
+            args = run.parse_args(['aws', 'test_plan', '--test-id', '1234',
+                                   '--results-dir', results_dir])
+            runner = run.Runner('aws', args)
+            ds = LocalDataStore(results_dir)
+            with mock.patch.object(run.Runner, 'get_datastore',
+                                   return_value=ds):
+                with mock.patch.object(ds, 'lock',
+                                       wraps=ds.lock) as mlock:
+                    runner.publish_results(results)
+            self.assertEqual(mlock.call_count, 1)
+            index = runner.load_index(ds)
+            self.assertEqual(sorted(index.bundle_names()),
+                             ['bundle1', 'bundle2'])
+            report = runner.load_report(ds, index, plan1)
+            self.assertEqual(sorted(r.provider for r in report.results),
+                             ['AWS', 'GCE'])
+            self.assertTrue(ds.exists('bundle1/index.json'))
+            self.assertTrue(ds.exists('bundle2/index.json'))
+            self.assertEqual(sorted(report.timings),
+                             ['load', 'lock_wait', 'svg'])
+            # the publishing timings are shown and aggregated in the index
+            self.assertIn('Publishing', ds.read(report.filename_html))
+            item = [i for i in index.reports if i.bundle_name == 'bundle1']
+            self.assertEqual(item[0].publish_timings, report.timings)
+
+    @mock.patch.object(run, 'Runner')
+    def test_run_publisher(self, mrunner):
+        test_plan = model.TestPlan(bundle='cs:bundle', bundle_name='bundle')
+        results = [model.SuiteResult(provider=p, test_outcome='PASS')
+                   for p in ('AWS', 'GCE', 'Azure')]
+        messages = [run.encode_result(r, [], test_plan) for r in results]
+        # the first two arrive together, the third later, and the first
+        # publish fails and is retried
+        results_queue = mock.Mock()
+        results_queue.get.side_effect = [
+            messages[0], messages[1], run.Empty(), messages[2], None]
+        batches = []
+
+        def publish_results(batch):
+            batches.append([r.provider for r, _, _ in batch])
+            if len(batches) == 1:
+                raise Exception('lock timeout')
+
+        publish = mrunner.return_value.publish_results
+        publish.side_effect = publish_results
+        run.run_publisher(mock.Mock(), results_queue, delay=0)
+        self.assertEqual(batches, [['AWS', 'GCE'], ['AWS', 'GCE', 'Azure']])
+        # unpublished results are reported with the exit code
+        publish.side_effect = Exception('lock timeout')
+        results_queue.get.side_effect = [messages[0], None]
+        with self.assertRaises(SystemExit) as cm:
+            run.run_publisher(mock.Mock(), results_queue, delay=0)
+        self.assertEqual(cm.exception.code, 1)
+
+    @mock.patch('cloudweatherreport.run.connect_juju_client')
+    def test_get_controller_cloud(self, mconnect):
+        mconnect.return_value.info.return_value = {'cloud-tag': 'cloud-aws'}
+        self.assertEqual(run.get_controller_cloud('ctrl', 2), 'aws')
+        mconnect.assert_called_once_with('ctrl', logging=mock.ANY,
+                                         version=2)
+        # the job processes don't inherit the connection
+        mconnect.return_value.close.assert_called_once_with()
+        mconnect.return_value.info.return_value = {'ProviderType': 'ec2'}
+        self.assertEqual(run.get_controller_cloud('ctrl'), 'ec2')
+        mconnect.return_value = None
+        self.assertIsNone(run.get_controller_cloud('ctrl'))
+        mconnect.side_effect = Exception('not bootstrapped')
+        self.assertIsNone(run.get_controller_cloud('ctrl'))
+
+    def test_get_model_name(self):
+        self.assertEqual(run.get_model_name('0123456789', 3),
+                         'cwr-01234567-87acec-3')
+        self.assertEqual(run.get_model_name('My_Run.2017', 1),
+                         'cwr-my-run-2-e3a46a-1')
+        self.assertEqual(run.get_model_name('__', 1), 'cwr-9cccc8-1')
+
+    @mock.patch('cloudweatherreport.run.juju_cmd')
+    def test_run_plan_in_model(self, mjuju_cmd):
+        runner = run.Runner('aws', mock.Mock(test_id='0123456789',
+                                             no_destroy=False, resume=False))
+        runner.run_plan = mock.Mock(return_value=True)
+        test_plan = mock.Mock()
+        self.assertTrue(runner.run_plan_in_model(test_plan, 3))
+        runner.run_plan.assert_called_once_with(test_plan)
+        self.assertEqual(runner.controller, 'aws:cwr-01234567-87acec-3')
+        self.assertEqual(mjuju_cmd.call_args_list, [
+            mock.call(['add-model', 'cwr-01234567-87acec-3', '-c', 'aws',
+                       '--no-switch']),
+            mock.call(['destroy-model', '-y', 'aws:cwr-01234567-87acec-3']),
+        ])
+
+    @mock.patch.object(run, 'connect_juju_client')
+    @mock.patch('cloudweatherreport.run.juju_cmd')
+    def test_run_plan_in_model_resume(self, mjuju_cmd, mconnect):
+        runner = run.Runner('aws', mock.Mock(test_id='0123456789',
+                                             no_destroy=False, resume=True))
+        runner.run_plan = mock.Mock(return_value=True)
+        mconnect.return_value.info.return_value = {'provider-type': 'ec2'}
+        completed = model.SuiteResult(provider='AWS', test_outcome='FAIL')
+        with mock.patch.object(runner, 'completed_result',
+                               return_value=completed) as mcompleted:
+            self.assertFalse(runner.run_plan_in_model(mock.Mock(), 3))
+        self.assertEqual(mcompleted.call_args[0][1], 'AWS')
+        self.assertEqual(runner.controller, 'aws')
+        self.assertFalse(runner.run_plan.called)
+        self.assertFalse(mjuju_cmd.called)
+        mconnect.return_value.close.assert_called_once_with()
+
+    @mock.patch('cloudweatherreport.run.juju_cmd',
+                side_effect=OSError('no juju'))
+    def test_run_plan_in_model_failed(self, mjuju_cmd):
+        runner = run.Runner('aws', mock.Mock(test_id='0123456789',
+                                             resume=False))
         runner.run_plan = mock.Mock()
-        runner.run()
-        self.assertEqual(runner.run_plan.call_args_list,
-                         [mock.call(p) for p in mload_plans.return_value])
+        runner.save_result_in_datastore = mock.Mock()
+        self.assertFalse(runner.run_plan_in_model(mock.Mock(), 1))
+        self.assertFalse(runner.run_plan.called)
+        test_result = runner.save_result_in_datastore.call_args[0][0]
+        self.assertEqual(test_result.tests[0].name,
+                         'Juju model creation failed')
 
     def test_load_index(self):
-        runner = run.Runner('aws', False, mock.Mock())
+        runner = run.Runner('aws', mock.Mock())
         datastore = mock.Mock()
         datastore.read.return_value = '{"providers": ["foo"]}'
 
@@ -55,15 +265,15 @@ class TestRunner(unittest.TestCase):
 
     @mock.patch.object(model.Report, 'upsert_benchmarks')
     def test_load_report(self, mupsert_benchmarks):
-        runner = run.Runner('aws', False, mock.Mock(test_id='test'))
+        runner = run.Runner('aws', mock.Mock(test_id='test'))
         test_plan = mock.Mock(bundle='bundle',
                               bundle_name='name',
                               url='example.com')
         test_plan.report_filename.return_value = 'filename'
         datastore = mock.Mock()
         datastore.read.return_value = '{"test_id": "foo"}'
-        index = mock.Mock()
-        index.find_previous_report.return_value = mock.Mock()
+        index = mock.Mock(reports=[])
+        index.find_previous_report.return_value = mock.Mock(archive=None)
 
         datastore.exists.return_value = True
         r1 = runner.load_report(datastore, index, test_plan)
@@ -80,7 +290,7 @@ class TestRunner(unittest.TestCase):
     @mock.patch('cloudweatherreport.run.connect_juju_client')
     def test_run_plan_no_env(self, mock_juju, mock_logging):
         mock_juju.return_value = None
-        runner = run.Runner('aws', False, mock.Mock())
+        runner = run.Runner('aws', mock.Mock())
         with mock.patch.object(
                 run.Runner, 'save_result_in_datastore') as mock_srd:
             res = runner.run_plan(mock.Mock())
@@ -102,7 +312,9 @@ class TestRunner(unittest.TestCase):
         mock_datastore.return_value = ds
         test_plan = mock.Mock()
         with mock.patch.object(run.Runner, 'run_tests',
-                               return_value=mock.Mock()) as mock_result:
+                               return_value=mock.Mock(bundle_yaml=None,
+                                                      cached_from=None)
+                               ) as mock_result:
             with mock.patch.object(run.Runner, 'run_benchmarks',
                                    return_value="") as mock_benchmark:
                 with mock.patch.object(run.Runner, 'load_index',
@@ -112,11 +324,16 @@ class TestRunner(unittest.TestCase):
                                            ) as mock_load:
                         mock_index.return_value.bundle_names. \
                             return_value = ['bundle']
+                        mock_index.return_value.providers = []
                         mock_index.return_value.bundle_index_filename. \
                             return_value = 'bundle/index.html'
                         with mock.patch.object(
-                                run.Runner, 'check_cloud_resource') as mock_cr:
-                            runner = run.Runner('aws', False, mock.Mock())
+                                run.Runner,
+                                'reserve_cloud_resource') as mock_cr:
+                            runner = run.Runner(
+                                'aws', mock.Mock(
+                                    resume=False, profile=False,
+                                    trace_malloc=False))
                             runner.run_plan(test_plan)
         rmtree(tempdir)
         # Assert we tried to get the Juju env run the tests and benchmarks
@@ -142,10 +359,11 @@ class TestRunner(unittest.TestCase):
             with mock.patch.object(run.Runner, 'run_benchmarks',
                                    return_value=""):
                 with mock.patch.object(
-                        run.Runner, 'check_cloud_resource') as mock_cr:
+                        run.Runner, 'reserve_cloud_resource') as mock_cr:
                     with mock.patch.object(
                             run.Runner, 'save_result_in_datastore') as mock_sr:
-                        runner = run.Runner('aws', False, mock.Mock())
+                        runner = run.Runner(
+                            'aws', mock.Mock(resume=False))
                         res = runner.run_plan(test_plan)
         # Assert we tried to get the Juju env run the tests but
         # since we failed to run the tests we return false
@@ -155,6 +373,98 @@ class TestRunner(unittest.TestCase):
         assert mock_sr.called
         mock_cr.assert_called_once_with(test_plan, {'ProviderType': 'foo'})
 
+    @mock.patch('cloudweatherreport.run.get_provider_name')
+    @mock.patch('cloudweatherreport.run.connect_juju_client')
+    def test_run_plan_resume(self, mock_juju, mock_provider):
+        mock_juju.return_value.info.return_value = {"ProviderType": "foo"}
+        mock_provider.return_value = "foo-provider"
+        runner = run.Runner('aws', mock.Mock(resume=True))
+        plan = mock.Mock(bundle_name='git')
+        completed = model.SuiteResult(provider='foo-provider',
+                                      test_outcome='FAIL')
+        with mock.patch.object(run.Runner, 'completed_result',
+                               return_value=completed) as mock_completed:
+            with mock.patch.object(run.Runner, 'run_tests') as mock_tests:
+                with mock.patch.object(
+                        run.Runner, 'reserve_cloud_resource') as mock_cr:
+                    self.assertIs(runner.run_plan(plan), False)
+                    mock_completed.return_value = None
+                    with mock.patch.object(run.Runner, 'run_benchmarks'), \
+                            mock.patch.object(
+                                run.Runner, 'save_result_in_datastore'):
+                        runner.run_plan(plan)
+        mock_completed.assert_called_with(plan, 'foo-provider')
+        self.assertEqual(mock_cr.call_count, 1)
+        self.assertEqual(mock_tests.call_count, 1)
+
+    def test_completed_result(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            runner = run.Runner('aws', mock.Mock(test_id='1234'))
+            plan = model.TestPlan(bundle='git', bundle_name='git')
+            with mock.patch.object(runner, 'get_datastore',
+                                   return_value=ds):
+                self.assertIsNone(runner.completed_result(plan, 'AWS'))
+                report = model.Report(
+                    test_id='1234', bundle=model.BundleInfo(name='git'),
+                    results=[
+                        model.SuiteResult(provider='AWS',
+                                          test_outcome='PASS'),
+                        model.SuiteResult(provider='GCE',
+                                          test_outcome='INFRA'),
+                    ])
+                ds.write(plan.report_filename('1234'), report.as_json())
+                self.assertEqual(
+                    runner.completed_result(plan, 'AWS').test_outcome,
+                    'PASS')
+                self.assertIsNone(runner.completed_result(plan, 'GCE'))
+                self.assertIsNone(runner.completed_result(plan, 'Azure'))
+
+    @mock.patch('cloudweatherreport.run.get_provider_name')
+    @mock.patch('cloudweatherreport.run.connect_juju_client')
+    def test_run_plan_resource_not_available(self, mock_juju, mock_provider):
+        mock_juju.return_value.info.return_value = {"ProviderType": "foo"}
+        mock_provider.return_value = "foo-provider"
+        runner = run.Runner('aws', mock.Mock(resume=False))
+        with mock.patch.object(run.Runner, 'reserve_cloud_resource',
+                               return_value=False):
+            with mock.patch.object(
+                    run.Runner, 'save_result_in_datastore') as mock_sr:
+                runner.can_requeue = True
+                self.assertIs(runner.run_plan(mock.Mock()), run.REQUEUE)
+                self.assertFalse(mock_sr.called)
+                runner.can_requeue = False
+                self.assertIs(runner.run_plan(mock.Mock()), False)
+                test_result = mock_sr.call_args[0][0]
+                self.assertEqual(test_result.tests[0].name,
+                                 'Resource not available')
+
+    @mock.patch.object(run.Runner, 'run_plan', return_value=run.REQUEUE)
+    def test_run_job_requeue(self, mrun_plan):
+        job = run.Job('aws', mock.Mock(), 1, wait_for_capacity=60)
+        with self.assertRaises(SystemExit) as cm:
+            run.run_job(mock.Mock(profile=False), job, False)
+        self.assertEqual(cm.exception.code, run.EXIT_REQUEUE)
+        mrun_plan.return_value = True
+        with self.assertRaises(SystemExit) as cm:
+            run.run_job(mock.Mock(profile=False), job, False)
+        self.assertFalse(cm.exception.code)
+
+    def test_run_job_queue_wait(self):
+        queue_waits = []
+
+        def run_plan(runner, test_plan):
+            queue_waits.append(runner.queue_wait)
+            return True
+
+        with mock.patch.object(run.Runner, 'run_plan', autospec=True,
+                               side_effect=run_plan):
+            for job in (run.Job('aws', mock.Mock(), 1),
+                        run.Job('aws', mock.Mock(), 1, wait_for_capacity=60)):
+                with self.assertRaises(SystemExit):
+                    run.run_job(mock.Mock(profile=False), job, False)
+        self.assertEqual(queue_waits, [None, 0.0])
+
     def test_generate_test_result(self):
         result = run.Runner.generate_test_result('aws', 'smoke', 'error')
         self.assertIsInstance(result, model.SuiteResult)
@@ -170,20 +480,114 @@ class TestRunner(unittest.TestCase):
     @mock.patch('bundletester.tester.main')
     @mock.patch.object(model.SuiteResult, 'from_bundletester_output')
     def test_run_tests(self, bt_out, tester_main):
-        runner = run.Runner('aws', False, mock.Mock())
+        runner = run.Runner('aws', mock.Mock())
         env = mock.Mock()
-        status = mock.Mock()
+        env.provider_name = 'AWS'
+        status = mock.Mock(tests=[])
         status.bundle_yaml.return_value = mock.Mock()
         tester_main.return_value = status
         bt_out.return_value = status
         plan = mock.Mock()
-        result = runner.run_tests(env, plan)
+        plan.report_filename.return_value = 'git/1234/report.json'
+        with mock.patch.object(runner, 'get_datastore'):
+            result = runner.run_tests(plan, env)
         # You called bundle tester and got back the results
         assert tester_main.called
         assert bt_out.called
         # The result is the Mock returned by SuiteResult
         self.assertIsInstance(result, mock.Mock)
 
+    @mock.patch('bundletester.tester.main')
+    def test_run_tests_timings(self, tester_main):
+        runner = run.Runner('aws', mock.Mock(result_cache=None,
+                                             test_id='1234'))
+        env = mock.Mock(provider_name='AWS')
+        plan = model.TestPlan(bundle='git', bundle_name='git')
+        tester_main.return_value = mock.Mock(bundle_yaml=None, charm=None)
+        result = model.SuiteResult(provider='AWS', tests=[
+            model.TestResult(name='juju-deployer', duration=600.0),
+            model.TestResult(name='test_01', duration=60.0),
+        ])
+        with mock.patch.object(runner, 'get_datastore'), \
+                mock.patch.object(model.SuiteResult,
+                                  'from_bundletester_output',
+                                  return_value=result), \
+                mock.patch('cloudweatherreport.utils.time',
+                           side_effect=[0, 700]):
+            runner.run_tests(plan, env)
+        self.assertEqual(runner.timings, {'deploy': 600, 'tests': 100})
+
+    @mock.patch('bundletester.tester.main')
+    def test_run_tests_releases_after_deploy(self, tester_main):
+        runner = run.Runner('aws', mock.Mock(result_cache=None,
+                                             test_id='1234'))
+        env = mock.Mock(provider_name='AWS')
+        plan = model.TestPlan(bundle='git', bundle_name='git')
+        released = []
+
+        def main(options):
+            options.on_test_result({'test': 'charm-proof', 'returncode': 0})
+            released.append(runner.release_cloud_resource.call_count)
+            options.on_test_result({'test': 'juju-deployer', 'returncode': 0})
+            released.append(runner.release_cloud_resource.call_count)
+            return mock.Mock(bundle_yaml=None, charm=None)
+
+        tester_main.side_effect = main
+        with mock.patch.object(runner, 'get_datastore'), \
+                mock.patch.object(runner, 'release_cloud_resource'), \
+                mock.patch.object(model.SuiteResult,
+                                  'from_bundletester_output',
+                                  return_value=model.SuiteResult()):
+            runner.run_tests(plan, env)
+        self.assertEqual(released, [0, 1])
+
+    def cache_and_rerun(self, bundle_yaml):
+        """
+        Run and cache the tests of a bundle, then run them again.
+        """
+        runner = run.Runner('aws', mock.Mock(result_cache=24,
+                                             test_id='1234'))
+        env = mock.Mock(provider_name='AWS')
+        plan = model.TestPlan(bundle='git', bundle_name='git')
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            passed = model.SuiteResult(provider='AWS', test_outcome='PASS',
+                                       bundle_yaml=bundle_yaml)
+
+            def main(options):
+                status = mock.Mock(bundle_yaml=bundle_yaml)
+                options.on_suite(status)
+                return status
+
+            with mock.patch.object(runner, 'get_datastore',
+                                   return_value=ds), \
+                    mock.patch('bundletester.tester.main',
+                               side_effect=main) as tester_main, \
+                    mock.patch.object(model.SuiteResult,
+                                      'from_bundletester_output',
+                                      return_value=passed):
+                result = runner.run_tests(plan, env)
+                self.assertIsNone(result.cached_from)
+                cached = runner.cache_result(plan, result)
+                runner.test_id = '5678'
+                result = runner.run_tests(plan, env)
+        self.assertEqual(tester_main.call_count, 2)
+        return cached, result
+
+    def test_run_tests_result_cache(self):
+        cached, result = self.cache_and_rerun(
+            'services: {mysql: {charm: "cs:xenial/mysql-57"}}')
+        self.assertTrue(cached)
+        self.assertEqual(result.cached_from, '1234')
+        self.assertEqual(result.test_outcome, 'PASS')
+
+    def test_run_tests_result_cache_unpinned(self):
+        # The charm may have changed since, so the bundle is tested again.
+        cached, result = self.cache_and_rerun(
+            'services: {mysql: {charm: "cs:xenial/mysql"}}')
+        self.assertFalse(cached)
+        self.assertIsNone(result.cached_from)
+
     @mock.patch('bundletester.tester.main')
     @mock.patch.object(model.SuiteResult, 'from_bundletester_output')
     def test_run_tests_with_args(self, bt_out, tester_main):
@@ -191,24 +595,31 @@ class TestRunner(unittest.TestCase):
             ['aws', 'test_plan', '--test-id', '1234', '--deploy-plan', 'foo',
              '--deploy-budget', 'bar', '--testdir', '/tmp/testdir',
              '--no-matrix'])
-        runner = run.Runner('aws', False, args)
+        runner = run.Runner('aws', args)
         env = mock.Mock(spec_set=['name', 'provider_name'])
         env.name = 'env-name'
-        status = mock.Mock()
+        status = mock.Mock(tests=[])
         status.bundle_yaml.return_value = mock.Mock(spec_set=[])
         tester_main.return_value = status
         bt_out.return_value = status
-        plan = mock.Mock(spec_set=['tests', 'bundle_file', 'bundle'])
+        env.provider_name = 'AWS'
+        plan = mock.Mock(spec_set=['tests', 'bundle_file', 'bundle',
+                                   'bundle_name', 'report_filename'])
         plan.tests = 'foo-tests'
         plan.bundle_file = 'foo-bundle-file'
         plan.bundle = 'foo-bundle'
+        plan.bundle_name = 'foo'
+        plan.report_filename.return_value = 'foo/1234/report.json'
         str_io = StringIO()
         with mock.patch('cloudweatherreport.run.StringIO', autospec=True,
-                        return_value=str_io) as string_mock:
+                        return_value=str_io) as string_mock, \
+                mock.patch.object(runner, 'get_datastore'):
             result = runner.run_tests(plan, env)
         expected_args = argparse.Namespace(
             bucket=None,
             bundle='foo-bundle-file',
+            chart_points=500,
+            client_side_index=False,
             controllers=['aws'],
             deploy_budget='bar',
             deploy_plan='foo',
@@ -221,22 +632,37 @@ class TestRunner(unittest.TestCase):
             log_level='INFO',
             no_destroy=False,
             no_matrix=True,
+            on_test_result=mock.ANY,
             output=str_io,
+            rebuild_index=False,
+            compact_older_than=None,
+            max_jobs=None,
+            metrics_file=None,
+            plan_concurrency=1,
+            profile=False,
+            prune_older_than=None,
             regenerate_index=False,
             remove_test=None,
-            reporter='json',
+            reporter='cwr-progress',
+            resume=False,
+            result_cache=None,
             results_dir='results',
             results_per_bundle=40,
+            s3_cache_policies=None,
             s3_creds=None,
             s3_public=True,
             skip_implicit=False,
+            svg_renderer='remote',
             test_id='1234',
             test_pattern=None,
+            trace_malloc=False,
             test_plan='test_plan',
             testdir='foo-bundle',
             tests='foo-tests',
             tests_yaml=None,
-            verbose=False)
+            verbose=False,
+            wait_for_capacity=None,
+            workers=16)
         tester_main.assert_called_once_with(expected_args)
         string_mock.assert_called_once_with()
         assert bt_out.called
@@ -248,7 +674,7 @@ class TestRunner(unittest.TestCase):
         mock_unit.return_value = "unit/0"
         env = mock.Mock()
         plan = self.get_plan()
-        runner = run.Runner('aws', False, mock.Mock())
+        runner = run.Runner('aws', mock.Mock())
         runner.run_benchmarks(plan, env)
         assert mock_log_error.called
 
@@ -257,22 +683,82 @@ class TestRunner(unittest.TestCase):
         mock_unit.return_value = None
         env = mock.Mock()
         plan = self.get_plan()
-        runner = run.Runner('aws', False, mock.Mock())
+        runner = run.Runner('aws', mock.Mock())
         with self.assertRaises(Exception):
             runner.run_benchmarks(plan, env)
 
     @mock.patch('cloudweatherreport.run.model.Benchmark.from_action')
-    @mock.patch('cloudweatherreport.run.run_action')
+    @mock.patch('cloudweatherreport.run.wait_for_actions_complete')
+    @mock.patch('cloudweatherreport.run.enqueue_action')
     @mock.patch('cloudweatherreport.run.find_unit')
-    def test_run_benchmarks(self, mock_unit, mock_action, mock_result):
-        mock_unit.return_value = "unit/0"
-        mock_action.return_value = mock.Mock()
-        mock_result.return_value = "Result"
+    def test_run_benchmarks(self, mock_unit, mock_enqueue, mock_wait,
+                            mock_result):
+        mock_unit.side_effect = lambda unit, status: unit
+        mock_enqueue.side_effect = lambda client, unit, action, params: action
+        mock_wait.side_effect = lambda client, tags, timeout: {
+            tag: {'status': 'completed',
+                  'output': {'meta': {'composite': {'value': tag}}}}
+            for tag in tags}
+        mock_result.side_effect = lambda composite: composite['name']
         env = mock.Mock()
         plan = self.get_plan()
-        runner = run.Runner('aws', False, mock.Mock())
+        runner = run.Runner('aws', mock.Mock())
         benchmarks = runner.run_benchmarks(plan, env)
-        self.assertEqual(len(benchmarks), 3)
+        self.assertEqual(benchmarks,
+                         [b.action for b in plan.benchmarks])
+        # unit/0 and unit/1 are benchmarked at the same time, but the two
+        # benchmarks of unit/1 one after another
+        calls = [c[0][1:3] for c in mock_enqueue.call_args_list]
+        unit1 = [b.action for b in plan.benchmarks if b.unit == 'unit/1']
+        self.assertItemsEqual(calls[:2], [('unit/0', 'name1'),
+                                          ('unit/1', unit1[0])])
+        self.assertEqual(calls[2], ('unit/1', unit1[1]))
+
+    def test_group_benchmarks(self):
+        def plan(unit, action, isolated=None):
+            return (model.BenchmarkPlan(unit=unit, action=action,
+                                        isolated=isolated), unit)
+
+        planned = [
+            plan('a/0', 'a1'),
+            plan('b/0', 'b1'),
+            plan('a/0', 'a2'),
+            plan('c/0', 'c1', isolated=True),
+            plan('b/0', 'b2'),
+            plan('d/0', 'd1'),
+        ]
+        groups = run.group_benchmarks(planned)
+        self.assertEqual(
+            [[p.action for p, _ in group] for group in groups],
+            [['a1', 'b1'], ['a2'], ['c1'], ['b2', 'd1']])
+        self.assertEqual(run.group_benchmarks([]), [])
+
+    @mock.patch('cloudweatherreport.run.wait_for_actions_complete')
+    @mock.patch('cloudweatherreport.run.enqueue_action')
+    def test_run_benchmark_group(self, mock_enqueue, mock_wait):
+        ok = model.BenchmarkPlan(unit='a/0', action='ok')
+        bad = model.BenchmarkPlan(unit='b/0', action='bad')
+        failed = model.BenchmarkPlan(unit='c/0', action='failed')
+        slow = model.BenchmarkPlan(unit='d/0', action='slow')
+
+        def enqueue(client, unit, action, params):
+            if action == 'bad':
+                raise Exception('Action failed')
+            return action
+
+        mock_enqueue.side_effect = enqueue
+        mock_wait.return_value = {
+            'ok': {'status': 'completed', 'output': 'output'},
+            'failed': {'status': 'failed'},
+        }
+        runner = run.Runner('aws', mock.Mock())
+        outputs = runner.run_benchmark_group(
+            mock.Mock(), [(ok, 'a/0'), (bad, 'b/0'), (failed, 'c/0'),
+                          (slow, 'd/0')])
+        self.assertEqual(outputs, {id(ok): 'output'})
+        # the enqueued actions are waited on together
+        self.assertEqual(mock_wait.call_count, 1)
+        self.assertEqual(mock_wait.call_args[0][1], ['ok', 'failed', 'slow'])
 
     def test_remove_test_by_bundle_name(self):
         index_json = {
@@ -312,7 +798,7 @@ class TestRunner(unittest.TestCase):
                  results_dir])
             with open(full_index, 'w') as f:
                 json.dump(index_json, f)
-            runner = run.Runner(None, False, args)
+            runner = run.Runner(None, args)
             runner.remove_test_by_bundle_name()
             with open(full_index) as f:
                 result_index = json.load(f)
@@ -322,6 +808,173 @@ class TestRunner(unittest.TestCase):
             os.path.isfile(model.ReportIndex.summary_filename_html)
             os.path.isfile(model.ReportIndex.summary_filename_json)
 
+    def test_remove_test_deletes_files(self):
+        with temp_dir() as results_dir:
+            ds = DataStore.get(results_dir)
+            index = self._write_reports(ds, [('foo', '1', 1), ('bar', '2', 2)])
+            ds.write('foo/index.html', '')
+            ds.write('foo/index.json', '')
+            args = run.parse_args(
+                ['aws', 'test_plan', '--remove-test', 'foo', '--dry-run',
+                 '--results-dir', results_dir])
+            runner = run.Runner(None, args)
+            files = runner.delete_report_files(
+                ds, index, index.remove_by_bundle_name('foo'))
+            self.assertEqual([f for f, _ in files],
+                             ['foo/1/report.json', 'foo/index.html',
+                              'foo/index.json'])
+            self.assertTrue(runner.remove_test_by_bundle_name())
+            self.assertTrue(ds.exists('foo/1/report.json'))
+            runner.args.dryrun = False
+            self.assertTrue(runner.remove_test_by_bundle_name())
+            self.assertFalse(os.path.exists(os.path.join(results_dir, 'foo')))
+            self.assertTrue(ds.exists('bar/2/report.json'))
+
+    def test_remove_test_dry_run_lists_all_files(self):
+        with temp_dir() as results_dir:
+            ds = DataStore.get(results_dir)
+            self._write_reports(ds, [('foo', '1', 3), ('foo', '2', 2),
+                                     ('foo', '3', 1)])
+            args = run.parse_args(
+                ['aws', 'test_plan', '--remove-test', 'foo', '--dry-run',
+                 '--results-per-bundle', '1', '--results-dir', results_dir])
+            runner = run.Runner(None, args)
+            runner.write_index(ds, model.ReportIndex.from_json(
+                ds.read('full_index.json')))
+            listed = []
+            delete_report_files = runner.delete_report_files
+
+            def record(datastore, index, reports):
+                files = delete_report_files(datastore, index, reports)
+                listed.append(sorted(f for f, _ in files))
+                return files
+
+            runner.delete_report_files = record
+            before = set(f for f, _ in ds.list_recursive('foo'))
+            # the dry run removes every report of the index
+            self.assertTrue(runner.remove_test_by_bundle_name())
+            runner.args.dryrun = False
+            self.assertTrue(runner.remove_test_by_bundle_name())
+            deleted = before - set(f for f, _ in ds.list_recursive('foo'))
+        self.assertIn('foo/index-3.json', listed[0])
+        self.assertEqual(listed[0], listed[1])
+        self.assertEqual(listed[0], sorted(deleted))
+
+    def test_prune_old_tests(self):
+        with temp_dir() as results_dir:
+            ds = DataStore.get(results_dir)
+            self._write_reports(ds, [('foo', '1', 30), ('foo', '2', 20),
+                                     ('foo', '3', 10), ('bar', '4', 30)])
+            args = run.parse_args(
+                ['aws', 'test_plan', '--prune-older-than', '15',
+                 '--results-per-bundle', '1', '--results-dir', results_dir])
+            runner = run.Runner(None, args)
+            runner.write_index(ds, model.ReportIndex.from_json(
+                ds.read('full_index.json')))
+            self.assertTrue(ds.exists('foo/index-3.json'))
+            self.assertTrue(runner.prune_old_tests())
+            index = model.ReportIndex.from_json(ds.read('full_index.json'))
+            self.assertEqual([r.test_id for r in index.reports], ['3'])
+            self.assertFalse(ds.exists('foo/1/report.json'))
+            self.assertFalse(ds.exists('foo/2/report.json'))
+            self.assertTrue(ds.exists('foo/3/report.json'))
+            self.assertTrue(ds.exists('foo/index-1.json'))
+            self.assertFalse(ds.exists('foo/index-2.json'))
+            self.assertFalse(ds.exists('foo/index-3.json'))
+            self.assertFalse(ds.exists('bar/index.json'))
+            self.assertFalse(runner.prune_old_tests())
+
+    def test_compact_old_tests(self):
+        with temp_dir() as results_dir:
+            ds = DataStore.get(results_dir)
+            self._write_reports(ds, [('foo', '1', 30), ('foo', '2', 10)])
+            ds.write('foo/1/report.html', '<html></html>')
+            args = run.parse_args(
+                ['aws', 'test_plan', '--compact-older-than', '15',
+                 '--results-dir', results_dir])
+            runner = run.Runner(None, args)
+            self.assertTrue(runner.compact_old_tests())
+            self.assertFalse(runner.compact_old_tests())
+            index = model.ReportIndex.from_json(ds.read('full_index.json'))
+            old = index.reports[1]
+            self.assertIsNotNone(old.archive)
+            self.assertTrue(ds.exists(old.archive))
+            self.assertEqual(old.filename_html, 'archive.html#{}/1'.format(
+                old.archive[len('archive/'):-len('.gz')]))
+            self.assertIn(old.filename_html, ds.read('foo/index.html'))
+            self.assertTrue(ds.exists('archive.html'))
+            self.assertFalse(ds.exists('foo/1/report.json'))
+            self.assertFalse(ds.exists('foo/1/report.html'))
+            self.assertTrue(ds.exists('foo/2/report.json'))
+            self.assertEqual(model.Report.from_json(
+                runner.read_report_json(ds, old)).test_id, '1')
+
+            # archived reports are found again when rebuilding the index
+            ds.delete('full_index.json')
+            self.assertTrue(runner.rebuild_index())
+            index = model.ReportIndex.from_json(ds.read('full_index.json'))
+            self.assertEqual([r.archive for r in index.reports],
+                             [None, old.archive])
+
+            # and the archive is deleted when its reports are pruned
+            runner.args.prune_older_than = 15
+            self.assertTrue(runner.prune_old_tests())
+            self.assertFalse(ds.exists(old.archive))
+            self.assertFalse(ds.exists(archive.lookup_filename(old.archive)))
+
+    def _write_reports(self, ds, reports):
+        index = model.ReportIndex()
+        for bundle, test_id, days_ago in reports:
+            report = model.Report(
+                test_id=test_id,
+                date=datetime.now() - timedelta(days=days_ago),
+                bundle=model.BundleInfo(name=bundle),
+                results=[model.SuiteResult(provider='AWS',
+                                           test_outcome='PASS')])
+            ds.write(report.filename_json, report.as_json())
+            index.upsert_report(report)
+        ds.write('full_index.json', index.as_json())
+        return index
+
+    def test_regenerate_index_client_side(self):
+        with temp_dir() as results_dir:
+            args = run.parse_args(
+                ['aws', 'test_plan', '--regenerate-index',
+                 '--client-side-index', '--results-dir', results_dir])
+            runner = run.Runner(None, args)
+            runner.regenerate_index()
+            ds = DataStore.get(results_dir)
+            self.assertIn('js/dashboard.js', ds.read('index.html'))
+            self.assertTrue(ds.exists('index.json'))
+            self.assertTrue(ds.exists('full_index.json'))
+            self.assertFalse(ds.exists('full_index.html'))
+
+    def test_rebuild_index(self):
+        with temp_dir() as results_dir:
+            ds = DataStore.get(results_dir)
+            for bundle, test_id, day in [('foo', '1', 1), ('foo', '2', 2),
+                                         ('cs:bar', '3', 3)]:
+                report = model.Report(
+                    test_id=test_id,
+                    date=datetime(2017, 1, day),
+                    bundle=model.BundleInfo(name=bundle),
+                    results=[model.SuiteResult(provider='AWS',
+                                               test_outcome='PASS')])
+                ds.write(report.filename_json, report.as_json())
+            ds.write('foo/4/report.json', 'not json')
+            ds.write('foo/index.json', '{}')
+            args = run.parse_args(
+                ['aws', 'test_plan', '--rebuild-index', '--results-per-bundle',
+                 '1', '--results-dir', results_dir])
+            self.assertTrue(run.Runner(None, args).rebuild_index())
+            index = model.ReportIndex.from_json(ds.read('full_index.json'))
+            self.assertEqual([(r.bundle_name, r.test_id)
+                              for r in index.reports],
+                             [('cs:bar', '3'), ('foo', '2'), ('foo', '1')])
+            self.assertEqual(index.providers, ['AWS'])
+            self.assertTrue(ds.exists('foo/index-2.html'))
+            self.assertTrue(ds.exists('cs_bar/index.json'))
+
     def get_plan(self):
         plan = model.TestPlan.from_dict({
             'bundle': 'bundle_name',
@@ -341,6 +994,21 @@ class TestRunner(unittest.TestCase):
         })
         return plan
 
+    def test_import_is_light(self):
+        # The slow to import dependencies are only loaded by the commands
+        # that use them, and juju is not probed on import.
+        code = ('import sys\n'
+                'from cloudweatherreport import run\n'
+                'run.parse_args(["aws", "test_plan"])\n'
+                'print(",".join(sorted(set(m.split(".")[0] '
+                'for m in sys.modules))))\n')
+        with mock.patch.dict(os.environ, {'PATH': ''}):
+            output = subprocess.check_output([sys.executable, '-c', code])
+        modules = output.strip().split(',')
+        for name in ('boto', 'bundletester', 'deployer', 'jinja2',
+                     'jujuclient', 'libcloud', 'requests'):
+            self.assertNotIn(name, modules)
+
     def test_parse_args_defaults(self):
         with mock.patch('os.getcwd') as mgetcwd:
             mgetcwd.return_value = '/foo'
@@ -348,6 +1016,8 @@ class TestRunner(unittest.TestCase):
         expected = argparse.Namespace(
             bucket=None,
             bundle=None,
+            chart_points=500,
+            client_side_index=False,
             controllers=['aws'],
             deploy_budget=None,
             deploy_plan=None,
@@ -355,26 +1025,50 @@ class TestRunner(unittest.TestCase):
             dryrun=False,
             exclude=None,
             failfast=True,
-            juju_major_version=2,
+            juju_major_version=None,
             log_level='INFO',
             no_destroy=False,
             no_matrix=False,
+            rebuild_index=False,
+            compact_older_than=None,
+            max_jobs=None,
+            metrics_file=None,
+            plan_concurrency=1,
+            profile=False,
+            prune_older_than=None,
             regenerate_index=False,
             remove_test=None,
+            resume=False,
+            result_cache=None,
             results_dir='results',
             results_per_bundle=40,
+            s3_cache_policies=None,
             s3_creds=None,
             s3_public=True,
             skip_implicit=False,
+            svg_renderer='remote',
             test_id='1234',
             test_pattern=None,
+            trace_malloc=False,
             test_plan='test_plan',
             testdir='/foo',
             tests_yaml=None,
             verbose=False,
+            wait_for_capacity=None,
+            workers=16,
         )
         self.assertEqual(args, expected)
 
+    def test_parse_args_cache_policies(self):
+        with temp_dir() as tmp:
+            policies = os.path.join(tmp, 'policies.yaml')
+            with open(policies, 'w') as f:
+                f.write("- pattern: '\\.json$'\n"
+                        "  cache-control: no-cache\n")
+            args = run.parse_args(
+                ['aws', 'test_plan', '--s3-cache-policies', policies])
+        self.assertEqual(args.s3_cache_policies, [('\\.json$', 'no-cache')])
+
     @mock.patch(
         'cloudweatherreport.run.is_resource_available')
     def test_check_cloud_resource(self, ira_mock):
@@ -382,7 +1076,7 @@ class TestRunner(unittest.TestCase):
         test_plan = mock.Mock(
             cloud_resource=cloud_resource, spec_set=['cloud_resource'])
         cloud_info = {'cloud-tag': 'cloud-aws', 'cloud-region': 'us-west'}
-        runner = run.Runner('aws', False, mock.Mock())
+        runner = run.Runner('aws', mock.Mock())
         runner.check_cloud_resource(test_plan, cloud_info)
         ira_mock.assert_called_once_with(
             cloud='aws', cpu_limit=None, credentials_name=None,
@@ -397,7 +1091,7 @@ class TestRunner(unittest.TestCase):
         test_plan = mock.Mock(
             cloud_resource=cloud_resource, spec_set=['cloud_resource'])
         cloud_info = {'cloud-tag': 'cloud-aws', 'cloud-region': 'us-west'}
-        runner = run.Runner('aws', False, mock.Mock())
+        runner = run.Runner('aws', mock.Mock())
         os.environ['AWS_MACHINE_LIMIT'] = '10'
         os.environ['AWS_SECURITY_GROUP_LIMIT'] = '50'
         os.environ['AWS_CPU_LIMIT'] = '20'
@@ -413,6 +1107,79 @@ class TestRunner(unittest.TestCase):
             num_of_security_groups=1, region='us-west',
             security_group_limit=50)
 
+    @mock.patch(
+        'cloudweatherreport.run.is_resource_available')
+    def test_check_cloud_resource_reserved(self, ira_mock):
+        test_plan = mock.Mock(cloud_resource={'machines': 1, 'cpus': 2},
+                              spec_set=['cloud_resource'])
+        cloud_info = {'cloud-tag': 'cloud-aws', 'cloud-region': 'us-west'}
+        runner = run.Runner('aws', mock.Mock())
+        runner.check_cloud_resource(test_plan, cloud_info,
+                                    {'machines': 3, 'cpus': 4})
+        self.assertEqual(ira_mock.call_args[1]['num_of_instances'], 4)
+        self.assertEqual(ira_mock.call_args[1]['num_of_cpus'], 6)
+
+    def test_reserve_cloud_resource(self):
+        test_plan = mock.Mock(cloud_resource={'machines': 1, 'cpus': 2},
+                              spec_set=['cloud_resource'])
+        cloud_info = {'cloud-tag': 'cloud-aws', 'cloud-region': 'us-west'}
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            other = run.Runner('aws', mock.Mock())
+            runner = run.Runner('aws', mock.Mock())
+            with mock.patch.object(run.Runner, 'get_datastore',
+                                   return_value=ds):
+                with mock.patch.object(run.Runner, 'check_cloud_resource',
+                                       return_value=True) as mock_cr:
+                    self.assertTrue(
+                        other.reserve_cloud_resource(test_plan, cloud_info))
+                    self.assertTrue(
+                        runner.reserve_cloud_resource(test_plan, cloud_info))
+                    # the first reservation is counted by the second check
+                    self.assertEqual(mock_cr.call_args_list[1][0][2],
+                                     {'machines': 1, 'cpus': 2})
+                    self.assertEqual(len(reservation.read_ledger(ds)), 2)
+                    other.release_cloud_resource()
+                    self.assertIsNone(other.reservation_id)
+                    self.assertEqual(list(reservation.read_ledger(ds)),
+                                     [runner.reservation_id])
+                    # nothing is reserved if the resources are not available
+                    mock_cr.return_value = False
+                    other.reserve_cloud_resource(test_plan, cloud_info)
+                    self.assertIsNone(other.reservation_id)
+                    self.assertEqual(len(reservation.read_ledger(ds)), 1)
+
+    def test_reserve_cloud_resource_outside_lock(self):
+        test_plan = mock.Mock(cloud_resource={'machines': 1, 'cpus': 2},
+                              spec_set=['cloud_resource'])
+        cloud_info = {'cloud-tag': 'cloud-aws', 'cloud-region': 'us-west'}
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            other = run.Runner('aws', mock.Mock())
+            runner = run.Runner('aws', mock.Mock())
+            checks = []
+
+            def check(test_plan, cloud_info, reserved):
+                self.assertIsNone(ds._active_lock_filename())
+                checks.append(reserved)
+                if len(checks) == 1:
+                    # another runner reserves during the first check
+                    other.reserve_cloud_resource(test_plan, cloud_info)
+                return True
+
+            with mock.patch.object(run.Runner, 'get_datastore',
+                                   return_value=ds), \
+                    mock.patch.object(run.Runner, 'check_cloud_resource',
+                                      side_effect=check):
+                self.assertTrue(
+                    runner.reserve_cloud_resource(test_plan, cloud_info))
+        self.assertEqual(checks, [
+            {'machines': 0, 'cpus': 0},
+            {'machines': 0, 'cpus': 0},
+            {'machines': 1, 'cpus': 2},
+        ])
+        self.assertIsNotNone(runner.reservation_id)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,143 @@
+from unittest import TestCase
+
+import mock
+
+from cloudweatherreport.scheduler import (
+    EXIT_REQUEUE,
+    Job,
+    Scheduler,
+)
+
+
+class FakeProcess(object):
+    def __init__(self, exitcode=0):
+        self.exitcode = exitcode
+        self.joined = False
+
+    def is_alive(self):
+        return False
+
+    def join(self):
+        self.joined = True
+
+
+def make_job(controller, number, cloud=None, machines=None, cpus=None):
+    resource = None
+    if machines is not None:
+        resource = {'machines': machines, 'cpus': cpus}
+    test_plan = mock.Mock(bundle='bundle', cloud_resource=resource)
+    return Job(controller, test_plan, number, cloud)
+
+
+class TestJob(TestCase):
+
+    @mock.patch('cloudweatherreport.scheduler.time', return_value=100)
+    def test_wait(self, mtime):
+        job = make_job('aws', 1)
+        self.assertFalse(job.can_wait)
+        job = Job('aws', mock.Mock(), 1, wait_for_capacity=60)
+        self.assertTrue(job.can_wait)
+        mtime.return_value = 160
+        self.assertFalse(job.can_wait)
+
+    def test_needs(self):
+        self.assertEqual(make_job('aws', 1).needs,
+                         {'machines': 0, 'cpus': 0})
+        self.assertEqual(make_job('aws', 1, machines=3, cpus=6).needs,
+                         {'machines': 3, 'cpus': 6})
+
+
+class TestScheduler(TestCase):
+
+    def test_fits_per_controller(self):
+        scheduler = Scheduler(per_controller=2)
+        scheduler.running = {make_job('aws', 1): None}
+        self.assertTrue(scheduler.fits(make_job('aws', 2)))
+        scheduler.running[make_job('aws', 2)] = None
+        self.assertFalse(scheduler.fits(make_job('aws', 3)))
+        self.assertTrue(scheduler.fits(make_job('gce', 1)))
+
+    def test_fits_max_jobs(self):
+        scheduler = Scheduler(per_controller=2, max_jobs=2)
+        scheduler.running = {make_job('aws', 1): None,
+                             make_job('gce', 1): None}
+        self.assertFalse(scheduler.fits(make_job('azure', 1)))
+
+    def test_fits_limits(self):
+        scheduler = Scheduler(per_controller=5, limits={
+            'aws': {'machines': 5, 'cpus': None}})
+        scheduler.running = {make_job('aws', 1, 'aws', 3, 6): None}
+        self.assertEqual(scheduler.used('aws', 'machines'), 3)
+        self.assertTrue(scheduler.fits(make_job('aws', 2, 'aws', 2, 100)))
+        self.assertFalse(scheduler.fits(make_job('aws', 2, 'aws', 3, 1)))
+        # other clouds, and jobs without a known cloud, are not limited
+        self.assertTrue(scheduler.fits(make_job('gce', 1, 'google', 30)))
+        self.assertTrue(scheduler.fits(make_job('aws', 2, None, 30)))
+        # a job needing more than the limit runs once the cloud is idle
+        scheduler.running = {}
+        self.assertTrue(scheduler.fits(make_job('aws', 2, 'aws', 30)))
+
+    def test_run(self):
+        scheduler = Scheduler(per_controller=1, poll_interval=0)
+        jobs = [make_job('aws', 1), make_job('aws', 2), make_job('gce', 1)]
+        for job in jobs:
+            scheduler.add(job)
+        processes = {}
+        started = []
+
+        def start(job):
+            # only one job per controller may be running
+            self.assertNotIn(job.controller,
+                             [j.controller for j in scheduler.running])
+            started.append(job)
+            processes[job] = FakeProcess(exitcode=int(job.number == 2))
+            return processes[job]
+
+        self.assertTrue(scheduler.run(start))
+        self.assertEqual(started, [jobs[0], jobs[2], jobs[1]])
+        self.assertTrue(all(p.joined for p in processes.values()))
+        self.assertEqual(scheduler.running, {})
+        self.assertEqual(scheduler.pending, [])
+
+    @mock.patch('cloudweatherreport.scheduler.time', return_value=1000)
+    def test_requeue(self, mtime):
+        scheduler = Scheduler(retry_delay=10, max_retry_delay=30)
+        job = Job('aws', mock.Mock(), 1, wait_for_capacity=100)
+        delays = []
+        for _ in range(4):
+            scheduler.requeue(job)
+            delays.append(job.not_before - 1000)
+        self.assertEqual(delays, [10, 20, 30, 30])
+        # only the time after being requeued is counted as waiting
+        self.assertEqual(job.queue_wait, 0)
+        mtime.return_value = 1012
+        job.dequeue()
+        self.assertEqual(job.queue_wait, 12)
+        job.dequeue()
+        self.assertEqual(job.queue_wait, 12)
+        self.assertEqual(scheduler.pending, [job] * 4)
+        self.assertFalse(scheduler.fits(job))
+        mtime.return_value = 1030
+        self.assertTrue(scheduler.fits(job))
+        # the backoff never goes past the deadline
+        mtime.return_value = 1090
+        scheduler.requeue(job)
+        self.assertEqual(job.not_before, 1100)
+
+    def test_run_requeue(self):
+        scheduler = Scheduler(poll_interval=0, retry_delay=0)
+        jobs = [make_job('aws', 1), make_job('aws', 2)]
+        for job in jobs:
+            scheduler.add(job)
+        started = []
+
+        def start(job):
+            started.append(job)
+            # the first job is requeued on its first attempt
+            if job is jobs[0] and started.count(job) == 1:
+                return FakeProcess(EXIT_REQUEUE)
+            return FakeProcess()
+
+        self.assertFalse(scheduler.run(start))
+        self.assertEqual(started, [jobs[0], jobs[1], jobs[0]])
+        self.assertEqual(jobs[0].attempts, 1)
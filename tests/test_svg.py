@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+from xml.etree import ElementTree
+
+from cloudweatherreport import svg
+
+
+BUNDLE = """
+services:
+  wiki:
+    charm: cs:trusty/mediawiki-5
+    annotations:
+      gui-x: '100'
+      gui-y: '200'
+  db:
+    charm: cs:trusty/mysql-42
+    annotations:
+      gui-x: '500'
+      gui-y: '200'
+  cache:
+    charm: cs:memcached
+relations:
+  - ["wiki:db", "db:db"]
+  - [db, wiki]
+  - ["wiki:cache", [cache]]
+  - [wiki, missing]
+"""
+
+NS = '{http://www.w3.org/2000/svg}'
+
+
+class TestSvg(TestCase):
+
+    def test_layout(self):
+        positions = svg.layout({
+            'a': {'annotations': {'gui-x': '10', 'gui-y': 20}},
+            'b': {'annotations': {'gui-x': 'bad'}},
+            'c': {},
+        })
+        self.assertEqual(positions, {
+            'a': (10.0, 20.0),
+            'b': (10, 320),
+            'c': (310, 320),
+        })
+
+    def test_render(self):
+        root = ElementTree.fromstring(svg.render(BUNDLE))
+        self.assertEqual(root.tag, NS + 'svg')
+        self.assertEqual(root.get('viewBox'), '0 100 600 500')
+        services = root.findall('.//{}g[@class="service"]'.format(NS))
+        self.assertEqual([s.get('id') for s in services],
+                         ['cache', 'db', 'wiki'])
+        self.assertEqual([t.text for t in services[1].findall(NS + 'text')],
+                         ['mysql', 'db'])
+        lines = root.findall('.//{}line'.format(NS))
+        self.assertEqual(len(lines), 2)
+
+    def test_render_applications(self):
+        rendered = svg.render(
+            u'applications:\n  "wiki<é>":\n    charm: mediawiki\n')
+        root = ElementTree.fromstring(rendered)
+        self.assertEqual(
+            root.find('.//{}g[@class="service"]'.format(NS)).get('id'),
+            u'wiki<é>')
+
+    def test_render_wrapped(self):
+        self.assertIn('mediawiki', svg.render(
+            'deployment:\n  services:\n    wiki:\n      charm: mediawiki\n'))
+
+    def test_render_no_services(self):
+        self.assertIsNone(svg.render('services: {}'))
+        self.assertIsNone(svg.render('[not, a, bundle]'))
+        self.assertIsNone(svg.render('{bad yaml'))
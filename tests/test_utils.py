@@ -1,3 +1,4 @@
+from datetime import datetime
 import json
 import os
 from shutil import rmtree
@@ -9,10 +10,18 @@ from tempfile import (
 )
 from unittest import TestCase
 
-from mock import call, patch
+from mock import (
+    call,
+    Mock,
+    patch,
+)
 import yaml
 
-from cloudweatherreport import utils
+from cloudweatherreport import (
+    model,
+    utils,
+)
+from cloudweatherreport.datastore import LocalDataStore
 from cloudweatherreport.utils import (
     connect_juju_client,
     create_bundle_yaml,
@@ -25,7 +34,10 @@ from cloudweatherreport.utils import (
     run_action,
     temp_dir,
     temp_tmpdir,
+    timed,
     wait_for_action_complete,
+    write_bundle_index,
+    write_dashboard,
 )
 from . import common
 
@@ -84,6 +96,65 @@ class TestUtil(TestCase):
             wait_for_action_complete(
                 fake_client, pending_action['results'][0]['action']['tag'])
 
+    def test_wait_for_action_complete_failed(self):
+        fake_client = FakeActionClient()
+        fake_client.status = 'failed'
+        with self.assertRaisesRegexp(Exception, 'Action failed'):
+            wait_for_action_complete(fake_client, 'foo')
+
+    def test_wait_for_actions_complete(self):
+        client = Mock()
+        statuses = {'a': ['running'] * 4 + ['completed'],
+                    'b': ['running', 'failed'],
+                    'c': ['pending'] * 10}
+
+        def info(entities):
+            return {'results': [{'status': statuses[e['Tag']].pop(0)}
+                                for e in entities]}
+
+        client.info.side_effect = info
+        clock = [0]
+        pauses = []
+
+        def sleep(pause):
+            pauses.append(pause)
+            clock[0] += pause
+
+        with patch('cloudweatherreport.utils.sleep', side_effect=sleep):
+            with patch('cloudweatherreport.utils.time',
+                       side_effect=lambda: clock[0]):
+                results = utils.wait_for_actions_complete(
+                    client, ['a', 'b', 'c'], timeout=12, pause_time=1,
+                    max_pause_time=4)
+        self.assertEqual(results, {'a': {'status': 'completed'},
+                                   'b': {'status': 'failed'}})
+        # each poll asks for all the actions still pending at once
+        self.assertEqual(
+            [[e['Tag'] for e in c[0][0]] for c in client.info.call_args_list],
+            [['a', 'b', 'c'], ['a', 'b', 'c'], ['a', 'c'], ['a', 'c'],
+             ['a', 'c'], ['c']])
+        # backing off while nothing finishes, up to the time left
+        self.assertEqual(pauses, [2, 1, 2, 4, 1, 2])
+
+    def test_lttb(self):
+        values = [0, 1, 0, 5, 0, 1, 0, 1, None, 0]
+        self.assertEqual(utils.lttb(values, 20), [0, 1, 2, 3, 4, 5, 6, 7, 9])
+        selected = utils.lttb(values, 4)
+        self.assertEqual(len(selected), 4)
+        self.assertEqual(selected[0], 0)
+        self.assertEqual(selected[-1], 9)
+        # the peak is the most significant point
+        self.assertIn(3, selected)
+        self.assertEqual(utils.lttb(values, 2), [0, 9])
+        self.assertEqual(utils.lttb([None, None], 2), [])
+
+    def test_parallel_map(self):
+        self.assertEqual(sorted(utils.parallel_map(lambda x: x * 2,
+                                                   range(10), workers=3,
+                                                   progress_every=4)),
+                         [0, 2, 4, 6, 8, 10, 12, 14, 16, 18])
+        self.assertEqual(utils.parallel_map(lambda x: x, []), [])
+
     def test_mkdir_p(self):
         d = mkdtemp()
         path = os.path.join(d, 'a/b/c')
@@ -167,6 +238,15 @@ class TestUtil(TestCase):
                          [call(env_name='foo'), call(env_name='foo')])
         self.assertEqual(env, None)
 
+    def test_connect_juju_client_version(self):
+        with patch.object(utils, 'get_juju_major_version') as mversion:
+            with patch('jujuclient.juju1.environment.Environment',
+                       autospec=True) as jc_mock:
+                jc_mock.connect.return_value = 'bar'
+                env = connect_juju_client('foo', version=1)
+        self.assertEqual(env, 'bar')
+        self.assertFalse(mversion.called)
+
     def test_is_machine_agent_started(self):
         status = {
             'EnvironmentName': 'default-joyent',
@@ -248,6 +328,17 @@ class TestUtil(TestCase):
             self.assertIn('cwr-tmp', temp)
         self.assertFalse(os.path.exists(temp))
 
+    def test_timed(self):
+        timings = {'tests': 1}
+        with patch('cloudweatherreport.utils.time', side_effect=[10, 12.5]):
+            with timed(timings, 'tests'):
+                pass
+        with patch('cloudweatherreport.utils.time', side_effect=[20, 21]):
+            with self.assertRaises(ValueError):
+                with timed(timings, 'deploy'):
+                    raise ValueError()
+        self.assertEqual(timings, {'tests': 3.5, 'deploy': 1})
+
     def test_temp_dir_keep(self):
         with temp_dir() as p:
             with temp_dir(parent=p, keep=True) as d:
@@ -283,6 +374,111 @@ class TestUtil(TestCase):
         self.assertFalse(os.path.exists(tmp))
         self.assertEqual(old_tmpdir, gettempdir())
 
+    def test_publish_svg(self):
+        bundle_yaml = 'services: {}'
+        filename = utils.svg_filename(bundle_yaml)
+        self.assertRegexpMatches(filename, r'^svg/[0-9a-f]{64}\.svg$')
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            with patch('cloudweatherreport.utils.fetch_svg',
+                       return_value='<svg/>') as fetch_mock:
+                with patch.object(utils, '_svg_cache', set()):
+                    self.assertEqual(utils.publish_svg(ds, bundle_yaml),
+                                     filename)
+                    self.assertEqual(utils.publish_svg(ds, bundle_yaml),
+                                     filename)
+                    self.assertEqual(ds.read(filename), '<svg/>')
+                    self.assertIsNone(utils.publish_svg(ds, None))
+                with patch.object(utils, '_svg_cache', set()):
+                    self.assertEqual(utils.publish_svg(ds, bundle_yaml),
+                                     filename)
+            fetch_mock.assert_called_once_with(bundle_yaml)
+
+    @patch('cloudweatherreport.utils.time', return_value=1000)
+    def test_fetch_svg_down(self, mtime):
+        import requests
+        with patch.object(utils, '_svg_down_until', 0), \
+                patch('requests.post',
+                      side_effect=requests.Timeout('timed out')) as mpost:
+            self.assertIsNone(utils.fetch_svg('services: {}'))
+            self.assertIsNone(utils.fetch_svg('services: {}'))
+            self.assertEqual(mpost.call_count, 1)
+            mtime.return_value = 1000 + utils.SVG_RETRY_AFTER
+            mpost.side_effect = None
+            mpost.return_value = Mock(status_code=200, content='<svg/>')
+            self.assertEqual(utils.fetch_svg('services: {}'), '<svg/>')
+            # errors about the bundle itself don't stop other bundles
+            mpost.return_value = Mock(status_code=400, content='bad')
+            self.assertIsNone(utils.fetch_svg('services: ['))
+            mpost.return_value = Mock(status_code=200, content='<svg/>')
+            self.assertEqual(utils.fetch_svg('services: {}'), '<svg/>')
+            self.assertEqual(mpost.call_count, 4)
+
+    @patch('cloudweatherreport.utils.fetch_svg', return_value=None)
+    def test_publish_svg_failure(self, fetch_mock):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            with patch.object(utils, '_svg_cache', set()):
+                self.assertIsNone(utils.publish_svg(ds, 'services: {}'))
+                self.assertIsNone(utils.publish_svg(ds, 'services: {}'))
+                self.assertEqual(utils._svg_cache, set())
+            self.assertEqual(ds.list_recursive(), [])
+        self.assertEqual(fetch_mock.call_count, 2)
+
+    @patch('cloudweatherreport.utils.fetch_svg', return_value=None)
+    def test_publish_svg_local(self, fetch_mock):
+        bundle_yaml = 'services: {wiki: {charm: mediawiki}}'
+        filename = utils.svg_filename(bundle_yaml, 'local')
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            with patch.object(utils, '_svg_cache', set()):
+                self.assertEqual(utils.publish_svg(ds, bundle_yaml), filename)
+                self.assertIn('mediawiki', ds.read(filename))
+            self.assertEqual(fetch_mock.call_count, 1)
+            with patch.object(utils, '_svg_cache', set()):
+                self.assertEqual(utils.publish_svg(ds, bundle_yaml, 'local'),
+                                 filename)
+            self.assertEqual(fetch_mock.call_count, 1)
+
+    def test_write_dashboard(self):
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            self.assertIs(write_dashboard(ds), True)
+            self.assertIn('js/dashboard.js', ds.read('index.html'))
+            self.assertTrue(ds.exists('js/dashboard.js'))
+            ds.write('index.html', 'modified')
+            self.assertIs(write_dashboard(ds), False)
+            self.assertEqual(ds.read('index.html'), 'modified')
+            self.assertIs(write_dashboard(ds, force=True), True)
+            self.assertNotEqual(ds.read('index.html'), 'modified')
+
+    def test_write_bundle_index(self):
+        index = model.ReportIndex()
+        for i in range(5):
+            index.upsert_report(model.Report(
+                test_id='test{}'.format(i),
+                date=datetime(2000, 1, i + 1),
+                bundle=model.BundleInfo(name='bundle')))
+        with temp_dir() as tmp:
+            ds = LocalDataStore(tmp)
+            write_bundle_index(ds, index, 'bundle', 2)
+            self.assertEqual(sorted(ds.list('bundle')),
+                             ['index-2.html', 'index-2.json',
+                              'index.html', 'index.json'])
+            # Full pages are only written once, unless they list an
+            # updated report.
+            ds.write('bundle/index-2.json', 'old')
+            write_bundle_index(ds, index, 'bundle', 2, html=False)
+            self.assertEqual(ds.read('bundle/index-2.json'), 'old')
+            report = model.Report(test_id='test2',
+                                  bundle=model.BundleInfo(name='bundle'))
+            write_bundle_index(ds, index, 'bundle', 2, html=False,
+                               reports=[report])
+            self.assertNotEqual(ds.read('bundle/index-2.json'), 'old')
+            self.assertFalse(ds.exists('bundle/index-1.json'))
+            write_bundle_index(ds, index, 'bundle', 2, all_pages=True)
+            self.assertTrue(ds.exists('bundle/index-1.json'))
+
 
 def get_bundle_yaml():
     return """services:
@@ -307,8 +503,10 @@ class FakeActionClient:
     def enqueue_units(self, unit, action, action_param):
         return self.action
 
+    status = 'completed'
+
     def info(self, tag):
-        self.action['results'][0]['status'] = 'completed'
+        self.action['results'][0]['status'] = self.status
         self.action['results'][0]['output'] = {'users': 'user, someuser'}
         return self.action
 